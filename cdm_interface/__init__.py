@@ -4,3 +4,6 @@ __author__ = "William Tucker"
 __date__ = "2019-10-03"
 __copyright__ = "Copyright 2019 United Kingdom Research and Innovation"
 __license__ = "BSD - see LICENSE file in top-level directory"
+
+
+default_app_config = 'cdm_interface.apps.CdmInterfaceConfig'
@@ -0,0 +1,19 @@
+""" App configuration for the cdm_interface app. """
+
+import sys
+
+from django.apps import AppConfig
+
+
+class CdmInterfaceConfig(AppConfig):
+
+    name = 'cdm_interface'
+
+    def ready(self):
+        from cdm_interface import warmup
+
+        # Warm up serving processes only (not management commands, except runserver)
+        is_command = sys.argv[0].endswith('manage.py') and 'runserver' not in sys.argv
+
+        if warmup.is_enabled() and not is_command:
+            warmup.start()
@@ -0,0 +1,96 @@
+"""
+async_db.py
+===========
+
+Asynchronous database connections for the async views (in ASGI deployments).
+
+Uses the psycopg (version 3) `AsyncConnection`, so a request waiting on PostgreSQL
+does not hold a worker thread. Connections are kept in a per-process pool of up to
+`ASYNC_DB_POOL_SIZE` connections; requests wait (without blocking) for a free one.
+
+psycopg prepares statements itself once they have been executed `prepare_threshold`
+times on a connection, so the SQL from the `SQLManager` is executed directly.
+"""
+
+import asyncio
+
+from contextlib import asynccontextmanager
+
+from django.conf import settings
+
+import logging
+log = logging.getLogger(__name__)
+
+
+DEFAULT_ASYNC_DB_POOL_SIZE = 20
+
+# Number of executions of a statement on a connection before it is prepared
+PREPARE_THRESHOLD = 2
+
+_pool = None
+
+
+class AsyncConnectionPool(object):
+
+    def __init__(self, conn_str, size):
+        self._conn_str = conn_str
+        self._semaphore = asyncio.Semaphore(size)
+        self._idle = []
+
+    async def _connect(self):
+        try:
+            import psycopg
+        except ImportError:
+            raise Exception('The async views require the "psycopg" (version 3) package (the "async" extra).')
+
+        return await psycopg.AsyncConnection.connect(self._conn_str, prepare_threshold=PREPARE_THRESHOLD)
+
+    @asynccontextmanager
+    async def connection(self):
+        """
+        Yields a connection from the pool. As in `db.pooled_connection`, the transaction
+        is always rolled back before the connection is returned, and broken connections
+        are discarded.
+        """
+        async with self._semaphore:
+            conn = None
+            while self._idle and conn is None:
+                conn = self._idle.pop()
+                if conn.closed:
+                    conn = None
+
+            if conn is None:
+                conn = await self._connect()
+
+            try:
+                yield conn
+            finally:
+                broken = conn.closed or conn.broken
+
+                if not broken:
+                    try:
+                        await conn.rollback()
+                    except Exception:
+                        broken = True
+
+                if broken:
+                    await conn.close()
+                else:
+                    self._idle.append(conn)
+
+
+def get_async_pool():
+    "Returns the async connection pool of this process, creating it on first use."
+    global _pool
+
+    if _pool is None:
+        size = getattr(settings, 'ASYNC_DB_POOL_SIZE', DEFAULT_ASYNC_DB_POOL_SIZE)
+        log.info(f'Creating async connection pool with up to {size} connections.')
+        _pool = AsyncConnectionPool(settings.LOCAL_CONN_STR, size)
+
+    return _pool
+
+
+def async_connection():
+    "Async context manager that yields a connection from the async pool."
+    return get_async_pool().connection()
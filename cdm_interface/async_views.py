@@ -0,0 +1,218 @@
+""" Async views for the cdm_interface app, for ASGI deployments (see `ASYNC_VIEWS`).
+
+Database access is awaited (on the async connection pool), so a single process can
+hold many requests that are waiting on PostgreSQL. CPU-bound steps (converting rows
+to DataFrames, mapping values, CSV formatting and compression) run in a thread pool
+of `ASYNC_EXECUTOR_WORKERS` threads and the response is streamed as it is produced.
+"""
+
+__author__ = "Ag Stephens"
+__date__ = "2020-08-01"
+__copyright__ = "Copyright 2020 United Kingdom Research and Innovation"
+__license__ = "BSD - see LICENSE file in top-level directory"
+
+
+import time
+import asyncio
+import contextvars
+import functools
+
+from concurrent.futures import ThreadPoolExecutor
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.http import HttpResponse, StreamingHttpResponse
+from django.utils.cache import get_conditional_response
+
+from cdm_interface.views import SelectView, QueryManager, log_time
+from cdm_interface.async_db import async_connection
+from cdm_interface.frames import read_frame_async, estimate_csv_bytes
+from cdm_interface.file_namer import OutputFileNamer
+from cdm_interface.request_model import parse_request
+from cdm_interface.data_versions import validate_data_version
+from cdm_interface.utils import canonical_query
+from cdm_interface.streaming import iter_csv, iter_zip, aiterate
+from cdm_interface import query_log
+from cdm_interface import limits
+
+import logging
+log = logging.getLogger(__name__)
+
+
+DEFAULT_ASYNC_EXECUTOR_WORKERS = 8
+
+# SQLSTATE of a missing table (i.e. partition)
+UNDEFINED_TABLE = '42P01'
+
+_executor = None
+
+
+def get_executor():
+    "Returns the thread pool used for CPU-bound steps in the async views."
+    global _executor
+
+    if _executor is None:
+        workers = getattr(settings, 'ASYNC_EXECUTOR_WORKERS', DEFAULT_ASYNC_EXECUTOR_WORKERS)
+        _executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='cdm-lens-async')
+
+    return _executor
+
+
+async def run_in_executor(func, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    # Run in a copy of the context, so log records keep the request ID
+    call = functools.partial(contextvars.copy_context().run, func, *args, **kwargs)
+    return await loop.run_in_executor(get_executor(), call)
+
+
+class AsyncSelectView(SelectView):
+    "Async variant of `SelectView`, with a streamed response."
+
+    async def get(self, request, data_version=None):
+        log.info('Query string: %s', request.GET.urlencode())
+        return await self._select_async(request, request.GET, data_version)
+
+    async def head(self, request, data_version=None):
+        return await sync_to_async(self._count, thread_sensitive=False)(request.GET, data_version, head=True)
+
+    async def post(self, request, data_version=None):
+        params = request.GET.copy()
+
+        for key in request.POST:
+            params.setlist(key, request.POST.getlist(key))
+
+        log.info('Posted query: %s', params.urlencode()[:1000])
+        return await self._select_async(request, params, data_version)
+
+    async def _select_async(self, request, params, data_version):
+        versioned = data_version is not None
+        data_version = validate_data_version(data_version)
+
+        try:
+            selection = parse_request(params, data_version)
+        except Exception as exc:
+            log.warning(f'[ERROR] Invalid request: {exc}')
+            return HttpResponse(f'Exception raised when running query: {str(exc)}', status=400)
+
+        if selection.count_only:
+            return await sync_to_async(self._count, thread_sensitive=False)(selection.params, data_version,
+                                                                            selection=selection)
+
+        params = selection.params
+
+        etag = self._get_etag(params, data_version)
+        if request.method == 'GET':
+            not_modified = get_conditional_response(request, etag=etag)
+            if not_modified:
+                return not_modified
+
+        response = await run_in_executor(self._get_extract_response, params, data_version)
+        if response:
+            return self._set_cache_headers(response, etag, versioned)
+
+        log_time(f'{self._reqid}::RECEIVED_QUERY')
+        try:
+            qm = AsyncQueryManager(data_version, self._reqid, selection=selection)
+            data, data_policy_text = await qm.run_query(params)
+        except Exception as exc:
+            log.warning(f'[ERROR] Failed with exception: {exc}')
+            status = 413 if isinstance(exc, limits.RequestTooLarge) else 400
+            return HttpResponse(f'Exception raised when running query: {str(exc)}', status=status)
+
+        compress = selection.compress
+
+        if data_policy_text and not compress:
+            return HttpResponse('Cannot return a data policy info to uncompressed response.', status=400)
+
+        file_namer = OutputFileNamer(data_version, params, content=self.output_content)
+
+        if compress:
+            content_type = "application/x-zip-compressed"
+            response_file_name = file_namer.get_zip_name()
+            chunks = iter_zip([(file_namer.get_csv_name(), iter_csv(data)),
+                               (file_namer.get_policy_name(), [data_policy_text.encode('utf-8')])])
+        else:
+            content_type = "text/csv"
+            response_file_name = file_namer.get_csv_name()
+            chunks = iter_csv(data)
+
+        response = StreamingHttpResponse(aiterate(chunks, executor=get_executor()), content_type=content_type)
+        response["Content-Disposition"] = f'attachment; filename="{response_file_name}"'
+
+        if qm.next_page_token:
+            response['X-Next-Page-Token'] = qm.next_page_token
+
+        return self._set_cache_headers(response, etag, versioned)
+
+
+class AsyncQueryManager(QueryManager):
+
+    async def run_query(self, kwargs):
+        """
+        Returns tuple of: (results_data_frame, data_policy_text)
+        As `QueryManager.run_query`, with the queries run on an async connection.
+        """
+        log.debug('kwargs: %s', kwargs)
+        sql_manager, budget, page_size, queries = self._plan_query(kwargs)
+
+        dfs = []
+        chunksize = getattr(settings, 'QUERY_CHUNK_SIZE', 50000)
+
+        log_time(f'{self._reqid}::START_SQL')
+
+        async with async_connection() as conn:
+            stations = sql_manager._get_request(kwargs).stations
+            uses_station_table = sql_manager.needs_station_table(stations)
+
+            if uses_station_table:
+                await self._load_station_table_async(conn, stations, sql_manager.STATION_TABLE)
+
+            # Rows/bytes extracted by previous queries, so the budget applies to the whole request
+            extracted = {'rows': 0, 'bytes': 0}
+            check = lambda n_rows, n_bytes: self._check_budget(
+                budget, kwargs, extracted['rows'] + n_rows, extracted['bytes'] + n_bytes)
+
+            for query in queries:
+                log.debug('Running SQL: %s | params: %s', query.sql, query.params)
+
+                try:
+                    start = time.time()
+                    df = await read_frame_async(conn, query.sql, query.params, chunksize=chunksize,
+                                                check=check, executor=get_executor())
+                    log.info('Extracted a DataFrame of length: %d', len(df), extra={'rows': len(df)})
+                except limits.RequestTooLarge as exc:
+                    log.warning(f'ABORTED: Request too large - {exc}')
+                    raise
+                except Exception as exc:
+                    if getattr(exc, 'sqlstate', None) != UNDEFINED_TABLE:
+                        log.warning(f'FAILED: Error when extracting data! - query: {query.sql} - {exc}')
+                        raise Exception('Error when extracting data from the database.') from exc
+
+                    log.warning(f'No partition found for query: {query.sql}')
+                    await conn.rollback()
+                    continue
+
+                await run_in_executor(query_log.record_query, self._reqid, canonical_query(kwargs), query,
+                                      time.time() - start, rows=len(df), replayable=not uses_station_table)
+                extracted['rows'] += len(df)
+                extracted['bytes'] += estimate_csv_bytes(df)
+                dfs.append(df)
+
+        log_time(f'{self._reqid}::END_SQL')
+
+        return await run_in_executor(self._finish_query, kwargs, dfs, page_size)
+
+    async def _load_station_table_async(self, conn, stations, table):
+        "As `_load_station_table`, on an async connection."
+        log.warning(f'Loading {len(stations)} stations into temporary table: {table}')
+
+        async with conn.cursor() as cursor:
+            await cursor.execute(f"CREATE TEMPORARY TABLE IF NOT EXISTS {table} "
+                                 "(primary_station_id text PRIMARY KEY) ON COMMIT DROP;")
+            await cursor.execute(f"TRUNCATE {table};")
+
+            async with cursor.copy(f"COPY {table} (primary_station_id) FROM STDIN") as copy:
+                for station in stations:
+                    await copy.write_row((station,))
+
+            await cursor.execute(f"ANALYZE {table};")
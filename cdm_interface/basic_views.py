@@ -0,0 +1,79 @@
+""" Lightweight views for the cdm_interface app (status checks and constraints).
+
+These views do not import pandas or psycopg2, so they can be served without
+loading the data views in `views.py`.
+"""
+
+__author__ = "Ag Stephens"
+__date__ = "2020-08-01"
+__copyright__ = "Copyright 2020 United Kingdom Research and Innovation"
+__license__ = "BSD - see LICENSE file in top-level directory"
+
+
+import os
+import json
+
+from asgiref.sync import sync_to_async
+from django.views.generic import View
+from django.http import HttpResponse
+
+from cdm_interface.data_versions import validate_data_version
+from cdm_interface import constraints
+from cdm_interface import warmup
+
+import logging
+log = logging.getLogger(__name__)
+
+
+class HealthView(View):
+    "Liveness check: returns 200 if the worker process can serve requests."
+
+    def get(self, request):
+        return HttpResponse(json.dumps({'status': 'ok'}), content_type='application/json')
+
+
+class ReadyView(View):
+    """
+    Readiness check for load balancers: returns 200 once the worker has warmed up
+    (see `warmup.py`), or 503 with details of the warm-up while it is not ready.
+    """
+
+    def get(self, request):
+        if warmup.is_enabled():
+            warmup.start()
+
+        state = warmup.get_state()
+        status = 200 if state['ready'] else 503
+        return HttpResponse(json.dumps(state), content_type='application/json', status=status)
+
+
+class ConstraintsView(View):
+
+    def get(self, request, data_version, domain):
+        return self._get_constraints(data_version, domain)
+
+    def _get_constraints(self, data_version, domain):
+        log.warning(f'Requested constraints for: {domain}')
+        domain = domain.lower()
+
+        data_version = validate_data_version(data_version) 
+
+        if domain not in ('land', 'marine'):
+            return HttpResponse('Domain must be one of: "land", "marine".', status=400)
+
+        content_type = "application/json"
+        response_file_path = constraints.get_constraints_path(domain, data_version)
+        response_file_name = os.path.basename(response_file_path)
+
+        response = HttpResponse(constraints.read_constraints(domain, data_version), content_type=content_type)
+        content_disposition = f"attachment; filename=\"{response_file_name}\""
+        response["Content-Disposition"] = content_disposition
+
+        return response
+
+
+class AsyncConstraintsView(ConstraintsView):
+    "Async variant of `ConstraintsView`: the file is read in a thread."
+
+    async def get(self, request, data_version, domain):
+        return await sync_to_async(self._get_constraints, thread_sensitive=False)(data_version, domain)
@@ -0,0 +1,206 @@
+"""
+coalesce.py
+===========
+
+Single-flight coalescing of identical concurrent requests.
+
+`run_once(key, func)` runs `func` in one "leader" for all concurrent callers that
+use the same `key` (e.g. the canonical query), across threads and worker processes
+on the same host. Coordination uses `flock` on a lock file per key in
+`COALESCE_DIR`:
+
+  - The first caller takes the lock, runs `func` and, if other callers are waiting,
+    publishes the result (or the exception raised) to a result file.
+  - Concurrent callers wait for the lock to be released and then read the published
+    result under a shared lock (so they do not wait for each other).
+  - If the leader dies without publishing anything (e.g. the worker was killed),
+    the lock is released by the OS and the next waiting caller becomes the leader.
+
+The result is published before the leader's own response is sent, so the leader's
+client disconnecting does not affect the waiting requests.
+"""
+
+import fcntl
+import hashlib
+import os
+import pickle
+import tempfile
+import time
+
+from django.conf import settings
+
+import logging
+log = logging.getLogger(__name__)
+
+
+DEFAULT_COALESCE_DIR = os.path.join(tempfile.gettempdir(), 'cdm_lens_coalesce')
+
+# Maximum time (seconds) to wait for a leader before running independently
+DEFAULT_COALESCE_WAIT_TIMEOUT = 600
+
+# Published results older than this (seconds) are removed
+RESULT_TTL = 120
+
+POLL_INTERVAL = 0.05
+
+
+def _get_dir():
+    coalesce_dir = getattr(settings, 'COALESCE_DIR', DEFAULT_COALESCE_DIR)
+    os.makedirs(coalesce_dir, exist_ok=True)
+    return coalesce_dir
+
+
+def _touch(path):
+    with open(path, 'a'):
+        os.utime(path)
+
+
+def _mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+
+def _remove_stale_results(coalesce_dir):
+    now = time.time()
+
+    for fname in os.listdir(coalesce_dir):
+        if not fname.endswith('.result'):
+            continue
+
+        path = os.path.join(coalesce_dir, fname)
+        try:
+            if now - os.stat(path).st_mtime > RESULT_TTL:
+                os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+def run_once(key, func):
+    """
+    Returns the result of `func()`, sharing a single execution between all
+    concurrent callers with the same `key`. Exceptions raised by the leader
+    are re-raised in the callers that were waiting for it.
+    """
+    if not getattr(settings, 'COALESCE_REQUESTS', True):
+        return func()
+
+    coalesce_dir = _get_dir()
+    base = os.path.join(coalesce_dir, hashlib.sha256(key.encode('utf-8')).hexdigest())
+    lock_path, waiting_path, result_path = [f'{base}.{_}' for _ in ('lock', 'waiting', 'result')]
+
+    with open(lock_path, 'a') as lock_file:
+        if not _try_lock(lock_file, fcntl.LOCK_EX):
+            return _follow(lock_file, waiting_path, result_path, func)
+
+        try:
+            return _lead(coalesce_dir, waiting_path, result_path, func)
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def _lead(coalesce_dir, waiting_path, result_path, func, always_publish=False):
+    started = time.time_ns()
+
+    try:
+        result = (True, func())
+    except Exception as exc:
+        result = (False, exc)
+
+    # Only publish if another request started waiting while this one was running
+    waiting_since = _mtime(waiting_path)
+
+    if always_publish or (waiting_since is not None and waiting_since >= started):
+        log.info(f'Publishing coalesced result to: {result_path}')
+
+        try:
+            tmp_path = f'{result_path}.{os.getpid()}.tmp'
+            with open(tmp_path, 'wb') as writer:
+                pickle.dump(result, writer, protocol=pickle.HIGHEST_PROTOCOL)
+
+            os.replace(tmp_path, result_path)
+        except Exception as exc:
+            log.warning(f'Could not publish coalesced result: {exc}')
+
+    _remove_stale_results(coalesce_dir)
+
+    succeeded, value = result
+    if not succeeded:
+        raise value
+
+    return value
+
+
+def _try_lock(lock_file, operation):
+    try:
+        fcntl.flock(lock_file, operation | fcntl.LOCK_NB)
+        return True
+    except BlockingIOError:
+        return False
+
+
+def _read_published(result_path, started):
+    "Returns the result published after `started`, or None."
+    published = _mtime(result_path)
+    if published is None or published < started:
+        return None
+
+    try:
+        with open(result_path, 'rb') as reader:
+            return pickle.load(reader)
+    except FileNotFoundError:
+        return None
+
+
+def _use_published(result):
+    succeeded, value = result
+
+    log.info('Using coalesced result.')
+    if not succeeded:
+        raise value
+
+    return value
+
+
+def _follow(lock_file, waiting_path, result_path, func):
+    started = time.time_ns()
+    _touch(waiting_path)
+
+    timeout = getattr(settings, 'COALESCE_WAIT_TIMEOUT', DEFAULT_COALESCE_WAIT_TIMEOUT)
+    deadline = time.time() + timeout
+
+    log.info(f'Waiting for identical request in progress: {result_path}')
+
+    while True:
+        # The published result is read under a shared lock, so waiting requests do not
+        # queue behind each other
+        if _try_lock(lock_file, fcntl.LOCK_SH):
+            try:
+                result = _read_published(result_path, started)
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+            if result is not None:
+                return _use_published(result)
+
+            # The leader failed without publishing a result, so become the leader
+            # (and publish, as other requests may have been waiting for the failed one)
+            if _try_lock(lock_file, fcntl.LOCK_EX):
+                try:
+                    result = _read_published(result_path, started)
+
+                    if result is None:
+                        log.warning('No coalesced result published by leader, running request.')
+                        return _lead(os.path.dirname(result_path), waiting_path, result_path, func,
+                                     always_publish=True)
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+                return _use_published(result)
+
+        if time.time() > deadline:
+            log.warning(f'Timed out waiting for identical request after {timeout}s, running independently.')
+            return func()
+
+        time.sleep(POLL_INTERVAL)
@@ -0,0 +1,41 @@
+"""
+constraints.py
+==============
+
+Cached access to the constraints JSON files (per domain and data version) that
+are served by the constraints view. A file is re-read only if its modification
+time changes.
+"""
+
+import os
+import threading
+
+from django.conf import settings
+
+
+DOMAINS = ('land', 'marine')
+
+_cache = {}
+_lock = threading.Lock()
+
+
+def get_constraints_path(domain, data_version):
+    return f'{settings.STATIC_ROOT}/constraints/constraints-{domain}-{data_version}.json'
+
+
+def read_constraints(domain, data_version):
+    "Returns the contents of the constraints file for `domain` and `data_version`."
+    path = get_constraints_path(domain, data_version)
+    mtime = os.stat(path).st_mtime
+
+    cached = _cache.get(path)
+    if cached and cached[0] == mtime:
+        return cached[1]
+
+    with open(path) as reader:
+        content = reader.read()
+
+    with _lock:
+        _cache[path] = (mtime, content)
+
+    return content
@@ -1,30 +1,121 @@
+"""
+data_policies.py
+================
+
+Data policy information for a set of observations, derived from their sources
+(`source_configuration.psv`) and nations (`national_data_policies.psv`).
+
+Both tables are held in a `PolicyRegistry`, indexed by `source_id` and `country_id`.
+The registry is loaded when the app starts (see `apps.py`) and is reloaded when the
+modification time of a file changes. A reload builds new indexes and swaps them in
+under a lock, so concurrent requests always see a complete table.
+
+The file paths are set with the `SOURCE_CONFIG_FILE` and `NATIONAL_POLICIES_FILE`
+settings.
+"""
+
+import os
+import threading
+
 import pandas as pd
 from io import StringIO
 
+from django.conf import settings
+
+import logging
+log = logging.getLogger(__name__)
+
 
 NATIONAL_POLICIES_FILE = '/usr/local/cdm_lens/tables/national_data_policies.psv' 
 SOURCE_CONFIG_FILE = '/usr/local/cdm_lens/tables/source_configuration.psv'
 
-ndp = None
-source_config = None
 
+class PolicyTable(object):
+    """
+    A PSV table indexed by `key` (as a string): each key maps to a list of
+    (position in file, record) tuples, so lookups preserve the file order.
+    """
 
-def get_national_data_policies():
-    global ndp
+    def __init__(self, path, key):
+        self.path = path
+        self.key = key
+        self.mtime = None
+        self.df = None
+        self.index = {}
 
-    if ndp is None:
-        ndp = pd.read_csv(NATIONAL_POLICIES_FILE, sep='|')
+    def load(self):
+        "Returns a new `PolicyTable` loaded from the current contents of the file."
+        table = PolicyTable(self.path, self.key)
 
-    return ndp
+        # Get the mtime first, so a change during the read triggers another reload
+        table.mtime = os.stat(self.path).st_mtime
+        table.df = pd.read_csv(self.path, sep='|')
 
+        for position, record in enumerate(table.df.to_dict('records')):
+            table.index.setdefault(str(record[self.key]), []).append((position, record))
 
-def get_source_config():
-    global source_config
+        log.info(f'Loaded {len(table.df)} data policy records from: {self.path}')
+        return table
+
+    def is_stale(self):
+        try:
+            return os.stat(self.path).st_mtime != self.mtime
+        except OSError:
+            # Keep serving the loaded table if the file is (temporarily) missing
+            return self.df is None
+
+    def lookup(self, keys, columns):
+        "Returns a DataFrame of the records for `keys` (in file order) with `columns`."
+        found = [_ for key in set([str(_) for _ in keys]) for _ in self.index.get(key, [])]
+        return pd.DataFrame([record for _, record in sorted(found, key=lambda _: _[0])], columns=columns)
+
+
+class PolicyRegistry(object):
+    "Thread-safe holder of the source configuration and national data policy tables."
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._tables = {}
+
+    def _get_paths(self):
+        return {
+            'source': (getattr(settings, 'SOURCE_CONFIG_FILE', SOURCE_CONFIG_FILE), 'source_id'),
+            'nation': (getattr(settings, 'NATIONAL_POLICIES_FILE', NATIONAL_POLICIES_FILE), 'country_id'),
+        }
+
+    def load(self):
+        "Loads (or reloads) any tables that are not loaded or whose files have changed."
+        for name in self._get_paths():
+            self.get(name)
+
+    def get(self, name):
+        "Returns the current `PolicyTable` called `name` ('source' or 'nation')."
+        table = self._tables.get(name)
+        path, key = self._get_paths()[name]
+
+        if table is not None and table.path == path and not table.is_stale():
+            return table
+
+        with self._lock:
+            table = self._tables.get(name)
+
+            if table is None or table.path != path or table.is_stale():
+                # Build the new table fully before it replaces the old one
+                table = PolicyTable(path, key).load()
+                self._tables[name] = table
 
-    if source_config is None:
-        source_config = pd.read_csv(SOURCE_CONFIG_FILE, sep='|')         
+        return table
 
-    return source_config
+
+registry = PolicyRegistry()
+
+
+def get_national_data_policies():
+    return registry.get('nation').df
+
+
+def get_source_config():
+    return registry.get('source').df
 
 
 def _select(sql_query, conn_str):
@@ -48,11 +139,8 @@ def _get_policies_by_source(df):
 #                 f' FROM source_configuration WHERE source_id IN ({source_ids_string});'
 #    df = _select(source_sql)
 
-    source_config = get_source_config()
-    source_df = source_config[source_config['source_id'].isin(source_ids)]
-
-    # Return filtered df containing only the required fields
-    return source_df[req_fields]
+    # Return records for the sources found, containing only the required fields
+    return registry.get('source').lookup(source_ids, req_fields)
 
 
 def _title(n):
@@ -68,16 +156,10 @@ def _value(v):
 
 def _get_policies_by_nation(df):
     country_ids = set([_[:2] for _ in df['observation_id'].unique()])
-    
-    ndps = get_national_data_policies()
-    countries_with_policies = set(ndps.country_id.unique())
-    
-    # Get countries with a policy that we have found data for
-    countries = countries_with_policies & country_ids 
 
     # Extract and return records for countries with matching policies
-    national_policies = ndps[ndps['country_id'].isin(list(countries))]
-    return national_policies
+    ndps = registry.get('nation')
+    return ndps.lookup(country_ids, list(ndps.df.columns))
 
 
 def _render_data_policies(pols):
@@ -153,6 +235,26 @@ def get_data_policies(df, rendered=True):
     return pols 
 
 
+def merge_data_policies(policies, rendered=True):
+    """
+    Merges a list of data policies from `get_data_policies(df, rendered=False)`, e.g.
+    for the results of several selections, without duplicates.
+
+    if `rendered` is True: return as a single string.
+    if `rendered` is False: return as a dictionary.
+    """
+    pols = {}
+
+    for key in ('by_source', 'by_nation'):
+        frames = [_[key] for _ in policies]
+        pols[key] = pd.concat(frames, ignore_index=True).drop_duplicates() if frames else pd.DataFrame()
+
+    if rendered:
+        pols = _render_data_policies(pols)
+
+    return pols
+
+
 def test_get_national_data_policies():
     _ = get_national_data_policies()
     assert(len(_) == 8)
@@ -0,0 +1,156 @@
+"""
+db.py
+=====
+
+Pooled database connections and per-connection server-side prepared statements.
+
+Connections are taken from a process-wide pool (`pooled_connection`), so that they
+(and the statements prepared on them) are reused across requests. Queries from the
+`SQLManager` are prepared once per connection, keyed by their SQL, which contains
+only the partition name and the shape of the predicates (all values are bound as
+parameters). Repeated request shapes therefore skip the parse/plan step.
+
+Queries read into DataFrames (see `frames.read_frame`) are not prepared: they run in
+server-side cursors, so that large results are fetched in chunks and can be stopped
+early, and a prepared statement cannot be declared as a cursor.
+"""
+
+import hashlib
+import re
+import threading
+import time
+
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import psycopg2
+import psycopg2.extensions
+import psycopg2.pool
+
+from django.conf import settings
+
+import logging
+log = logging.getLogger(__name__)
+
+
+DEFAULT_POOL_MIN_CONNECTIONS = 1
+DEFAULT_POOL_MAX_CONNECTIONS = 8
+
+# Maximum time (seconds) to wait for a free connection when the pool is exhausted
+DEFAULT_POOL_TIMEOUT = 30
+POOL_POLL_INTERVAL = 0.05
+
+# Maximum number of prepared statements kept on each connection
+DEFAULT_MAX_PREPARED_STATEMENTS = 200
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+class PreparingConnection(psycopg2.extensions.connection):
+    "A connection that records the statements that have been prepared on it."
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared = OrderedDict()
+
+
+def get_pool():
+    "Returns the process-wide connection pool, creating it on first use."
+    global _pool
+
+    with _pool_lock:
+        if _pool is None:
+            min_conns = getattr(settings, 'DB_POOL_MIN_CONNECTIONS', DEFAULT_POOL_MIN_CONNECTIONS)
+            max_conns = getattr(settings, 'DB_POOL_MAX_CONNECTIONS', DEFAULT_POOL_MAX_CONNECTIONS)
+
+            log.info(f'Creating connection pool with {min_conns}-{max_conns} connections.')
+            _pool = psycopg2.pool.ThreadedConnectionPool(min_conns, max_conns, settings.LOCAL_CONN_STR,
+                                                         connection_factory=PreparingConnection)
+
+    return _pool
+
+
+def _getconn(pool):
+    "Gets a connection from `pool`, waiting up to DB_POOL_TIMEOUT seconds for one to be free."
+    deadline = time.time() + getattr(settings, 'DB_POOL_TIMEOUT', DEFAULT_POOL_TIMEOUT)
+
+    while True:
+        try:
+            return pool.getconn()
+        except psycopg2.pool.PoolError:
+            if time.time() > deadline:
+                raise
+
+            time.sleep(POOL_POLL_INTERVAL)
+
+
+@contextmanager
+def pooled_connection():
+    """
+    Context manager that yields a connection from the pool. The transaction is
+    always ended (rolled back) before the connection is returned, so temporary
+    tables created with ON COMMIT DROP do not leak into the next request.
+    Broken connections are discarded from the pool.
+    """
+    pool = get_pool()
+    conn = _getconn(pool)
+
+    try:
+        yield conn
+    finally:
+        broken = bool(conn.closed)
+
+        if not broken:
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                broken = True
+
+        pool.putconn(conn, close=broken)
+
+
+def _to_positional(sql):
+    "Converts psycopg2 '%s' placeholders to PostgreSQL '$n' placeholders."
+    counter = iter(range(1, sql.count('%s') + 1))
+    sql = re.sub(r'(?<!%)%s', lambda _: f'${next(counter)}', sql)
+    return sql.replace('%%', '%')
+
+
+def _statement_name(sql):
+    return 'cdm_' + hashlib.sha1(sql.encode('utf-8')).hexdigest()[:20]
+
+
+def prepare(conn, sql, params):
+    """
+    Prepares `sql` on `conn` (if not already prepared) and returns the SQL to
+    execute it with `params`, i.e.: "EXECUTE <name> (%s, ...)".
+
+    Connections that do not support prepared statement tracking (i.e. not
+    created by the pool) just get the original SQL back.
+    """
+    prepared = getattr(conn, 'prepared', None)
+    if prepared is None:
+        return sql
+
+    name = _statement_name(sql)
+
+    if name in prepared:
+        prepared.move_to_end(name)
+    else:
+        max_prepared = getattr(settings, 'DB_MAX_PREPARED_STATEMENTS', DEFAULT_MAX_PREPARED_STATEMENTS)
+
+        with conn.cursor() as cursor:
+            while len(prepared) >= max_prepared:
+                oldest, _ = prepared.popitem(last=False)
+                cursor.execute(f'DEALLOCATE {oldest}')
+
+            log.info(f'Preparing statement {name}: {sql}')
+            cursor.execute(f'PREPARE {name} AS {_to_positional(sql)}')
+
+        prepared[name] = sql
+
+    if not params:
+        return f'EXECUTE {name}'
+
+    return f'EXECUTE {name} (' + ', '.join(['%s'] * len(params)) + ')'
@@ -0,0 +1,142 @@
+"""
+extracts.py
+===========
+
+Store of pre-built bulk extracts.
+
+Many requests are for whole partitions: all variables, globally, for a whole year or
+month. The "build_extracts" management command runs these selections offline and
+writes each result as a ready-made zip file (with the same contents as a response of
+`/select`) into the `EXTRACT_STORE_DIR` directory. Each file is recorded in a manifest
+(`manifest.json` in the same directory), keyed by the data version and the canonical
+query string of the selection.
+
+`SelectView` looks up (compressed) requests in the manifest and serves a matching file
+directly; other requests are run as live queries. The manifest is reloaded when its
+modification time changes, so new extracts are picked up without a restart.
+
+The manifest also records the number of modifications of the partition (from the
+PostgreSQL statistics collector) when the extract was built, so the builder only
+rebuilds extracts of partitions that have changed.
+"""
+
+import datetime
+import hashlib
+import json
+import os
+import tempfile
+import threading
+
+from django.conf import settings
+
+from cdm_interface.utils import canonical_query
+
+import logging
+log = logging.getLogger(__name__)
+
+
+MANIFEST_FILE = 'manifest.json'
+
+
+def get_key(data_version, params):
+    "Returns the manifest key of a selection: `params` of `data_version`."
+    return f'{data_version}?' + canonical_query(params, ignore=('compress',))
+
+
+def _write_atomic(path, write):
+    "Writes a file by calling `write(file_object)` on a temporary file, then renaming it to `path`."
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp-')
+
+    try:
+        with os.fdopen(fd, 'wb') as writer:
+            write(writer)
+
+        os.replace(tmp_path, path)
+    except Exception:
+        os.remove(tmp_path)
+        raise
+
+
+class ExtractStore(object):
+    "A directory of pre-built extracts, with its manifest."
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._lock = threading.Lock()
+        self._mtime = None
+        self._entries = {}
+
+    @property
+    def manifest_path(self):
+        return os.path.join(self.directory, MANIFEST_FILE)
+
+    def _get_entries(self):
+        "Returns the manifest entries, reloaded if the manifest has changed."
+        try:
+            mtime = os.stat(self.manifest_path).st_mtime
+        except OSError:
+            return {}
+
+        with self._lock:
+            if mtime != self._mtime:
+                with open(self.manifest_path) as reader:
+                    self._entries = json.load(reader)
+
+                self._mtime = mtime
+                log.info(f'Loaded {len(self._entries)} extracts from: {self.manifest_path}')
+
+            return self._entries
+
+    def get_entry(self, data_version, params):
+        return self._get_entries().get(get_key(data_version, params))
+
+    def lookup(self, data_version, params):
+        "Returns the path of the extract matching the selection, or None."
+        entry = self.get_entry(data_version, params)
+
+        if not entry:
+            return None
+
+        path = os.path.join(self.directory, entry['file'])
+        return path if os.path.isfile(path) else None
+
+    def add(self, data_version, params, write, **info):
+        """
+        Writes an extract, by calling `write(file_object)`, and records it in the manifest
+        with `info` (e.g. the partition, its number of modifications and rows).
+        """
+        key = get_key(data_version, params)
+        file_name = hashlib.sha1(key.encode('utf-8')).hexdigest() + '.zip'
+
+        os.makedirs(self.directory, exist_ok=True)
+        _write_atomic(os.path.join(self.directory, file_name), write)
+
+        entries = dict(self._get_entries())
+        entries[key] = dict(info, file=file_name, created=datetime.datetime.utcnow().isoformat())
+
+        content = json.dumps(entries, indent=2, sort_keys=True).encode('utf-8')
+        _write_atomic(self.manifest_path, lambda writer: writer.write(content))
+
+        return file_name
+
+
+_stores = {}
+
+
+def get_store():
+    "Returns the `ExtractStore` in EXTRACT_STORE_DIR, or None if it is not set."
+    directory = getattr(settings, 'EXTRACT_STORE_DIR', None)
+
+    if not directory:
+        return None
+
+    if directory not in _stores:
+        _stores[directory] = ExtractStore(directory)
+
+    return _stores[directory]
+
+
+def lookup(data_version, params):
+    "Returns the path of a pre-built extract matching the selection, or None."
+    store = get_store()
+    return store.lookup(data_version, params) if store else None
@@ -1,15 +1,17 @@
 import os
-import random
+import hashlib
 
 
 from cdm_interface.data_versions import validate_data_version
+from cdm_interface.utils import canonical_query
 
 
 class OutputFileNamer:
 
-    def __init__(self, data_version, req):
+    def __init__(self, data_version, req, content='obs'):
         data_version = validate_data_version(data_version)
-        self._suffix = self._get_suffix(data_version)
+        self._content = content
+        self._suffix = self._get_suffix(data_version, req)
         self._build(req)
 
     def _build(self, req):
@@ -17,7 +19,7 @@ class OutputFileNamer:
         domain = req.get('domain', 'land')
         frequency = req.get('frequency').replace('_', '-') 
 
-        if req.get('bbox', None):
+        if any(req.get(_, None) for _ in ('bbox', 'polygon', 'point', 'station')):
             area = 'subset'
         else:
             area = 'global'
@@ -51,7 +53,7 @@ class OutputFileNamer:
         return sorted(list(resp)) 
 
     def get_csv_name(self):
-        return f'{self._base}_csv-obs_{self._suffix}.csv'
+        return f'{self._base}_csv-{self._content}_{self._suffix}.csv'
 
     def get_policy_name(self):
         return f'{self._base}_data-policy_{self._suffix}.txt'
@@ -59,8 +61,10 @@ class OutputFileNamer:
     def get_zip_name(self):
         return f'{self._base}_{self._suffix}.zip'
 
-    def _get_suffix(self, data_version):
-        return ''.join([str(random.randint(0, 9)) for _ in range(8)]) + "_" + data_version
+    def _get_suffix(self, data_version, req):
+        "Returns a suffix from a hash of the request, so identical requests give identical file names."
+        selection = f'{data_version}/{self._content}?' + canonical_query(req, ignore=('compress',))
+        return hashlib.sha1(selection.encode('utf-8')).hexdigest()[:8] + "_" + data_version
 
 
 
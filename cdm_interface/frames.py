@@ -0,0 +1,230 @@
+"""
+frames.py
+=========
+
+Memory-lean extraction of query results into pandas DataFrames.
+
+Results are fetched from a server-side (named) cursor in chunks, so that only one
+chunk is transferred and held at a time, and each chunk is converted to explicit
+dtypes for the CDM lite columns before the next one is fetched:
+
+  - code columns and repetitive strings (stations, sources) are categoricals
+  - categorical codes are stored in the smallest integer type that fits
+  - `date_time` is a tz-aware (UTC) timestamp
+  - columns that are only used internally (`location`, `date`) are dropped
+
+The chunks are then concatenated, keeping categoricals as categoricals.
+"""
+
+import asyncio
+import itertools
+import resource
+
+import pandas as pd
+from pandas.api.types import union_categoricals
+
+import logging
+log = logging.getLogger(__name__)
+
+
+DEFAULT_CHUNK_SIZE = 50000
+
+# Names of the server-side cursors (unique within the process)
+_cursor_ids = itertools.count()
+
+# Columns that are never returned to the user, so they are dropped as each chunk is read
+DROP_COLUMNS = ['location', 'date']
+
+CATEGORY = 'category'
+FLOAT = 'float'
+TIMESTAMP = 'timestamp'
+
+# Explicit dtypes for the CDM lite observation columns.
+# NOTE: floats are kept as float64, so that values are written to CSV unchanged.
+CDM_LITE_SCHEMA = {
+    'observation_id': None,
+    'data_policy_licence': CATEGORY,
+    'date_time': TIMESTAMP,
+    'date_time_meaning': CATEGORY,
+    'observation_duration': CATEGORY,
+    'longitude': FLOAT,
+    'latitude': FLOAT,
+    'report_type': CATEGORY,
+    'height_above_surface': FLOAT,
+    'observed_variable': CATEGORY,
+    'units': CATEGORY,
+    'observation_value': FLOAT,
+    'value_significance': CATEGORY,
+    'platform_type': CATEGORY,
+    'station_type': CATEGORY,
+    'primary_station_id': CATEGORY,
+    'station_name': CATEGORY,
+    'quality_flag': CATEGORY,
+    'source_id': CATEGORY,
+}
+
+
+def _apply_dtypes(df):
+    for column in df.columns:
+        kind = CDM_LITE_SCHEMA.get(column)
+
+        if kind == CATEGORY:
+            df[column] = df[column].astype('category')
+        elif kind == TIMESTAMP:
+            df[column] = pd.to_datetime(df[column], utc=True)
+        elif kind == FLOAT:
+            df[column] = pd.to_numeric(df[column]).astype('float64')
+
+    return df
+
+
+def concat_frames(chunks, columns=()):
+    "Concatenates typed chunks, unioning the categories of categorical columns."
+    if not chunks:
+        return _apply_dtypes(pd.DataFrame(columns=columns))
+
+    if len(chunks) == 1:
+        return chunks[0]
+
+    data = {}
+    for column in chunks[0].columns:
+        parts = [chunk[column] for chunk in chunks]
+
+        if isinstance(parts[0].dtype, pd.CategoricalDtype):
+            try:
+                data[column] = pd.Series(union_categoricals(parts))
+            except TypeError:
+                # Categories of different types (e.g. a chunk with only NULLs)
+                data[column] = pd.concat([_.astype(object) for _ in parts], ignore_index=True).astype('category')
+        else:
+            data[column] = pd.concat(parts, ignore_index=True)
+
+    return pd.DataFrame(data)
+
+
+def estimate_csv_bytes(df, sample_size=1000):
+    "Estimates the size of `df` as CSV, from a sample of its rows."
+    if not len(df):
+        return 0
+
+    sample = df.head(sample_size)
+    return int(len(sample.to_csv(index=False, header=False)) * len(df) / len(sample))
+
+
+def _to_frame(rows, columns):
+    exclude = [_ for _ in DROP_COLUMNS if _ in columns]
+    return _apply_dtypes(pd.DataFrame.from_records(rows, columns=columns, exclude=exclude))
+
+
+def get_cursor_name():
+    return f'cdm_frame_{next(_cursor_ids)}'
+
+
+def read_frame(conn, sql, params=None, chunksize=DEFAULT_CHUNK_SIZE, check=None):
+    """
+    Executes `sql` (with `params`) on `conn` and returns the results as a typed
+    DataFrame, fetching and converting them `chunksize` rows at a time.
+
+    The query runs in a server-side cursor (so it must be a SELECT, not an EXECUTE
+    of a prepared statement), that produces rows only as they are fetched.
+
+    If `check` is given, it is called as `check(n_rows, n_bytes)` after each chunk
+    with the running totals of rows and (estimated) CSV bytes, so that it can abort
+    the read by raising an exception. The cursor is then closed, which stops the
+    query in the database before the rest of the results are produced.
+    """
+    with conn.cursor(name=get_cursor_name()) as cursor:
+        cursor.itersize = chunksize
+        cursor.execute(sql, params)
+
+        chunks = []
+        columns = None
+        n_rows = n_bytes = 0
+
+        while True:
+            rows = cursor.fetchmany(chunksize)
+
+            # The description of a named cursor is only set by the first fetch
+            if columns is None:
+                columns = [_.name for _ in cursor.description]
+
+            if not rows:
+                break
+
+            chunk = _to_frame(rows, columns)
+            chunks.append(chunk)
+
+            if check:
+                n_rows += len(chunk)
+                n_bytes += estimate_csv_bytes(chunk)
+                check(n_rows, n_bytes)
+
+    return concat_frames(chunks, [_ for _ in columns if _ not in DROP_COLUMNS])
+
+
+async def read_frame_async(conn, sql, params=None, chunksize=DEFAULT_CHUNK_SIZE, check=None, executor=None):
+    """
+    As `read_frame`, for an async (psycopg 3) connection. Fetching is awaited and
+    the (CPU-bound) conversion of each chunk runs in `executor`.
+    """
+    loop = asyncio.get_running_loop()
+
+    async with conn.cursor(name=get_cursor_name()) as cursor:
+        cursor.itersize = chunksize
+        await cursor.execute(sql, params)
+        columns = [_.name for _ in cursor.description]
+        keep = [_ for _ in columns if _ not in DROP_COLUMNS]
+
+        chunks = []
+        n_rows = n_bytes = 0
+
+        while True:
+            rows = await cursor.fetchmany(chunksize)
+            if not rows:
+                break
+
+            chunk = await loop.run_in_executor(executor, _to_frame, rows, columns)
+            chunks.append(chunk)
+
+            if check:
+                n_rows += len(chunk)
+                n_bytes += estimate_csv_bytes(chunk)
+                check(n_rows, n_bytes)
+
+    return await loop.run_in_executor(executor, concat_frames, chunks, keep)
+
+
+def map_categories(df, mappers):
+    """
+    Maps code values to labels, in place, for each (column, mapper) in `mappers`.
+    For categorical columns, only the categories are mapped (not every row).
+    """
+    for column, mapper in mappers:
+        if column not in df:
+            continue
+
+        series = df[column]
+
+        if isinstance(series.dtype, pd.CategoricalDtype):
+            labels = [mapper.get(_, _) for _ in series.cat.categories]
+
+            if len(set(labels)) == len(labels):
+                df[column] = series.cat.rename_categories(labels)
+            else:
+                df[column] = series.astype(object).replace(mapper).astype('category')
+        else:
+            df[column] = series.replace(mapper)
+
+
+def get_memory_usage():
+    "Returns a tuple of (current RSS, peak RSS) in MB for this process."
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+
+    try:
+        with open('/proc/self/statm') as reader:
+            pages = int(reader.read().split()[1])
+        current = pages * resource.getpagesize() / 1024. ** 2
+    except (OSError, IndexError, ValueError):
+        current = None
+
+    return current, peak
@@ -0,0 +1,175 @@
+"""
+inventory.py
+============
+
+Materialised station/variable inventory tables.
+
+Each observations partition (`<schema>.observations_<year>_<domain>_<report_type>`)
+has an inventory table (`<schema>.inventory_<year>_<domain>_<report_type>`) with one
+row per station, variable and month, holding:
+
+  - the number of observations
+  - the first and last `date_time`
+  - the (latest) location of the station
+
+The tables are built and refreshed with the "build_inventory" management command and
+are used to answer availability questions (`/inventory`) without scanning partitions.
+
+Refreshes are incremental: a partition is only re-scanned if it has been modified
+(according to the PostgreSQL statistics collector) since its inventory was built,
+and a refresh can be limited to specific months.
+"""
+
+import datetime
+import re
+
+from cdm_interface.data_versions import DATA_VERSIONS
+
+import logging
+log = logging.getLogger(__name__)
+
+
+PARTITION_REGEX = r'^observations_(\d{4})_(land|marine)_(\d+)$'
+
+STATE_TABLE = 'inventory_state'
+
+create_state_tmpl = ("CREATE TABLE IF NOT EXISTS {schema}." + STATE_TABLE + " ("
+    "partition text PRIMARY KEY, modifications bigint, refreshed timestamptz)")
+
+create_tmpl = ("CREATE TABLE IF NOT EXISTS {inventory} ("
+    "primary_station_id text NOT NULL, "
+    "observed_variable integer NOT NULL, "
+    "month date NOT NULL, "
+    "observation_count bigint NOT NULL, "
+    "first_date_time timestamptz, "
+    "last_date_time timestamptz, "
+    "longitude double precision, "
+    "latitude double precision, "
+    "location geography(Point, 4326), "
+    "PRIMARY KEY (primary_station_id, observed_variable, month))")
+
+create_indexes_tmpl = [
+    "CREATE INDEX IF NOT EXISTS {name}_variable_month_idx ON {inventory} (observed_variable, month)",
+    "CREATE INDEX IF NOT EXISTS {name}_location_idx ON {inventory} USING GIST (location)",
+]
+
+# The location is taken from the latest observation in the month
+refresh_tmpl = ("INSERT INTO {inventory} SELECT "
+    "primary_station_id, observed_variable, "
+    "date_trunc('month', date_time AT TIME ZONE 'UTC')::date AS month, "
+    "count(*), min(date_time), max(date_time), "
+    "(array_agg(longitude ORDER BY date_time DESC))[1], "
+    "(array_agg(latitude ORDER BY date_time DESC))[1], "
+    "(array_agg(location ORDER BY date_time DESC))[1] "
+    "FROM {partition} WHERE {where} GROUP BY 1, 2, 3")
+
+
+def get_inventory_table(partition):
+    "Returns the name of the inventory table for the observations `partition`."
+    schema, table = partition.split('.')
+    return f"{schema}.{table.replace('observations_', 'inventory_', 1)}"
+
+
+def list_partitions(conn, data_version, domain=None, years=None):
+    "Returns a sorted list of the observations partitions of `data_version`."
+    schema = DATA_VERSIONS[data_version]
+
+    with conn.cursor() as cursor:
+        cursor.execute("SELECT table_name FROM information_schema.tables WHERE table_schema = %s "
+                       "AND table_name LIKE 'observations\\_%%'", [schema])
+        tables = [_[0] for _ in cursor.fetchall()]
+
+    partitions = []
+
+    for table in tables:
+        match = re.match(PARTITION_REGEX, table)
+        if not match:
+            continue
+
+        year, table_domain, _ = match.groups()
+
+        if (domain and table_domain != domain) or (years and int(year) not in years):
+            continue
+
+        partitions.append(f'{schema}.{table}')
+
+    return sorted(partitions)
+
+
+def _get_modifications(cursor, partition):
+    schema, table = partition.split('.')
+
+    cursor.execute("SELECT n_tup_ins + n_tup_upd + n_tup_del FROM pg_stat_user_tables "
+                   "WHERE schemaname = %s AND relname = %s", [schema, table])
+    row = cursor.fetchone()
+
+    return row[0] if row else None
+
+
+def get_modifications(conn, partition):
+    "Returns the number of rows inserted, updated and deleted in `partition` (or None if unknown)."
+    with conn.cursor() as cursor:
+        return _get_modifications(cursor, partition)
+
+
+def _get_month_bounds(year, month):
+    start = datetime.datetime(year, month, 1, tzinfo=datetime.timezone.utc)
+    end = datetime.datetime(year + month // 12, month % 12 + 1, 1, tzinfo=datetime.timezone.utc)
+    return start, end
+
+
+def refresh_partition(conn, partition, months=None, force=False):
+    """
+    Builds or refreshes the inventory of `partition` (optionally only for `months`)
+    and commits. Returns the number of inventory rows written, or None if the
+    partition was not modified since the last refresh (unless `force` is set).
+    """
+    schema = partition.split('.')[0]
+    inventory = get_inventory_table(partition)
+    year = int(re.match(PARTITION_REGEX, partition.split('.')[1]).group(1))
+
+    with conn.cursor() as cursor:
+        cursor.execute(create_state_tmpl.format(schema=schema))
+        cursor.execute(create_tmpl.format(inventory=inventory))
+
+        for tmpl in create_indexes_tmpl:
+            cursor.execute(tmpl.format(inventory=inventory, name=inventory.split('.')[1]))
+
+        modifications = _get_modifications(cursor, partition)
+
+        cursor.execute(f"SELECT modifications FROM {schema}.{STATE_TABLE} WHERE partition = %s", [partition])
+        state = cursor.fetchone()
+
+        if not force and not months and state and modifications is not None and state[0] == modifications:
+            log.info(f'Inventory is up to date for: {partition}')
+            conn.rollback()
+            return None
+
+        if months:
+            bounds = [_get_month_bounds(year, month) for month in sorted(months)]
+            month_starts = [start.date() for start, _ in bounds]
+
+            where = ' OR '.join(['(date_time >= %s AND date_time < %s)'] * len(bounds))
+            params = [_ for pair in bounds for _ in pair]
+
+            cursor.execute(f"DELETE FROM {inventory} WHERE month = ANY(%s)", [month_starts])
+        else:
+            # Not TRUNCATE, which would block `/inventory` readers until the refresh commits
+            where, params = 'TRUE', []
+            cursor.execute(f"DELETE FROM {inventory}")
+
+        log.info(f'Refreshing inventory: {inventory}')
+        cursor.execute(refresh_tmpl.format(inventory=inventory, partition=partition, where=where), params)
+        n_rows = cursor.rowcount
+
+        cursor.execute(f"ANALYZE {inventory}")
+
+        # Only a full refresh brings the whole inventory up to date with the partition
+        if not months:
+            cursor.execute(f"INSERT INTO {schema}.{STATE_TABLE} (partition, modifications, refreshed) "
+                           "VALUES (%s, %s, now()) ON CONFLICT (partition) DO UPDATE SET "
+                           "modifications = EXCLUDED.modifications, refreshed = EXCLUDED.refreshed",
+                           [partition, modifications])
+
+    conn.commit()
+    return n_rows
@@ -0,0 +1,67 @@
+"""
+limits.py
+=========
+
+Per-request budgets for the number of rows and output bytes of a select.
+
+Limits are set in the `REQUEST_LIMITS` setting. The "default" entry applies to
+all requests and can be overridden per domain and per frequency, e.g.:
+
+    REQUEST_LIMITS = {
+        'default': {'max_rows': 5000000, 'max_bytes': 1024 ** 3},
+        'land': {
+            'sub_daily': {'max_rows': 2000000}
+        }
+    }
+
+A limit of None means unlimited.
+"""
+
+from collections import namedtuple
+
+from django.conf import settings
+
+
+DEFAULT_REQUEST_LIMITS = {
+    'default': {'max_rows': 5000000, 'max_bytes': 1024 ** 3}
+}
+
+Limits = namedtuple('Limits', ['max_rows', 'max_bytes'])
+
+NARROWING_ADVICE = ('Please narrow your request, for example by selecting fewer variables, '
+                    'a shorter time period, a "bbox" or a list of stations.')
+
+
+class RequestTooLarge(Exception):
+    "Raised when a request exceeds its row or byte budget."
+    pass
+
+
+def get_limits(domain, frequency):
+    "Returns the `Limits` for a request of `domain` and `frequency`."
+    all_limits = getattr(settings, 'REQUEST_LIMITS', DEFAULT_REQUEST_LIMITS)
+
+    limits = dict(DEFAULT_REQUEST_LIMITS['default'])
+    limits.update(all_limits.get('default', {}))
+    limits.update(all_limits.get(domain, {}).get(frequency, {}))
+
+    return Limits(limits.get('max_rows'), limits.get('max_bytes'))
+
+
+def _format_bytes(n):
+    for unit in ('bytes', 'KB', 'MB', 'GB'):
+        if n < 1024:
+            break
+        n /= 1024.
+
+    return f'{n:.0f} {unit}'
+
+
+def rows_exceeded(max_rows, domain, frequency):
+    return RequestTooLarge(f'The request returns more than the limit of {max_rows} rows for '
+                           f'{domain}/{frequency} data. {NARROWING_ADVICE}')
+
+
+def bytes_exceeded(max_bytes, domain, frequency):
+    return RequestTooLarge(f'The request returns more than the limit of {_format_bytes(max_bytes)} '
+                           f'for {domain}/{frequency} data. {NARROWING_ADVICE}')
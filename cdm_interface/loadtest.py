@@ -0,0 +1,394 @@
+"""
+loadtest.py
+===========
+
+Load-test harness: replays a mix of `/select` and `/constraints` requests against a
+(local) server and reports on latency, throughput, errors and the memory of the
+server's worker processes. Used by the "loadtest" management command, that can
+also compare a run with a baseline run and flag regressions.
+
+A request mix is a list of `(kind, path)` tuples. It is either:
+
+ - synthetic (`synthetic_mix`): drawn at random (with a seed, so a mix can be
+   repeated) with a spread of domains, frequencies, variables, time selections
+   (time components and ranges) and spatial selections (none, bboxes of various
+   sizes, point and radius) like that of the production traffic; or
+ - recorded (`recorded_mix`): read from the slow-query log (the canonical query of
+   each entry) or from a text file of request paths (e.g. taken from an access log).
+
+Requests are sent by a pool of `concurrency` threads, each reading the whole
+response. The resident set size (RSS) of the worker processes is sampled from
+`/proc` while the requests run.
+
+The synthetic mix uses the years, domains and frequencies of the partitions written
+by the "build_synthetic_db" management command, so that it can be run against a
+local server and a local, synthetic, PostgreSQL database.
+"""
+
+import datetime
+import json
+import os
+import random
+import re
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from cdm_interface.data_versions import DEFAULT_VERSION
+
+
+# Years of the synthetic partitions (see the "build_synthetic_db" command)
+DEFAULT_YEARS = (2010, 2011)
+
+# Spread of the request mix: (value, weight)
+KINDS = (('select', 0.85), ('constraints', 0.15))
+DOMAINS = (('land', 0.75), ('marine', 0.25))
+FREQUENCIES = (('monthly', 0.45), ('daily', 0.35), ('sub_daily', 0.2))
+
+VARIABLES = {
+    'land': ('air_temperature', 'accumulated_precipitation', 'air_pressure', 'dew_point_temperature',
+             'snow_depth', 'wind_speed', 'wind_from_direction'),
+    'marine': ('air_temperature', 'water_temperature', 'air_pressure_at_sea_level',
+               'dew_point_temperature', 'wind_speed', 'wind_from_direction')
+}
+
+# Spatial selections: (kind, weight)
+SPATIAL_SELECTIONS = (('global', 0.45), ('bbox', 0.4), ('point', 0.15))
+
+PERCENTILES = (50, 95, 99)
+
+DEFAULT_TIMEOUT = 300
+RSS_SAMPLE_INTERVAL = 0.5
+
+# Relative change beyond which a metric is flagged as a regression
+DEFAULT_THRESHOLD = 0.1
+
+# Absolute increase in the error rate that is flagged as a regression
+ERROR_RATE_THRESHOLD = 0.01
+
+
+def _choose(rand, choices):
+    values, weights = zip(*choices)
+    return rand.choices(values, weights=weights)[0]
+
+
+def _get_time_selection(rand, frequency, year):
+    "Returns the time parameters of a selection: time components or a time range."
+    month = rand.randint(1, 12)
+
+    if rand.random() < 0.6:
+        params = [('year', str(year)), ('month', f'{month:02d}')]
+
+        if frequency == 'sub_daily' and rand.random() < 0.5:
+            params.append(('day', f'{rand.randint(1, 28):02d}'))
+
+        return params
+
+    # Range lengths (in days) by frequency
+    days = {'monthly': (30, 330), 'daily': (1, 60), 'sub_daily': (1, 7)}[frequency]
+    start = datetime.datetime(year, month, rand.randint(1, 28))
+    end = min(start + datetime.timedelta(days=rand.randint(*days)), datetime.datetime(year, 12, 31, 23, 59, 59))
+
+    return [('time', f'{start.isoformat()}/{end.isoformat()}')]
+
+
+def _get_spatial_selection(rand):
+    kind = _choose(rand, SPATIAL_SELECTIONS)
+
+    if kind == 'bbox':
+        # Edge lengths from 1 to 90 degrees, with smaller boxes more common
+        width, height = [min(round(10 ** rand.uniform(0, 1.95), 1), 90.) for _ in range(2)]
+        west, south = rand.uniform(-180, 180 - width), rand.uniform(-90, 90 - height)
+        return [('bbox', f'{west:.1f},{south:.1f},{west + width:.1f},{south + height:.1f}')]
+    elif kind == 'point':
+        return [('point', f'{rand.uniform(-180, 180):.2f},{rand.uniform(-80, 80):.2f}'),
+                ('radius', str(rand.choice((10, 50, 100, 500))))]
+
+    return []
+
+
+def synthetic_mix(count, seed=0, years=DEFAULT_YEARS, data_version=DEFAULT_VERSION):
+    "Returns a list of `count` (kind, path) tuples of synthetic requests."
+    rand = random.Random(seed)
+    mix = []
+
+    for _ in range(count):
+        kind = _choose(rand, KINDS)
+        domain = _choose(rand, DOMAINS)
+
+        if kind == 'constraints':
+            mix.append((kind, f'/{data_version}/constraints/{domain}'))
+            continue
+
+        frequency = _choose(rand, FREQUENCIES)
+        variables = rand.sample(VARIABLES[domain], rand.choice((1, 1, 2, 3)))
+
+        params = [('domain', domain), ('frequency', frequency), ('variable', ','.join(sorted(variables)))]
+        params += _get_time_selection(rand, frequency, rand.choice(years))
+        params += _get_spatial_selection(rand)
+
+        if rand.random() < 0.3:
+            params.append(('intended_use', 'non_commercial'))
+
+        if rand.random() < 0.2:
+            params.append(('data_quality', 'passed'))
+
+        if rand.random() < 0.3:
+            params.append(('column_selection', 'basic_metadata'))
+
+        mix.append((kind, f'/{data_version}/select/?' + urllib.parse.urlencode(params)))
+
+    return mix
+
+
+def _get_kind(path):
+    return 'constraints' if '/constraints/' in path else 'select'
+
+
+def recorded_mix(path, data_version=DEFAULT_VERSION):
+    """
+    Returns a list of (kind, path) tuples read from `path`: either the slow-query log
+    (JSON lines with a "canonical_query") or a text file of request paths.
+    """
+    mix = []
+
+    with open(path) as reader:
+        for line in reader:
+            line = line.strip()
+
+            if not line or line.startswith('#'):
+                continue
+
+            if line.startswith('{'):
+                entry = json.loads(line)
+                mix.append(('select', f'/{data_version}/select/?' + entry['canonical_query']))
+            else:
+                mix.append((_get_kind(line), line if line.startswith('/') else '/' + line))
+
+    return mix
+
+
+def _get_rss(pid):
+    "Returns the resident set size (in bytes) of process `pid`, or None if it has gone."
+    try:
+        with open(f'/proc/{pid}/status') as reader:
+            for line in reader:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+
+    return None
+
+
+def find_pids(pattern):
+    "Returns the IDs of the processes (other than this one) whose command line matches `pattern`."
+    pids = []
+
+    for name in os.listdir('/proc'):
+        if not name.isdigit() or int(name) == os.getpid():
+            continue
+
+        try:
+            with open(f'/proc/{name}/cmdline', 'rb') as reader:
+                cmdline = reader.read().replace(b'\0', b' ').decode('utf-8', 'replace')
+        except OSError:
+            continue
+
+        if re.search(pattern, cmdline):
+            pids.append(int(name))
+
+    return sorted(pids)
+
+
+class RSSSampler(threading.Thread):
+    "Samples the RSS of the processes `pids` every `interval` seconds until stopped."
+
+    def __init__(self, pids, interval=RSS_SAMPLE_INTERVAL):
+        super().__init__(daemon=True)
+        self.pids = list(pids)
+        self.interval = interval
+        self.totals = []
+        self.peaks = {}
+        self._stopped = threading.Event()
+
+    def sample(self):
+        total = 0
+
+        for pid in self.pids:
+            rss = _get_rss(pid)
+
+            if rss is not None:
+                self.peaks[pid] = max(self.peaks.get(pid, 0), rss)
+                total += rss
+
+        self.totals.append(total)
+
+    def run(self):
+        while not self._stopped.is_set():
+            self.sample()
+            self._stopped.wait(self.interval)
+
+    def stop(self):
+        self._stopped.set()
+        self.join()
+        self.sample()
+
+    def get_summary(self):
+        "Returns a dictionary of the RSS statistics (in MB), or None if no processes were sampled."
+        if not self.peaks:
+            return None
+
+        mb = 1024 ** 2
+        return {
+            'workers': len(self.peaks),
+            'peak_worker_mb': round(max(self.peaks.values()) / mb, 1),
+            'peak_total_mb': round(max(self.totals) / mb, 1),
+            'mean_total_mb': round(sum(self.totals) / len(self.totals) / mb, 1)
+        }
+
+
+def send_request(base_url, kind, path, timeout=DEFAULT_TIMEOUT):
+    "Sends a request and reads the whole response. Returns a dictionary describing the result."
+    result = {'kind': kind, 'path': path, 'status': None, 'bytes': 0, 'error': None}
+    start = time.perf_counter()
+
+    try:
+        with urllib.request.urlopen(base_url.rstrip('/') + path, timeout=timeout) as resp:
+            result['status'] = resp.status
+
+            for chunk in iter(lambda: resp.read(65536), b''):
+                result['bytes'] += len(chunk)
+
+    except urllib.error.HTTPError as err:
+        result['status'] = err.code
+        result['bytes'] = len(err.read())
+    except Exception as err:
+        result['error'] = f'{type(err).__name__}: {err}'
+
+    result['latency'] = time.perf_counter() - start
+    return result
+
+
+def run(base_url, mix, concurrency=1, timeout=DEFAULT_TIMEOUT, pids=None):
+    """
+    Sends the requests in `mix` to `base_url` from `concurrency` threads, sampling the
+    RSS of the processes `pids`. Returns the report of the run (see `summarise`).
+    """
+    sampler = RSSSampler(pids or [])
+    sampler.start()
+
+    start = time.perf_counter()
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(lambda _: send_request(base_url, _[0], _[1], timeout=timeout), mix))
+
+    elapsed = time.perf_counter() - start
+    sampler.stop()
+
+    report = summarise(results, elapsed, rss=sampler.get_summary())
+    report['url'] = base_url
+    report['concurrency'] = concurrency
+    return report
+
+
+def _get_latencies(results):
+    latencies = [_['latency'] for _ in results]
+
+    if not latencies:
+        return {}
+
+    values = np.percentile(latencies, PERCENTILES)
+    resp = dict([(f'p{pct}', round(float(value), 4)) for pct, value in zip(PERCENTILES, values)])
+    resp['mean'] = round(sum(latencies) / len(latencies), 4)
+    return resp
+
+
+def _is_error(result):
+    return result['error'] is not None or result['status'] >= 500
+
+
+def summarise(results, elapsed, rss=None):
+    "Returns the report of a run: a JSON-serialisable dictionary of statistics of the `results`."
+    count = len(results)
+    errors = [_ for _ in results if _is_error(_)]
+    client_errors = [_ for _ in results if not _is_error(_) and _['status'] >= 400]
+
+    report = {
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'requests': count,
+        'elapsed': round(elapsed, 3),
+        'throughput': round(count / elapsed, 3) if elapsed else 0.,
+        'bytes_per_second': round(sum([_['bytes'] for _ in results]) / elapsed) if elapsed else 0,
+        'error_rate': round(len(errors) / count, 4) if count else 0.,
+        'client_error_rate': round(len(client_errors) / count, 4) if count else 0.,
+        'latency': _get_latencies(results),
+        'kinds': {},
+        'statuses': {},
+        'rss': rss,
+        'sample_errors': sorted(set([_['error'] or f'{_["status"]} {_["path"]}' for _ in errors]))[:10]
+    }
+
+    for kind in sorted(set([_['kind'] for _ in results])):
+        selected = [_ for _ in results if _['kind'] == kind]
+        report['kinds'][kind] = {
+            'requests': len(selected),
+            'error_rate': round(len([_ for _ in selected if _is_error(_)]) / len(selected), 4),
+            'latency': _get_latencies(selected)
+        }
+
+    for result in results:
+        status = str(result['status'] or 'failed')
+        report['statuses'][status] = report['statuses'].get(status, 0) + 1
+
+    return report
+
+
+def _get_metrics(report):
+    "Returns a dictionary of: name: (value, higher_is_worse) of the compared metrics of a report."
+    metrics = {'throughput': (report['throughput'], False)}
+
+    for name, value in report['latency'].items():
+        metrics[f'latency.{name}'] = (value, True)
+
+    for kind, stats in report['kinds'].items():
+        for name, value in stats['latency'].items():
+            metrics[f'{kind}.latency.{name}'] = (value, True)
+
+    if report.get('rss'):
+        metrics['rss.peak_worker_mb'] = (report['rss']['peak_worker_mb'], True)
+        metrics['rss.peak_total_mb'] = (report['rss']['peak_total_mb'], True)
+
+    return metrics
+
+
+def compare(baseline, current, threshold=DEFAULT_THRESHOLD):
+    """
+    Compares the report `current` with `baseline`. Returns a list of the regressions:
+    (metric, baseline value, current value) for each metric that is worse by more than
+    `threshold` (relative), or error rate that is higher by more than ERROR_RATE_THRESHOLD.
+    """
+    regressions = []
+    base_metrics, metrics = _get_metrics(baseline), _get_metrics(current)
+
+    for name, (base_value, higher_is_worse) in sorted(base_metrics.items()):
+        if name not in metrics or not base_value:
+            continue
+
+        value = metrics[name][0]
+        change = (value - base_value) / base_value
+
+        if (change if higher_is_worse else -change) > threshold:
+            regressions.append((name, base_value, value))
+
+    for name in ('error_rate', 'client_error_rate'):
+        if current[name] - baseline[name] > ERROR_RATE_THRESHOLD:
+            regressions.append((name, baseline[name], current[name]))
+
+    return regressions
@@ -0,0 +1,137 @@
+""" Management command to build the store of pre-built bulk extracts (see `extracts.py`). """
+
+import re
+import time
+import uuid
+
+from django.core.management.base import BaseCommand, CommandError
+from django.http import QueryDict
+
+from cdm_interface import extracts
+from cdm_interface import inventory
+from cdm_interface import limits
+from cdm_interface.db import pooled_connection
+from cdm_interface.views import QueryManager
+from cdm_interface.wfs_mappings import wfs_mappings
+from cdm_interface.file_namer import OutputFileNamer
+from cdm_interface.streaming import iter_csv, iter_zip
+from cdm_interface.data_versions import DATA_VERSIONS, DEFAULT_VERSION
+
+
+# Frequencies by report type (as in the partition names)
+FREQUENCIES = dict([(v, k) for k, v in wfs_mappings['frequency']['fields'].items()])
+
+ALL_VARIABLES = sorted(wfs_mappings['variable']['fields'])
+
+
+class ExtractQueryManager(QueryManager):
+    "As `QueryManager`, without the request budget: extracts are always built whole."
+
+    def _plan_query(self, kwargs):
+        sql_manager, _, _, _ = super()._plan_query(kwargs)
+        return sql_manager, limits.Limits(None, None), None, [sql_manager._generate_queries(kwargs)]
+
+
+def get_selection(domain, frequency, year, months, variables, intended_use, data_quality):
+    "Returns the request parameters (as sent to `/select`) of an extract."
+    params = QueryDict(mutable=True)
+
+    params['domain'] = domain
+    params['frequency'] = frequency
+    params['year'] = str(year)
+    params.setlist('month', [f'{_:02d}' for _ in months])
+    params.setlist('variable', variables)
+    params.setlist('intended_use', intended_use)
+    params.setlist('data_quality', data_quality)
+
+    if frequency in ('daily', 'sub_daily'):
+        params.setlist('day', [f'{_:02d}' for _ in range(1, 32)])
+
+    if frequency == 'sub_daily':
+        params.setlist('hour', [f'{_:02d}' for _ in range(24)])
+
+    return params
+
+
+class Command(BaseCommand):
+
+    help = ('Builds pre-generated extracts (all variables, global) of whole months and/or whole '
+            'years of each observations partition into EXTRACT_STORE_DIR. Extracts of partitions '
+            'that have not been modified since they were built are skipped.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--data-version', default=DEFAULT_VERSION, choices=list(DATA_VERSIONS),
+                            help='Data version of the partitions.')
+        parser.add_argument('--domain', choices=['land', 'marine'], default=None,
+                            help='Only build extracts of partitions of this domain.')
+        parser.add_argument('--frequency', choices=list(FREQUENCIES.values()), default=None,
+                            help='Only build extracts of partitions of this frequency.')
+        parser.add_argument('--year', type=int, nargs='+', default=None,
+                            help='Only build extracts of partitions of these years.')
+        parser.add_argument('--month', type=int, nargs='+', default=list(range(1, 13)), choices=range(1, 13),
+                            help='Months to build (whole-month) extracts for.')
+        parser.add_argument('--scope', choices=['month', 'year', 'both'], default='both',
+                            help='Build extracts of whole months, whole years or both.')
+        parser.add_argument('--variable', nargs='+', default=ALL_VARIABLES,
+                            help='Variables in each extract (default: all).')
+        parser.add_argument('--intended-use', nargs='+', default=['non_commercial', 'open'],
+                            help='Value(s) of "intended_use" in each extract.')
+        parser.add_argument('--data-quality', nargs='+', default=['passed'],
+                            help='Value(s) of "data_quality" in each extract.')
+        parser.add_argument('--force', action='store_true',
+                            help='Rebuild extracts even if their partition has not been modified.')
+
+    def handle(self, *args, **options):
+        store = extracts.get_store()
+
+        if not store:
+            raise CommandError('The EXTRACT_STORE_DIR setting must be set.')
+
+        data_version = options['data_version']
+
+        month_sets = []
+        if options['scope'] in ('month', 'both'):
+            month_sets.extend([[_] for _ in options['month']])
+        if options['scope'] in ('year', 'both'):
+            month_sets.append(list(range(1, 13)))
+
+        with pooled_connection() as conn:
+            partitions = inventory.list_partitions(conn, data_version, domain=options['domain'],
+                                                   years=options['year'])
+            modifications = dict([(_, inventory.get_modifications(conn, _)) for _ in partitions])
+
+        for partition in partitions:
+            year, domain, report_type = re.match(inventory.PARTITION_REGEX, partition.split('.')[1]).groups()
+            frequency = FREQUENCIES.get(report_type)
+
+            if not frequency or (options['frequency'] and frequency != options['frequency']):
+                continue
+
+            for months in month_sets:
+                params = get_selection(domain, frequency, year, months, options['variable'],
+                                       options['intended_use'], options['data_quality'])
+                label = f'{partition} (months: {",".join([str(_) for _ in months])})'
+
+                entry = store.get_entry(data_version, params)
+                if (entry and not options['force'] and modifications[partition] is not None
+                        and entry.get('modifications') == modifications[partition]):
+                    self.stdout.write(f'{label}: up to date')
+                    continue
+
+                start = time.time()
+                self._build(store, data_version, params, partition, modifications[partition])
+                self.stdout.write(f'{label}: built in {time.time() - start:.1f}s')
+
+    def _build(self, store, data_version, params, partition, modifications):
+        df, data_policy_text = ExtractQueryManager(data_version, uuid.uuid4()).run_query(params)
+        file_namer = OutputFileNamer(data_version, params)
+
+        files = [(file_namer.get_csv_name(), iter_csv(df)),
+                 (file_namer.get_policy_name(), [data_policy_text.encode('utf-8')])]
+
+        def write(writer):
+            for chunk in iter_zip(files):
+                writer.write(chunk)
+
+        store.add(data_version, params, write, partition=partition, modifications=modifications,
+                  rows=len(df))
@@ -0,0 +1,46 @@
+""" Management command to build and refresh the station/variable inventory tables. """
+
+import time
+
+from django.core.management.base import BaseCommand
+
+from cdm_interface import inventory
+from cdm_interface.db import pooled_connection
+from cdm_interface.data_versions import DATA_VERSIONS, DEFAULT_VERSION
+
+
+class Command(BaseCommand):
+
+    help = ('Builds (or incrementally refreshes) the station x variable x month inventory '
+            'table of each observations partition.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--data-version', default=DEFAULT_VERSION, choices=list(DATA_VERSIONS),
+                            help='Data version of the partitions.')
+        parser.add_argument('--domain', choices=['land', 'marine'], default=None,
+                            help='Only refresh partitions of this domain.')
+        parser.add_argument('--year', type=int, nargs='+', default=None,
+                            help='Only refresh partitions of these years.')
+        parser.add_argument('--month', type=int, nargs='+', default=None, choices=range(1, 13),
+                            help='Only refresh these months (of each partition).')
+        parser.add_argument('--force', action='store_true',
+                            help='Refresh partitions even if they have not been modified.')
+
+    def handle(self, *args, **options):
+        with pooled_connection() as conn:
+            partitions = inventory.list_partitions(conn, options['data_version'],
+                                                   domain=options['domain'], years=options['year'])
+
+            if not partitions:
+                self.stdout.write('No matching partitions found.')
+                return
+
+            for partition in partitions:
+                start = time.time()
+                n_rows = inventory.refresh_partition(conn, partition, months=options['month'],
+                                                     force=options['force'])
+
+                if n_rows is None:
+                    self.stdout.write(f'{partition}: up to date')
+                else:
+                    self.stdout.write(f'{partition}: {n_rows} inventory rows in {time.time() - start:.1f}s')
@@ -0,0 +1,158 @@
+""" Management command to fill a local PostgreSQL database with synthetic partitions, for load tests. """
+
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from cdm_interface import loadtest
+from cdm_interface.db import pooled_connection
+from cdm_interface.sql_mngr import SQLManager
+from cdm_interface.views import mapper_data
+from cdm_interface.wfs_mappings import wfs_mappings
+from cdm_interface.data_versions import DATA_VERSIONS, DEFAULT_VERSION
+
+
+REPORT_TYPES = wfs_mappings['frequency']['fields']
+VARIABLE_CODES = wfs_mappings['variable']['fields']
+
+# Time step of the observations of each frequency
+INTERVALS = {'monthly': '1 month', 'daily': '1 day'}
+
+# Codes of the observation duration of each frequency
+DURATIONS = {'monthly': 3, 'daily': 2, 'sub_daily': 0}
+
+# Code tables: code_table: [(code, description)]
+CODE_VALUES = {
+    'report_type': [(2, 'monthly'), (3, 'daily'), (0, 'sub_daily')],
+    'meaning_of_time_stamp': [(1, 'beginning')],
+    'observed_variable': [(int(code), name.replace('_', ' ')) for name, code in VARIABLE_CODES.items()],
+    'units': [(1, 'synthetic')],
+    'observation_value_significance': [(2, 'mean')],
+    'duration': [(0, 'instantaneous'), (2, 'daily'), (3, 'monthly')],
+    'platform_type': [(0, 'land station'), (2, 'ship')],
+    'station_type': [(1, 'synthetic station')],
+    'quality_flag': [(0, 'passed'), (1, 'failed')],
+    'data_policy_licence': [(0, 'open'), (1, 'non_commercial')],
+}
+
+create_partition_tmpl = """CREATE TABLE {partition} (
+    observation_id text, data_policy_licence integer, date_time timestamptz, date_time_meaning integer,
+    observation_duration integer, longitude numeric, latitude numeric, report_type integer,
+    height_above_surface numeric, observed_variable integer, units integer, observation_value numeric,
+    value_significance integer, platform_type integer, station_type integer, primary_station_id text,
+    station_name text, quality_flag integer, source_id text, location geography(Point, 4326))"""
+
+# Stations are spread over the globe (a golden-angle spiral), each reporting every variable at every step
+insert_partition_tmpl = """INSERT INTO {partition}
+    SELECT %(domain)s || '-' || s || '-' || v || '-' || to_char(t AT TIME ZONE 'UTC', 'YYYYMMDDHH24'),
+        s %% 2, t, 1, %(duration)s, round(lon::numeric, 3), round(lat::numeric, 3), %(report_type)s, 2, v, 1,
+        round((random() * 40 - 10)::numeric, 2), 2, %(platform_type)s, 1,
+        upper(%(domain)s) || lpad(s::text, 6, '0'), 'Synthetic station ' || s, (random() < 0.1)::int,
+        'synthetic', ST_SetSRID(ST_MakePoint(lon, lat), 4326)::geography
+    FROM generate_series(1, %(stations)s) AS s
+    CROSS JOIN LATERAL (SELECT ((s * 137.508) %% 360)::float8 - 180 AS lon,
+                               degrees(asin(1 - 2 * (s - 0.5) / %(stations)s))::float8 AS lat) AS position
+    CROSS JOIN unnest(%(variables)s::integer[]) AS v
+    CROSS JOIN generate_series(%(start)s::timestamptz, %(end)s::timestamptz - interval '1 second',
+                               %(interval)s::interval) AS t"""
+
+index_tmpls = [
+    "CREATE INDEX ON {partition} (observed_variable, date_time)",
+    "CREATE INDEX ON {partition} (date_time, observation_id)",
+    "CREATE INDEX ON {partition} (primary_station_id)",
+    "CREATE INDEX ON {partition} USING GIST (location)",
+]
+
+
+class Command(BaseCommand):
+
+    help = ('Creates observations partitions (and code tables) filled with synthetic data in the '
+            'database of LOCAL_CONN_STR, for running the "loadtest" command against a local server. '
+            'Run "build_inventory" afterwards to build their inventory tables.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--data-version', default=DEFAULT_VERSION, choices=list(DATA_VERSIONS),
+                            help='Data version (schema) of the partitions.')
+        parser.add_argument('--years', type=int, nargs='+', default=list(loadtest.DEFAULT_YEARS),
+                            help='Years of the partitions.')
+        parser.add_argument('--stations', type=int, default=200,
+                            help='Number of stations in each partition.')
+        parser.add_argument('--sub-daily-hours', type=int, default=6,
+                            help='Hours between the observations of the sub-daily partitions.')
+        parser.add_argument('--replace', action='store_true',
+                            help='Drop and rebuild partitions that already exist.')
+
+    def handle(self, *args, **options):
+        schema = DATA_VERSIONS[options['data_version']]
+        intervals = dict(INTERVALS, sub_daily=f'{options["sub_daily_hours"]} hours')
+
+        with pooled_connection() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute("CREATE EXTENSION IF NOT EXISTS postgis")
+                cursor.execute(f"CREATE SCHEMA IF NOT EXISTS {schema}")
+                self._create_code_tables(cursor)
+
+            conn.commit()
+
+            for year in options['years']:
+                for domain in loadtest.VARIABLES:
+                    for frequency, report_type in REPORT_TYPES.items():
+                        start = time.time()
+                        partition = SQLManager.partition_tmpl.format(SCHEMA=schema, year=year, domain=domain,
+                                                                     report_type=report_type)
+
+                        with conn.cursor() as cursor:
+                            n_rows = self._build_partition(cursor, partition, domain, frequency, year,
+                                                           intervals[frequency], options)
+
+                        conn.commit()
+
+                        if n_rows is None:
+                            self.stdout.write(f'{partition}: exists (use --replace to rebuild)')
+                        else:
+                            self.stdout.write(f'{partition}: {n_rows} rows in {time.time() - start:.1f}s')
+
+    def _create_code_tables(self, cursor):
+        prefix = settings.FULL_CDM_SCHEMA
+
+        if prefix.endswith('.'):
+            cursor.execute(f"CREATE SCHEMA IF NOT EXISTS {prefix[:-1]}")
+
+        for column, (code_table, index_field, desc_field) in mapper_data.items():
+            if code_table not in CODE_VALUES:
+                raise CommandError(f'No synthetic values for code table: {code_table}')
+
+            cursor.execute(f"CREATE TABLE IF NOT EXISTS {prefix}{code_table} "
+                           f"({index_field} integer PRIMARY KEY, {desc_field} text)")
+            cursor.executemany(f"INSERT INTO {prefix}{code_table} VALUES (%s, %s) ON CONFLICT DO NOTHING",
+                               CODE_VALUES[code_table])
+
+    def _build_partition(self, cursor, partition, domain, frequency, year, interval, options):
+        "Creates and fills `partition`. Returns the number of rows, or None if it exists already."
+        cursor.execute("SELECT to_regclass(%s)", [partition])
+
+        if cursor.fetchone()[0]:
+            if not options['replace']:
+                return None
+
+            cursor.execute(f"DROP TABLE {partition}")
+
+        cursor.execute(create_partition_tmpl.format(partition=partition))
+
+        report_type = int(REPORT_TYPES[frequency])
+        params = {
+            'domain': domain, 'report_type': report_type, 'duration': DURATIONS[frequency],
+            'platform_type': 0 if domain == 'land' else 2, 'stations': options['stations'],
+            'variables': [int(VARIABLE_CODES[_]) for _ in loadtest.VARIABLES[domain]],
+            'start': f'{year}-01-01T00:00:00Z', 'end': f'{year + 1}-01-01T00:00:00Z', 'interval': interval
+        }
+
+        cursor.execute(insert_partition_tmpl.format(partition=partition), params)
+        n_rows = cursor.rowcount
+
+        for tmpl in index_tmpls:
+            cursor.execute(tmpl.format(partition=partition))
+
+        cursor.execute(f"ANALYZE {partition}")
+        return n_rows
@@ -0,0 +1,118 @@
+""" Management command to run a load test against a server (see `loadtest.py`). """
+
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from cdm_interface import loadtest
+from cdm_interface.data_versions import DEFAULT_VERSION
+
+
+class Command(BaseCommand):
+
+    help = ('Replays a synthetic or recorded mix of /select and /constraints requests against a '
+            'server and reports latency percentiles, throughput, error rates and worker RSS. '
+            'With --baseline, flags regressions against an earlier run.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--url', default='http://localhost:8000',
+                            help='Base URL of the server.')
+        parser.add_argument('--requests', type=int, default=200,
+                            help='Number of requests in a synthetic mix.')
+        parser.add_argument('--concurrency', type=int, default=8,
+                            help='Number of concurrent requests.')
+        parser.add_argument('--seed', type=int, default=0,
+                            help='Seed of the synthetic mix.')
+        parser.add_argument('--years', type=int, nargs='+', default=list(loadtest.DEFAULT_YEARS),
+                            help='Years selected in the synthetic mix.')
+        parser.add_argument('--data-version', default=DEFAULT_VERSION,
+                            help='Data version of the requests.')
+        parser.add_argument('--replay', default=None,
+                            help='Replay the requests in a slow-query log or file of request paths, '
+                                 'instead of a synthetic mix.')
+        parser.add_argument('--timeout', type=float, default=loadtest.DEFAULT_TIMEOUT,
+                            help='Timeout (seconds) of each request.')
+        parser.add_argument('--pid', type=int, action='append', default=[],
+                            help='ID of a worker process to sample the RSS of (can be repeated).')
+        parser.add_argument('--process-match', default=None,
+                            help='Sample the RSS of all processes whose command line matches this regex '
+                                 '(e.g. "gunicorn|runserver").')
+        parser.add_argument('--output', default=None,
+                            help='Write the report (JSON) to this path.')
+        parser.add_argument('--baseline', default=None,
+                            help='Report (JSON) of an earlier run to compare with.')
+        parser.add_argument('--threshold', type=float, default=loadtest.DEFAULT_THRESHOLD,
+                            help='Relative change of a metric that is flagged as a regression.')
+        parser.add_argument('--fail-on-regression', action='store_true',
+                            help='Exit with an error if any regressions are found.')
+
+    def handle(self, *args, **options):
+        if options['replay']:
+            mix = loadtest.recorded_mix(options['replay'], data_version=options['data_version'])
+        else:
+            mix = loadtest.synthetic_mix(options['requests'], seed=options['seed'],
+                                         years=options['years'], data_version=options['data_version'])
+
+        if not mix:
+            raise CommandError('No requests to send.')
+
+        pids = list(options['pid'])
+        if options['process_match']:
+            pids += loadtest.find_pids(options['process_match'])
+
+        if not pids:
+            self.stderr.write('No worker processes given (--pid/--process-match): RSS is not sampled.')
+
+        self.stdout.write(f'Sending {len(mix)} requests to {options["url"]} '
+                          f'with concurrency {options["concurrency"]}...')
+
+        report = loadtest.run(options['url'], mix, concurrency=options['concurrency'],
+                              timeout=options['timeout'], pids=pids)
+        self._write_report(report)
+
+        if options['output']:
+            with open(options['output'], 'w') as writer:
+                json.dump(report, writer, indent=2)
+
+            self.stdout.write(f'Wrote report to: {options["output"]}')
+
+        if options['baseline']:
+            self._compare(options['baseline'], report, options['threshold'], options['fail_on_regression'])
+
+    def _write_report(self, report):
+        self.stdout.write(f'\n# {report["requests"]} requests in {report["elapsed"]:.1f}s\n')
+        self.stdout.write(f'Throughput:  {report["throughput"]:.2f} requests/s, '
+                          f'{report["bytes_per_second"] / 1024 ** 2:.2f} MB/s')
+        self.stdout.write(f'Errors:      {report["error_rate"]:.2%} (server/connection), '
+                          f'{report["client_error_rate"]:.2%} (client)')
+        self.stdout.write(f'Statuses:    {report["statuses"]}')
+
+        for kind, stats in [('all', report)] + sorted(report['kinds'].items()):
+            latency = stats['latency']
+            self.stdout.write(f'Latency ({kind}): ' + '  '.join(
+                [f'{name}={value * 1000:.0f}ms' for name, value in latency.items()]))
+
+        rss = report['rss']
+        if rss:
+            self.stdout.write(f'Worker RSS:  {rss["workers"]} workers, peak {rss["peak_worker_mb"]} MB per worker, '
+                              f'peak {rss["peak_total_mb"]} MB in total (mean {rss["mean_total_mb"]} MB)')
+
+        for error in report['sample_errors']:
+            self.stdout.write(f'    ERROR: {error}')
+
+    def _compare(self, baseline_path, report, threshold, fail_on_regression):
+        with open(baseline_path) as reader:
+            baseline = json.load(reader)
+
+        regressions = loadtest.compare(baseline, report, threshold=threshold)
+        self.stdout.write(f'\n# Comparison with: {baseline_path}\n')
+
+        if not regressions:
+            self.stdout.write('No regressions found.')
+            return
+
+        for name, base_value, value in regressions:
+            self.stdout.write(f'REGRESSION: {name}: {base_value} -> {value}')
+
+        if fail_on_regression:
+            raise CommandError(f'{len(regressions)} regressions found.')
@@ -0,0 +1,58 @@
+""" Management command to profile the import time of a worker at startup. """
+
+import re
+import subprocess
+import sys
+
+from django.core.management.base import BaseCommand
+
+
+# The warm-up is disabled, so only the imports needed to serve the first request are measured
+STARTUP_SCRIPT = ('from django.conf import settings; settings.WARMUP_ON_START = False; '
+                  'import django; django.setup(); '
+                  'from django.urls import get_resolver; get_resolver().url_patterns')
+
+VIEWS_SCRIPT = STARTUP_SCRIPT + '; import cdm_interface.views'
+
+IMPORT_TIME_REGEX = r'^import time:\s+(\d+) \|\s+(\d+) \|(\s*)(\S+)$'
+
+
+class Command(BaseCommand):
+
+    help = ('Reports the import-time breakdown (from "python -X importtime") of starting a '
+            'worker with the current settings, i.e. setting up Django and loading the URLs.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--top', type=int, default=20,
+                            help='Number of slowest top-level imports to list.')
+        parser.add_argument('--with-views', action='store_true',
+                            help='Also import the data views (pandas, psycopg2 etc.).')
+
+    def handle(self, *args, **options):
+        script = VIEWS_SCRIPT if options['with_views'] else STARTUP_SCRIPT
+
+        proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', script],
+                              stderr=subprocess.PIPE, universal_newlines=True)
+
+        if proc.returncode:
+            self.stderr.write(proc.stderr)
+            return
+
+        # Records of: (cumulative microseconds, indent level, module)
+        records = []
+        for line in proc.stderr.splitlines():
+            match = re.match(IMPORT_TIME_REGEX, line)
+            if match:
+                _, cumulative, indent, module = match.groups()
+                records.append((int(cumulative), len(indent), module))
+
+        top_level = [_ for _ in records if _[1] == 1]
+        total = sum([_[0] for _ in top_level])
+
+        self.stdout.write(f'# Total import time: {total / 1e6:.3f}s ({len(records)} modules)\n')
+
+        for cumulative, _, module in sorted(top_level, reverse=True)[:options['top']]:
+            self.stdout.write(f'{cumulative / 1e6:>8.3f}s  {100. * cumulative / total:5.1f}%  {module}')
+
+        heavy = [_ for _ in ('pandas', 'numpy', 'psycopg2') if _ in set([r[2] for r in records])]
+        self.stdout.write(f'\nHeavy dependencies imported: {", ".join(heavy) or "none"}')
@@ -0,0 +1,82 @@
+""" Management command to report on the slow-query log. """
+
+import collections
+
+from django.core.management.base import BaseCommand
+
+from cdm_interface import query_log
+
+
+class Command(BaseCommand):
+
+    help = ('Lists the slowest queries in the slow-query log and the partition/predicate '
+            'shapes that cause sequential scans.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--path', default=None,
+                            help='Path to the slow-query log (default: SLOW_QUERY_LOG_PATH).')
+        parser.add_argument('--top', type=int, default=10,
+                            help='Number of slowest queries to list.')
+        parser.add_argument('--show-sql', action='store_true',
+                            help='Include the SQL and params of each listed query.')
+
+    def handle(self, *args, **options):
+        entries = list(query_log.read_entries(options['path']))
+
+        if not entries:
+            self.stdout.write('No entries in slow-query log.')
+            return
+
+        self._write_worst_offenders(entries, options['top'], options['show_sql'])
+        self._write_seq_scans(entries)
+
+    def _write_worst_offenders(self, entries, top, show_sql):
+        self.stdout.write(f'# Slowest {top} of {len(entries)} recorded queries\n')
+
+        for entry in sorted(entries, key=lambda _: _['duration'], reverse=True)[:top]:
+            seq_scans = query_log.find_seq_scans(entry.get('plan'))
+            flag = ' [SEQ SCAN]' if seq_scans else ''
+
+            self.stdout.write(f'{entry["duration"]:>10.3f}s  {entry["time"]}  rows={entry["rows"]}  '
+                              f'{entry["partition"]}{flag}')
+            self.stdout.write(f'             {entry["canonical_query"]}')
+
+            if show_sql:
+                self.stdout.write(f'             SQL: {entry["sql"]}')
+                self.stdout.write(f'             PARAMS: {entry["params"]}')
+
+        self.stdout.write('')
+
+    def _write_seq_scans(self, entries):
+        # Group by (partition, predicate shape): [count, count with seq scan, total duration]
+        shapes = collections.defaultdict(lambda: [0, 0, 0.])
+        without_plan = 0
+
+        for entry in entries:
+            if not entry.get('plan'):
+                without_plan += 1
+                continue
+
+            stats = shapes[(entry['partition'], entry['shape'])]
+            stats[0] += 1
+            stats[1] += 1 if query_log.find_seq_scans(entry['plan']) else 0
+            stats[2] += entry['duration']
+
+        self.stdout.write('# Partition/predicate shapes causing sequential scans\n')
+
+        found = False
+        for (partition, shape), (count, seq_count, total) in sorted(
+                shapes.items(), key=lambda _: _[1][2], reverse=True):
+
+            if not seq_count:
+                continue
+
+            found = True
+            self.stdout.write(f'{seq_count}/{count} plans with seq scan, {total:.3f}s total: {partition}')
+            self.stdout.write(f'    {shape}')
+
+        if not found:
+            self.stdout.write('No sequential scans found in captured plans.')
+
+        if without_plan:
+            self.stdout.write(f'\n({without_plan} entries have no captured plan.)')
@@ -0,0 +1,80 @@
+"""
+pagination.py
+=============
+
+Keyset pagination of select requests.
+
+A request with `page_size=<n>` returns at most `n` rows, ordered by
+`(date_time, observation_id)`. If there are more rows, the response includes an
+opaque continuation token (in the `X-Next-Page-Token` header) which is sent back
+as `page_token=<token>` with the same selection parameters to get the next page.
+
+The token is a signed encoding of the last `(date_time, observation_id)` returned
+and a hash of the selection, so no state is kept on the server between pages and
+a token cannot be used with a different selection.
+"""
+
+import datetime
+import hashlib
+
+from django.core import signing
+
+from cdm_interface.utils import canonical_query
+
+
+PAGE_PARAMETERS = ('page_size', 'page_token')
+TOKEN_SALT = 'cdm_interface.pagination'
+
+
+def get_page_size(qdict, max_rows=None):
+    "Returns the requested page size, or None if the request is not paginated."
+    page_size = qdict.get('page_size')
+
+    if not page_size:
+        if qdict.get('page_token'):
+            raise Exception('"page_size" must be provided with "page_token".')
+        return None
+
+    try:
+        page_size = int(page_size)
+    except ValueError:
+        raise Exception(f'"page_size" must be an integer, not "{page_size}".')
+
+    if page_size < 1:
+        raise Exception(f'"page_size" must be greater than zero, not "{page_size}".')
+
+    if max_rows is not None and page_size > max_rows:
+        raise Exception(f'"page_size" must be no more than {max_rows}.')
+
+    return page_size
+
+
+def _selection_hash(qdict):
+    selection = canonical_query(qdict, ignore=PAGE_PARAMETERS + ('compress',))
+    return hashlib.sha1(selection.encode('utf-8')).hexdigest()[:16]
+
+
+def encode_token(qdict, date_time, observation_id):
+    "Returns a token for the page after the row: (`date_time`, `observation_id`)."
+    return signing.dumps({'s': _selection_hash(qdict), 'd': date_time.isoformat(), 'o': observation_id},
+                         salt=TOKEN_SALT, compress=True)
+
+
+def decode_token(qdict):
+    """
+    Returns the (date_time, observation_id) to continue after, from the
+    "page_token" in `qdict`, or None if this is the first page.
+    """
+    token = qdict.get('page_token')
+    if not token:
+        return None
+
+    try:
+        payload = signing.loads(token, salt=TOKEN_SALT)
+    except signing.BadSignature:
+        raise Exception('Invalid value for "page_token".')
+
+    if payload['s'] != _selection_hash(qdict):
+        raise Exception('"page_token" does not match the selection parameters of this request.')
+
+    return datetime.datetime.fromisoformat(payload['d']), payload['o']
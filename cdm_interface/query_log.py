@@ -0,0 +1,233 @@
+"""
+query_log.py
+============
+
+Opt-in slow-query log. Queries that take longer than `SLOW_QUERY_THRESHOLD`
+seconds (or a random `SLOW_QUERY_SAMPLE_RATE` fraction of all queries) are
+recorded as JSON lines in `SLOW_QUERY_LOG_PATH`. Each record holds the canonical
+query, the generated SQL (and params) and, depending on `SLOW_QUERY_EXPLAIN`:
+
+  - "replay":       an `EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON)` plan, captured by
+                    replaying the query on a pooled connection in a single background
+                    thread. At most REPLAY_QUEUE_SIZE queries wait to be replayed; others
+                    are recorded without a plan.
+  - "auto_explain": nothing extra - the session loads `auto_explain` so that the
+                    server logs the plan of any query over the threshold (only if
+                    `SLOW_QUERY_THRESHOLD` is set).
+  - None:           no plan.
+
+Use the "slow_queries" management command to report on the log.
+"""
+
+import datetime
+import fcntl
+import json
+import os
+import queue
+import random
+import threading
+
+from django.conf import settings
+
+import logging
+log = logging.getLogger(__name__)
+
+
+DEFAULT_SLOW_QUERY_LOG_PATH = '/var/log/cdm_lens/slow-queries.jsonl'
+EXPLAIN_MODES = ('replay', 'auto_explain', None)
+
+# Maximum number of queries waiting to be replayed
+REPLAY_QUEUE_SIZE = 100
+
+_write_lock = threading.Lock()
+
+_replay_lock = threading.Lock()
+_replay_queue = None
+_replay_pid = None
+
+
+def _get_threshold():
+    return getattr(settings, 'SLOW_QUERY_THRESHOLD', None)
+
+
+def _get_sample_rate():
+    return getattr(settings, 'SLOW_QUERY_SAMPLE_RATE', 0.0)
+
+
+def get_log_path():
+    return getattr(settings, 'SLOW_QUERY_LOG_PATH', DEFAULT_SLOW_QUERY_LOG_PATH)
+
+
+def get_explain_mode():
+    mode = getattr(settings, 'SLOW_QUERY_EXPLAIN', 'replay')
+
+    if mode not in EXPLAIN_MODES:
+        raise ValueError(f'SLOW_QUERY_EXPLAIN must be one of: {EXPLAIN_MODES}')
+
+    return mode
+
+
+def is_enabled():
+    return _get_threshold() is not None or _get_sample_rate() > 0
+
+
+def get_record_reason(duration):
+    "Returns the reason to record a query that took `duration` seconds ('slow'/'sampled'), or None."
+    threshold = _get_threshold()
+
+    if threshold is not None and duration >= threshold:
+        return 'slow'
+
+    sample_rate = _get_sample_rate()
+    if sample_rate and random.random() < sample_rate:
+        return 'sampled'
+
+    return None
+
+
+def configure_auto_explain(conn):
+    """
+    Loads `auto_explain` into the session of `conn` so that the server logs the
+    plans of queries over the threshold. Only applied if that mode is configured.
+    """
+    if get_explain_mode() != 'auto_explain' or getattr(conn, 'auto_explain', False):
+        return
+
+    # Without a threshold (i.e. sampling only), every query would be logged and analysed
+    threshold = _get_threshold()
+    if threshold is None:
+        return
+
+    threshold_ms = int(threshold * 1000)
+
+    with conn.cursor() as cursor:
+        cursor.execute("LOAD 'auto_explain'")
+        cursor.execute(f"SET auto_explain.log_min_duration = {threshold_ms}")
+        cursor.execute("SET auto_explain.log_analyze = on")
+        cursor.execute("SET auto_explain.log_buffers = on")
+        cursor.execute("SET auto_explain.log_format = json")
+
+    conn.commit()
+    conn.auto_explain = True
+
+
+def get_predicate_shape(query):
+    "Returns the SQL of `query` with the partition name replaced, i.e. the predicate shape."
+    return query.sql.replace(query.partition, '<partition>')
+
+
+def record_query(reqid, canonical, query, duration, rows=None, replayable=True):
+    """
+    Records `query` in the slow-query log if it qualifies (see `get_record_reason`).
+    Queries that depend on per-transaction state (e.g. the temporary station table)
+    should set `replayable=False`, as they cannot be replayed on another connection.
+    """
+    if not is_enabled():
+        return
+
+    reason = get_record_reason(duration)
+    if not reason:
+        return
+
+    entry = {
+        'time': datetime.datetime.utcnow().isoformat(),
+        'reqid': str(reqid),
+        'reason': reason,
+        'duration': round(duration, 3),
+        'rows': rows,
+        'canonical_query': canonical,
+        'partition': query.partition,
+        'shape': get_predicate_shape(query),
+        'sql': query.sql,
+        'params': [str(_) for _ in query.params],
+        'explain': get_explain_mode(),
+        'plan': None
+    }
+
+    if entry['explain'] == 'replay' and replayable:
+        _queue_replay(entry, query)
+    else:
+        _write_entry(entry)
+
+
+def _get_replay_queue():
+    "Returns the queue of queries to replay, starting its worker thread (once per process)."
+    global _replay_queue, _replay_pid
+
+    with _replay_lock:
+        # The worker thread does not survive a fork (e.g. of a pre-loaded server worker)
+        if _replay_pid != os.getpid():
+            _replay_queue = queue.Queue(maxsize=REPLAY_QUEUE_SIZE)
+            _replay_pid = os.getpid()
+            threading.Thread(target=_replay_worker, args=(_replay_queue,), daemon=True).start()
+
+        return _replay_queue
+
+
+def _queue_replay(entry, query):
+    try:
+        _get_replay_queue().put_nowait((entry, query))
+    except queue.Full:
+        entry['plan_error'] = 'Replay queue full'
+        _write_entry(entry)
+
+
+def _replay_worker(replay_queue):
+    while True:
+        entry, query = replay_queue.get()
+
+        try:
+            _replay_and_write(entry, query)
+        finally:
+            replay_queue.task_done()
+
+
+def _replay_and_write(entry, query):
+    from cdm_interface.db import pooled_connection
+
+    try:
+        with pooled_connection() as conn, conn.cursor() as cursor:
+            cursor.execute(f'EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) {query.sql}', query.params)
+            entry['plan'] = cursor.fetchone()[0]
+    except Exception as exc:
+        log.warning(f'Could not capture plan for slow query: {exc}')
+        entry['plan_error'] = str(exc)
+
+    _write_entry(entry)
+
+
+def _write_entry(entry):
+    line = json.dumps(entry, default=str) + '\n'
+
+    # Lock the file as well as the thread, as several worker processes share the log
+    with _write_lock, open(get_log_path(), 'a') as writer:
+        fcntl.flock(writer, fcntl.LOCK_EX)
+        try:
+            writer.write(line)
+        finally:
+            fcntl.flock(writer, fcntl.LOCK_UN)
+
+
+def read_entries(path=None):
+    "Yields the entries in the slow-query log."
+    with open(path or get_log_path()) as reader:
+        for line in reader:
+            if line.strip():
+                yield json.loads(line)
+
+
+def find_seq_scans(plan):
+    "Returns a list of the relations that are read with a sequential scan in a JSON plan."
+    found = []
+
+    def _walk(node):
+        if node.get('Node Type') == 'Seq Scan':
+            found.append(node.get('Relation Name', '?'))
+
+        for child in node.get('Plans', []):
+            _walk(child)
+
+    for item in plan or []:
+        _walk(item.get('Plan', {}))
+
+    return found
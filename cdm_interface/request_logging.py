@@ -0,0 +1,140 @@
+"""
+request_logging.py
+==================
+
+Structured (JSON) logging, configured in the LOGGING setting (see settings.py.template):
+
+ - `JSONFormatter`: writes each record as one JSON object, with the ID of the request
+   ("request_id") and any fields passed in `extra`.
+ - `QueueingHandler`: puts records on a queue; a background thread formats them and
+   writes them to a stream or file, so requests do not wait on log formatting and I/O.
+ - `RequestIdFilter`: adds the ID of the current request to each record.
+ - `SamplingFilter`: passes DEBUG records for a sample (LOG_DEBUG_SAMPLE_RATE) of the
+   requests only, so that verbose events (the SQL, parsed parameters...) are logged
+   in full for some requests at a small cost.
+
+The request ID is set by the views (for the current thread or async task) with
+`set_request_id`. Log levels are set per module in the "loggers" of LOGGING.
+"""
+
+import atexit
+import contextvars
+import datetime
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+
+from django.conf import settings
+
+
+DEFAULT_DEBUG_SAMPLE_RATE = 0.01
+
+_request_id = contextvars.ContextVar('cdm_request_id', default=None)
+_sampled = contextvars.ContextVar('cdm_log_sampled', default=False)
+
+
+def _get_sample_rate():
+    return getattr(settings, 'LOG_DEBUG_SAMPLE_RATE', DEFAULT_DEBUG_SAMPLE_RATE)
+
+
+def set_request_id(request_id):
+    "Sets the ID of the current request, and whether its DEBUG records are sampled."
+    _request_id.set(str(request_id))
+    _sampled.set(random.random() < _get_sample_rate())
+
+
+def get_request_id():
+    return _request_id.get()
+
+
+class RequestIdFilter(logging.Filter):
+
+    def filter(self, record):
+        record.request_id = _request_id.get()
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    "Passes all records above DEBUG, and DEBUG records of sampled requests."
+
+    def filter(self, record):
+        if record.levelno > logging.DEBUG:
+            return True
+
+        # Outside a request, each record is sampled
+        if _request_id.get() is None:
+            return random.random() < _get_sample_rate()
+
+        return _sampled.get()
+
+
+# Attributes of every record, i.e. not fields passed in `extra`
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime', 'request_id'}
+
+
+class JSONFormatter(logging.Formatter):
+
+    def format(self, record):
+        entry = {
+            'time': datetime.datetime.fromtimestamp(record.created, datetime.timezone.utc).isoformat(
+                timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'request_id': getattr(record, 'request_id', None),
+            'message': record.getMessage()
+        }
+
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRIBUTES:
+                entry[key] = value
+
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+
+        return json.dumps(entry, default=str)
+
+
+class QueueingHandler(logging.handlers.QueueHandler):
+    """
+    Queues records for a `QueueListener` thread, that writes them to `filename` (if set)
+    or `stream` (default: stderr). The formatter is applied in the listener thread.
+    """
+
+    def __init__(self, filename=None, stream=None):
+        super().__init__(queue.SimpleQueue())
+
+        if filename:
+            self._target = logging.handlers.WatchedFileHandler(filename)
+        else:
+            self._target = logging.StreamHandler(stream or sys.stderr)
+
+        self._listener = None
+        self._start_listener()
+        atexit.register(self._stop_listener)
+
+    def _start_listener(self):
+        self._pid = os.getpid()
+        self._listener = logging.handlers.QueueListener(self.queue, self._target)
+        self._listener.start()
+
+    def _stop_listener(self):
+        if self._listener and self._pid == os.getpid():
+            self._listener.stop()
+
+    def setFormatter(self, fmt):
+        self._target.setFormatter(fmt)
+
+    def prepare(self, record):
+        # The record is formatted by the listener (in this process), so it is queued as is
+        return record
+
+    def emit(self, record):
+        # The listener thread does not survive a fork (e.g. of a pre-loaded server worker)
+        if self._pid != os.getpid():
+            self._start_listener()
+
+        super().emit(record)
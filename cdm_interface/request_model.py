@@ -0,0 +1,153 @@
+"""
+request_model.py
+================
+
+Typed model of a selection request, parsed and validated in a single pass before
+any database or pandas work.
+
+`parse_request` checks every parameter against lookup sets built once from
+`wfs_mappings` (domains, frequencies, variables, intended uses...), parses the
+temporal selection ("time", or "year", "month", "day" and "hour"), the spatial
+and station selections (with the parsers of `SQLManager`) and the flags
+("compress", "count_only"), and returns a `SelectRequest`. Errors are raised as
+Exceptions with a message for the user (a missing parameter as a KeyError).
+
+SQL generation reads the fields of the `SelectRequest` (see `SQLManager._get_request`),
+so a request is not parsed again. The `params` of the `SelectRequest` are the
+request parameters with the list parameters split, de-duplicated, sorted and with
+the time components zero-padded. They are used for file naming and cache keys, so
+that equivalent requests are treated identically.
+"""
+
+import re
+
+from collections import namedtuple
+
+from cdm_interface.wfs_mappings import wfs_mappings
+from cdm_interface.sql_mngr import SQLManager
+from cdm_interface.utils import LIST_PARAMETERS
+
+
+REQUIRED_PARAMETERS = ('domain', 'frequency', 'variable')
+
+DOMAINS = ('marine', 'land')
+FREQUENCIES = ('monthly', 'daily', 'sub_daily')
+
+# Lookup sets of the valid values of the list parameters
+VALID_VALUES = {
+    'variable': frozenset(wfs_mappings['variable']['fields']),
+    'intended_use': frozenset(wfs_mappings['intended_use']['fields']),
+    'data_quality': frozenset(wfs_mappings['data_quality']['fields']),
+}
+
+COLUMN_SELECTIONS = frozenset(wfs_mappings['column_selection']['fields'])
+
+# Time components: (minimum, maximum, number of digits)
+TIME_COMPONENTS = {
+    'year': (1, 9999, 4),
+    'month': (1, 12, 2),
+    'day': (1, 31, 2),
+    'hour': (0, 23, 2),
+}
+
+# Boolean parameters and their defaults
+FLAGS = {'compress': True, 'count_only': False}
+FLAG_VALUES = {'true': True, 'false': False, '1': True, '0': False}
+
+SelectRequest = namedtuple('SelectRequest', [
+    'domain', 'frequency', 'variables', 'intended_use', 'data_quality',
+    'years', 'months', 'days', 'hours', 'time_range',
+    'spatial', 'stations', 'column_selection', 'compress', 'count_only', 'params'
+])
+
+
+def _split(values):
+    return sorted(set([_ for value in values for _ in re.split(r'[,\s]+', value) if _]))
+
+
+def parse_flag(qdict, name):
+    "Returns the value of the boolean parameter `name` (or its default, if not set)."
+    value = qdict.get(name)
+
+    if value is None:
+        return FLAGS[name]
+
+    if value.lower() not in FLAG_VALUES:
+        raise Exception(f'Incorrect value for "{name}": "{value}". Must be "true" or "false".')
+
+    return FLAG_VALUES[value.lower()]
+
+
+def _parse_time_component(name, values):
+    minimum, maximum, digits = TIME_COMPONENTS[name]
+    resp = []
+
+    for value in values:
+        if not value.isdigit() or not minimum <= int(value) <= maximum:
+            raise Exception(f'Invalid value for "{name}": "{value}". Must be a number from {minimum} to {maximum}.')
+
+        resp.append(f'{int(value):0{digits}d}')
+
+    return sorted(set(resp))
+
+
+def parse_request(qdict, data_version=None):
+    "Parses and validates the selection in `qdict` and returns a `SelectRequest`."
+    for param in REQUIRED_PARAMETERS:
+        if param not in qdict:
+            raise KeyError(f'Input parameter "{param}" must be provided.')
+
+    # Check either 'time' or 'year' provided
+    if 'time' not in qdict and ('year' not in qdict or 'month' not in qdict):
+        raise Exception('Either "time" or time compoonents must be provided.')
+
+    if qdict['domain'] not in DOMAINS:
+        raise Exception(f'"domain" must be one of: {DOMAINS}')
+
+    if qdict['frequency'] not in FREQUENCIES:
+        raise Exception(f'Incorrect value for "frequency". Must be one of: {FREQUENCIES}.')
+
+    flags = dict([(name, parse_flag(qdict, name)) for name in FLAGS])
+
+    column_selection = qdict.get('column_selection', None)
+    if column_selection is not None and column_selection not in COLUMN_SELECTIONS:
+        raise Exception(f'Incorrect value for "column_selection". Must be one of: {sorted(COLUMN_SELECTIONS)}.')
+
+    params = qdict.copy()
+    lists = {}
+
+    for name in LIST_PARAMETERS:
+        if name not in qdict or name == 'station':
+            continue
+
+        values = _split(qdict.getlist(name))
+
+        if name in VALID_VALUES:
+            for value in values:
+                if value not in VALID_VALUES[name]:
+                    raise Exception(f'Cannot find value "{value}" in list of valid options for parameter: "{name}".')
+        elif name in TIME_COMPONENTS:
+            values = _parse_time_component(name, values)
+
+        # Other list parameters (the aggregation options) are only normalised here
+
+        params.setlist(name, values)
+        lists[name] = values
+
+    if not lists.get('variable'):
+        raise Exception('At least one "variable" must be provided.')
+
+    sql_manager = SQLManager(data_version)
+    time_range = sql_manager._parse_time_range(qdict['time']) if qdict.get('time') else None
+
+    if not time_range and (not lists.get('year') or not lists.get('month')):
+        raise Exception('Either "time" or time compoonents must be provided.')
+
+    return SelectRequest(
+        domain=qdict['domain'], frequency=qdict['frequency'], variables=lists['variable'],
+        intended_use=lists.get('intended_use', []), data_quality=lists.get('data_quality', []),
+        years=lists.get('year', []), months=lists.get('month', []), days=lists.get('day', []),
+        hours=lists.get('hour', []), time_range=time_range,
+        spatial=sql_manager._parse_spatial(qdict), stations=sql_manager._get_stations(qdict),
+        column_selection=column_selection, params=params, **flags
+    )
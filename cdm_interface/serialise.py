@@ -0,0 +1,327 @@
+"""
+serialise.py
+============
+
+Parallel CSV serialisation and compression of large results.
+
+The result DataFrame is split into chunks of rows, which are formatted as CSV and
+deflated by a pool of worker processes. The pool is started once per server process
+(with the "forkserver" method, so the workers are not forked from a multi-threaded
+process) and reused by all requests. The column data of each chunk is passed to the
+workers in a shared memory block, as the out-of-band buffers of a pickle (protocol 5):
+only the structure of the chunk (and object columns, such as strings) is pickled.
+Each worker returns its compressed piece (ending on a byte boundary, with a "sync
+flush") with the CRC-32 and length of its CSV text.
+
+The pieces are stitched together, in order, into a single deflate stream in a zip
+file that is written as it is produced (with a data descriptor after the data),
+so it can be streamed in the response.
+"""
+
+import atexit
+import collections
+import datetime
+import multiprocessing
+import os
+import pickle
+import struct
+import threading
+import zlib
+
+from multiprocessing import shared_memory
+
+import logging
+log = logging.getLogger(__name__)
+
+
+DEFAULT_CHUNK_ROWS = 200000
+COMPRESSION_LEVEL = 6
+
+# Chunks sent to the workers ahead of the one being streamed, per worker process
+CHUNKS_IN_FLIGHT = 2
+
+ZIP64_LIMIT = 0xFFFFFFFF
+
+# Zip compression method
+DEFLATED = 8
+
+# Worker pool of this process, started on first use
+_pool = None
+_pool_processes = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+
+
+def _serialise_chunk(task):
+    name, header, buffer_ranges, first, compress = task
+    block = shared_memory.SharedMemory(name=name)
+
+    try:
+        buffers = [block.buf[offset:offset + size] for offset, size in buffer_ranges]
+        chunk = pickle.loads(header, buffers=buffers)
+        data = chunk.to_csv(index=False, header=first).encode('utf-8')
+
+        # Release the views of the block before closing it
+        del chunk
+        for buffer in buffers:
+            buffer.release()
+    finally:
+        block.close()
+
+    if not compress:
+        return data
+
+    compressor = zlib.compressobj(COMPRESSION_LEVEL, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH), zlib.crc32(data), len(data)
+
+
+def _gf2_matrix_times(mat, vec):
+    total, i = 0, 0
+
+    while vec:
+        if vec & 1:
+            total ^= mat[i]
+        vec >>= 1
+        i += 1
+
+    return total
+
+
+def _gf2_matrix_square(mat):
+    return [_gf2_matrix_times(mat, mat[n]) for n in range(32)]
+
+
+def crc32_combine(crc1, crc2, len2):
+    "Returns the CRC-32 of two concatenated blocks, from their CRCs (as in zlib's `crc32_combine`)."
+    if len2 == 0:
+        return crc1
+
+    # Operator for one zero bit, then two and four zero bits
+    odd = [0xEDB88320] + [1 << n for n in range(31)]
+    even = _gf2_matrix_square(odd)
+    odd = _gf2_matrix_square(even)
+
+    while True:
+        even = _gf2_matrix_square(odd)
+        if len2 & 1:
+            crc1 = _gf2_matrix_times(even, crc1)
+        len2 >>= 1
+
+        if not len2:
+            break
+
+        odd = _gf2_matrix_square(even)
+        if len2 & 1:
+            crc1 = _gf2_matrix_times(odd, crc1)
+        len2 >>= 1
+
+        if not len2:
+            break
+
+    return crc1 ^ crc2
+
+
+def _get_pool(processes):
+    "Returns the pool of `processes` workers of this process, starting it if needed."
+    global _pool, _pool_processes, _pool_pid
+
+    with _pool_lock:
+        # A pool is not inherited by forked (server worker) processes
+        if _pool is None or _pool_pid != os.getpid() or _pool_processes != processes:
+            if _pool is not None and _pool_pid == os.getpid():
+                _pool.terminate()
+
+            methods = multiprocessing.get_all_start_methods()
+            context = multiprocessing.get_context('forkserver' if 'forkserver' in methods else 'spawn')
+
+            log.info(f'Starting {processes} serialisation worker processes.')
+            _pool = context.Pool(processes)
+            _pool_processes, _pool_pid = processes, os.getpid()
+
+        return _pool
+
+
+def _shutdown_pool():
+    if _pool is not None and _pool_pid == os.getpid():
+        _pool.terminate()
+
+
+atexit.register(_shutdown_pool)
+
+
+def _submit(pool, chunk, first, compress):
+    """
+    Copies the column data of `chunk` to a shared memory block and sends it to `pool`
+    to serialise. Returns a tuple of: (block, async_result).
+    """
+    buffers = []
+    header = pickle.dumps(chunk, protocol=5, buffer_callback=buffers.append)
+    raws = [_.raw() for _ in buffers]
+
+    block = shared_memory.SharedMemory(create=True, size=max(sum([_.nbytes for _ in raws]), 1))
+    buffer_ranges = []
+    offset = 0
+
+    try:
+        for raw in raws:
+            block.buf[offset:offset + raw.nbytes] = raw
+            buffer_ranges.append((offset, raw.nbytes))
+            offset += raw.nbytes
+
+        result = pool.apply_async(_serialise_chunk, [(block.name, header, buffer_ranges, first, compress)])
+    except Exception:
+        _release(block)
+        raise
+
+    return block, result
+
+
+def _release(block):
+    block.close()
+    block.unlink()
+
+
+def _iter_pieces(df, processes, chunk_rows, compress):
+    pool = _get_pool(processes)
+    pending = collections.deque()
+
+    def collect():
+        block, result = pending.popleft()
+
+        try:
+            return result.get()
+        finally:
+            _release(block)
+
+    try:
+        for start in range(0, max(len(df), 1), chunk_rows):
+            # Copied, so the numeric columns are contiguous and passed out-of-band
+            chunk = df.iloc[start:start + chunk_rows].copy()
+            pending.append(_submit(pool, chunk, start == 0, compress))
+
+            # Only a few chunks are in shared memory at a time
+            if len(pending) >= processes * CHUNKS_IN_FLIGHT:
+                yield collect()
+
+        while pending:
+            yield collect()
+    finally:
+        # The response was abandoned (or failed): chunks in progress are discarded
+        for block, _ in pending:
+            _release(block)
+
+
+def iter_csv_parallel(df, processes, chunk_rows=DEFAULT_CHUNK_ROWS):
+    "Yields `df` as CSV (bytes), formatted in chunks by `processes` worker processes."
+    yield from _iter_pieces(df, processes, chunk_rows, compress=False)
+
+
+def _dos_date_time(now):
+    return ((now.year - 1980) << 9 | now.month << 5 | now.day,
+            now.hour << 11 | now.minute << 5 | now.second // 2)
+
+
+class _ZipEntry(object):
+
+    def __init__(self, name, offset, zip64):
+        self.name = name.encode('utf-8')
+        self.offset = offset
+        self.zip64 = zip64
+        self.crc = 0
+        self.compressed_size = 0
+        self.size = 0
+        self.date, self.time = _dos_date_time(datetime.datetime.now())
+
+    @property
+    def version(self):
+        return 45 if self.zip64 else 20
+
+    def local_header(self):
+        # Bit 3: sizes and CRC follow the data; bit 11: UTF-8 file name
+        extra = struct.pack('<HHQQ', 1, 16, 0, 0) if self.zip64 else b''
+        sizes = ZIP64_LIMIT if self.zip64 else 0
+
+        return struct.pack('<IHHHHHIIIHH', 0x04034B50, self.version, 0x0808, DEFLATED,
+                           self.time, self.date, 0, sizes, sizes, len(self.name), len(extra)) + self.name + extra
+
+    def data_descriptor(self):
+        size_format = 'Q' if self.zip64 else 'I'
+        return struct.pack(f'<II{size_format}{size_format}', 0x08074B50, self.crc,
+                           self.compressed_size, self.size)
+
+    def central_header(self):
+        if self.zip64:
+            extra = struct.pack('<HHQQQ', 1, 24, self.size, self.compressed_size, self.offset)
+            size, compressed_size, offset = ZIP64_LIMIT, ZIP64_LIMIT, ZIP64_LIMIT
+        else:
+            extra = b''
+            size, compressed_size, offset = self.size, self.compressed_size, self.offset
+
+        return struct.pack('<IHHHHHHIIIHHHHHII', 0x02014B50, self.version, self.version, 0x0808,
+                           DEFLATED, self.time, self.date, self.crc, compressed_size, size,
+                           len(self.name), len(extra), 0, 0, 0, 0, offset) + self.name + extra
+
+
+def _end_records(entries, cd_offset, cd_size, zip64):
+    records = b''
+
+    if zip64:
+        zip64_offset = cd_offset + cd_size
+        records += struct.pack('<IQHHIIQQQQ', 0x06064B50, 44, 45, 45, 0, 0, len(entries), len(entries),
+                               cd_size, cd_offset)
+        records += struct.pack('<IIQI', 0x07064B50, 0, zip64_offset, 1)
+
+    return records + struct.pack('<IHHHHIIH', 0x06054B50, 0, 0, len(entries), len(entries),
+                                 min(cd_size, ZIP64_LIMIT), min(cd_offset, ZIP64_LIMIT), 0)
+
+
+def iter_zip_parallel(csv_name, df, other_files, processes, chunk_rows=DEFAULT_CHUNK_ROWS, zip64=True):
+    """
+    Yields the bytes of a zip file containing `df` as CSV (in `csv_name`), formatted and
+    compressed in chunks by `processes` worker processes, followed by `other_files`:
+    a list of (file name, bytes) pairs. Only unset `zip64` if the zip is known to be
+    smaller than 4 GB: the sizes are only known once the headers have been sent.
+    """
+    entries = []
+    offset = 0
+
+    def add_entry(name):
+        entry = _ZipEntry(name, offset, zip64)
+        entries.append(entry)
+        return entry
+
+    # The CSV file, compressed in parallel
+    entry = add_entry(csv_name)
+    header = entry.local_header()
+    yield header
+    offset += len(header)
+
+    for piece, crc, size in _iter_pieces(df, processes, chunk_rows, compress=True):
+        entry.crc = crc32_combine(entry.crc, crc, size)
+        entry.size += size
+        entry.compressed_size += len(piece)
+        offset += len(piece)
+        yield piece
+
+    # End the deflate stream with an empty final block
+    final_block = zlib.compressobj(COMPRESSION_LEVEL, zlib.DEFLATED, -zlib.MAX_WBITS).flush(zlib.Z_FINISH)
+    entry.compressed_size += len(final_block)
+
+    trailer = final_block + entry.data_descriptor()
+    offset += len(trailer)
+    yield trailer
+
+    # Other (small) files
+    for name, content in other_files:
+        entry = add_entry(name)
+        compressor = zlib.compressobj(COMPRESSION_LEVEL, zlib.DEFLATED, -zlib.MAX_WBITS)
+        data = compressor.compress(content) + compressor.flush()
+
+        entry.crc, entry.size, entry.compressed_size = zlib.crc32(content), len(content), len(data)
+
+        chunk = entry.local_header() + data + entry.data_descriptor()
+        offset += len(chunk)
+        yield chunk
+
+    central_directory = b''.join([_.central_header() for _ in entries])
+    yield central_directory + _end_records(entries, offset, len(central_directory), zip64)
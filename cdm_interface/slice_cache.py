@@ -0,0 +1,233 @@
+"""
+slice_cache.py
+==============
+
+On-disk cache of the raw (undecoded) results of selections, so requests that only
+differ in their output options reuse a single scan of the partition.
+
+A slice is keyed by the data version and the canonical query of the selection,
+leaving out the options that are applied after extraction: `column_selection`,
+`compress` and `intended_use`. Slices are always extracted for all intended uses;
+the licence filter, column projection, decoding of values and packaging are then
+applied to the cached slice for each request.
+
+Each slice is a directory in `SLICE_CACHE_DIR` with one NumPy (`.npy`) file per
+column and a `meta.json` file describing the columns. Numeric and timestamp columns
+are stored as arrays (and memory-mapped when read), string and categorical columns
+as integer codes plus their categories. Only the columns that are needed are read.
+
+The cache is limited to `SLICE_CACHE_MAX_BYTES`: the least recently used slices are
+removed when a new slice is written. Slices expire after `SLICE_CACHE_TIMEOUT` seconds.
+"""
+
+import errno
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+from django.conf import settings
+
+from cdm_interface.utils import canonical_query
+
+import logging
+log = logging.getLogger(__name__)
+
+
+# Parameters applied to the cached slice, rather than in the query
+OUTPUT_PARAMETERS = ('column_selection', 'compress', 'intended_use')
+
+# Intended uses that a slice is extracted for
+ALL_INTENDED_USES = ('non_commercial', 'open')
+
+DEFAULT_MAX_BYTES = 10 * 1024 ** 3
+DEFAULT_TIMEOUT = 24 * 3600
+
+META_FILE = 'meta.json'
+
+
+def get_key(data_version, params):
+    "Returns the key of the slice of a selection: `params` of `data_version`."
+    selection = f'{data_version}?' + canonical_query(params, ignore=OUTPUT_PARAMETERS)
+    return hashlib.sha1(selection.encode('utf-8')).hexdigest()
+
+
+def _write_column(directory, index, series):
+    "Writes `series` to a .npy file and returns the description of the column."
+    path = os.path.join(directory, f'{index}.npy')
+    column = {'name': series.name, 'file': os.path.basename(path)}
+
+    if isinstance(series.dtype, pd.DatetimeTZDtype):
+        column['kind'] = 'timestamp'
+        column['unit'] = getattr(series.dtype, 'unit', 'ns')
+        np.save(path, series.array.asi8)
+    elif series.dtype.kind in 'biuf':
+        column['kind'] = 'numeric'
+        np.save(path, series.to_numpy())
+    else:
+        # Strings are stored as codes too, and decoded when read
+        categorical = series.astype('category').array
+        column['kind'] = 'category' if isinstance(series.dtype, pd.CategoricalDtype) else 'string'
+        column['categories'] = categorical.categories.tolist()
+        np.save(path, categorical.codes)
+
+    return column
+
+
+def _read_column(directory, column):
+    values = np.load(os.path.join(directory, column['file']), mmap_mode='r')
+
+    if column['kind'] == 'timestamp':
+        times = np.asarray(values).view(f'datetime64[{column["unit"]}]')
+        return pd.Series(pd.to_datetime(times, utc=True), name=column['name'])
+    elif column['kind'] == 'numeric':
+        return pd.Series(values, name=column['name'], copy=True)
+
+    categorical = pd.Categorical.from_codes(values, column['categories'])
+
+    if column['kind'] == 'string':
+        return pd.Series(list(categorical), name=column['name'])
+
+    return pd.Series(categorical, name=column['name'])
+
+
+def _get_size(directory):
+    return sum([_.stat().st_size for _ in os.scandir(directory) if _.is_file()])
+
+
+class SliceCache(object):
+
+    def __init__(self, directory, max_bytes=DEFAULT_MAX_BYTES, timeout=DEFAULT_TIMEOUT):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.timeout = timeout
+
+    def _get_path(self, key):
+        return os.path.join(self.directory, key)
+
+    def get(self, key, columns=None):
+        "Returns the DataFrame of the slice `key` (only `columns`, if set), or None if not cached."
+        path = self._get_path(key)
+        meta_path = os.path.join(path, META_FILE)
+
+        try:
+            with open(meta_path) as reader:
+                meta = json.load(reader)
+        except (OSError, ValueError):
+            return None
+
+        if time.time() - meta['created'] > self.timeout:
+            return None
+
+        # The modification time of the meta file records when the slice was last used
+        os.utime(meta_path)
+
+        wanted = [_ for _ in meta['columns'] if columns is None or _['name'] in columns]
+
+        try:
+            data = dict([(_['name'], _read_column(path, _)) for _ in wanted])
+        except OSError:
+            # Removed by another process
+            return None
+
+        return pd.DataFrame(data, columns=[_['name'] for _ in wanted])
+
+    def put(self, key, df):
+        "Writes `df` as the slice `key`, then removes the least recently used slices if over the limit."
+        os.makedirs(self.directory, exist_ok=True)
+        tmp_path = tempfile.mkdtemp(dir=self.directory, prefix='.tmp-')
+
+        try:
+            meta = {'created': time.time(), 'rows': len(df),
+                    'columns': [_write_column(tmp_path, index, df[name]) for index, name in enumerate(df.columns)]}
+
+            with open(os.path.join(tmp_path, META_FILE), 'w') as writer:
+                json.dump(meta, writer)
+
+            path = self._get_path(key)
+            self._remove_expired(path)
+            os.rename(tmp_path, path)
+        except OSError as exc:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+
+            # Another process wrote the same slice meanwhile: its copy is used
+            if exc.errno not in (errno.ENOTEMPTY, errno.EEXIST):
+                raise
+        except Exception:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            raise
+
+        self._evict()
+
+    def _remove_expired(self, path):
+        "Removes the slice in `path` if it has expired (or is incomplete)."
+        try:
+            with open(os.path.join(path, META_FILE)) as reader:
+                created = json.load(reader)['created']
+        except FileNotFoundError:
+            if not os.path.isdir(path):
+                return
+
+            created = 0
+        except (OSError, ValueError, KeyError):
+            created = 0
+
+        if time.time() - created <= self.timeout:
+            return
+
+        # Moved aside first, so other processes never see a partly removed slice
+        old_path = tempfile.mkdtemp(dir=self.directory, prefix='.old-')
+
+        try:
+            os.rename(path, old_path)
+        except FileNotFoundError:
+            # Removed by another process
+            pass
+
+        shutil.rmtree(old_path, ignore_errors=True)
+
+    def _evict(self):
+        slices = []
+
+        for entry in os.scandir(self.directory):
+            # Slices being written or removed by other processes
+            if entry.name.startswith(('.tmp-', '.old-')):
+                continue
+
+            meta_path = os.path.join(entry.path, META_FILE)
+
+            if entry.is_dir() and os.path.exists(meta_path):
+                slices.append((os.stat(meta_path).st_mtime, _get_size(entry.path), entry.path))
+
+        total = sum([_[1] for _ in slices])
+
+        for _, size, path in sorted(slices):
+            if total <= self.max_bytes:
+                break
+
+            log.info(f'Evicting slice from cache: {path}')
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+
+
+_caches = {}
+
+
+def get_cache():
+    "Returns the `SliceCache` in SLICE_CACHE_DIR, or None if it is not set."
+    directory = getattr(settings, 'SLICE_CACHE_DIR', None)
+
+    if not directory:
+        return None
+
+    if directory not in _caches:
+        _caches[directory] = SliceCache(directory,
+                                        max_bytes=getattr(settings, 'SLICE_CACHE_MAX_BYTES', DEFAULT_MAX_BYTES),
+                                        timeout=getattr(settings, 'SLICE_CACHE_TIMEOUT', DEFAULT_TIMEOUT))
+
+    return _caches[directory]
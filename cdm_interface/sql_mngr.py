@@ -4,6 +4,9 @@ sql_mngr.py
 
 Manages construction of SQL query in SQLManager class.
 
+Queries are generated with "%s" placeholders and a separate list of parameters,
+so that values are always bound by the driver (and never formatted into the SQL).
+
 Some example queries:
 
 ```
@@ -15,40 +18,131 @@ query = "SELECT * FROM lite.observations_1763_land_2 WHERE date_time < '1763-01-
 
 import itertools
 import datetime
+import math
 import re
 
+from collections import namedtuple
+
 from cdm_interface.wfs_mappings import wfs_mappings
 from cdm_interface.utils import decompose_datetime
 from cdm_interface.data_versions import validate_data_version, DATA_VERSIONS
 
 import logging
-logging.basicConfig()
 log = logging.getLogger(__name__)
 
 
-#UTC = datetime.timezone.utc
+UTC = datetime.timezone.utc
 #SCHEMA = 'lite_2_0'
 
 
+# A generated query: SQL (with "%s" placeholders), its parameters and the partition queried
+Query = namedtuple('Query', ['sql', 'params', 'partition'])
+
+
 class SQLManager(object):
 
-    tmpl = ("SELECT * FROM {SCHEMA}.observations_{year}_{domain}_{report_type} WHERE "
-        "observed_variable IN {observed_variable} AND "
-        "data_policy_licence IN {data_policy_licence} AND ")
+    partition_tmpl = "{SCHEMA}.observations_{year}_{domain}_{report_type}"
+
+    tmpl = "SELECT * FROM {partition} WHERE {where}"
+
+    where_tmpl = ("observed_variable = ANY(%s) AND "
+        "data_policy_licence = ANY(%s) AND ")
+
+    SPATIAL_COLUMN = 'location'
+    SRID = 4326
+
+    # Maximum edge length (in degrees) of a bbox envelope before it is cast to geography
+    ENVELOPE_SEGMENT_DEGREES = 1
+
+    POLYGON_REGEX = r'^\s*(MULTI)?POLYGON\s*\([\d\s\.,\-\+\(\)eE]+\)\s*$'
+
+    STATION_REGEX = r'^[A-Za-z0-9_\-\.:]+$'
+
+    # Values that are formatted into table names (so must be checked, not bound as params)
+    DOMAINS = ('land', 'marine')
+    YEAR_REGEX = r'^\d{4}$'
+    MAX_STATIONS = 10000
+
+    # Station lists longer than this are loaded into a temporary table and joined,
+    # rather than being written into the query as a long IN (...) literal
+    STATION_TABLE_THRESHOLD = 100
+    STATION_TABLE = 'request_stations'
+
+    # Aggregation: group_by option -> (SQL expression, output column)
+    AGGREGATE_GROUPS = {
+        'station': ('primary_station_id', 'primary_station_id'),
+        'day': ("date_trunc('day', date_time AT TIME ZONE 'UTC')::date", 'day'),
+        'month': ("date_trunc('month', date_time AT TIME ZONE 'UTC')::date", 'month'),
+    }
+
+    # Aggregation: statistic option -> SQL aggregate of observation_value
+    AGGREGATE_STATISTICS = {
+        'count': 'count(observation_value)',
+        'mean': 'avg(observation_value)',
+        'min': 'min(observation_value)',
+        'max': 'max(observation_value)',
+        'sum': 'sum(observation_value)',
+        'stddev': 'stddev_samp(observation_value)',
+    }
+
+    DEFAULT_AGGREGATE_STATISTICS = ['count', 'mean', 'min', 'max']
+
+    # Ways in which a select can be split into independent queries (see `_generate_split_queries`)
+    SPLIT_STRATEGIES = ('variable', 'month', 'auto')
+
+    # Vector tiles: points are clustered on a grid (in tile units, of 4096 per tile) below this zoom
+    TILE_CLUSTER_ZOOM = 8
+    TILE_CLUSTER_GRID = 64
+    TILE_LAYER = 'observations'
+
+    tile_tmpl = ("SELECT ST_AsMVT(tile.*, '" + TILE_LAYER + "') FROM ("
+        "SELECT ST_SnapToGrid(ST_AsMVTGeom(ST_Transform(location::geometry, 3857), "
+        "ST_MakeEnvelope(%s, %s, %s, %s, 3857)), %s) AS geom, "
+        "count(*) AS count, count(DISTINCT primary_station_id) AS stations "
+        "FROM {partition} WHERE {where} GROUP BY 1) AS tile "
+        "WHERE tile.geom IS NOT NULL")
+
+    inventory_tmpl = "{SCHEMA}.inventory_{year}_{domain}_{report_type}"
+
+    inventory_select_tmpl = ("SELECT primary_station_id, observed_variable, month, observation_count, "
+        "first_date_time, last_date_time, longitude, latitude FROM {inventory} WHERE {where}")
+
+    count_tmpl = ("SELECT observed_variable, count(*) AS count FROM {partition} "
+        "WHERE {where} GROUP BY observed_variable")
 
+    aggregate_tmpl = ("SELECT {groups}, observed_variable, units, {statistics}, "
+        "array_agg(DISTINCT source_id) AS source_ids, "
+        "array_agg(DISTINCT left(observation_id, 2)) AS country_ids "
+        "FROM {partition} WHERE {where} "
+        "GROUP BY {group_by}, observed_variable, units "
+        "ORDER BY {group_by}, observed_variable")
 
-    def __init__(self, data_version):
+    def __init__(self, data_version, selection=None):
         self._data_version = validate_data_version(data_version)
 
+        # The parsed request (a `SelectRequest`) that queries are generated for, if any
+        self._selection = selection
+
+    def _get_request(self, qdict):
+        """
+        Returns the `SelectRequest` of `qdict`: the parsed request given to the
+        SQLManager if `qdict` is its params, otherwise `qdict` parsed now.
+        """
+        if self._selection is not None and self._selection.params is qdict:
+            return self._selection
+
+        # Imported here, as the request model uses the parsers of this module
+        from cdm_interface.request_model import parse_request
+        return parse_request(qdict, self._data_version)
+
     def _get_as_list(self, qdict, key, default=None):
         "Parses both: x=1&x=2 and x=1,2 params in query string."
         items = qdict.getlist(key, [])
         
         resp = set()
 
-        log.warning(f'Wanting to split: {items}')
+        log.debug('Splitting items to list: %s', items)
         for item in items:
-            log.warning(f'Splitting items to list: {item}')
             for _ in item.split(','):
                 resp.add(_)
 
@@ -64,7 +158,7 @@ class SQLManager(object):
     def _map_value(self, name, value, mapper, as_array=False):
         try: 
             if as_array:
-                return '(' + ','.join([mapper[_] for _ in value]) + ')'
+                return [mapper[_] for _ in value]
             else:
                 return mapper[value] 
 
@@ -76,14 +170,172 @@ class SQLManager(object):
         # PREVIOUSLY:  return f"ST_Polygon('LINESTRING({w} {s}, {w} {n}, {e} {n}, {e} {s}, {w} {s})'::geometry, {srid})"
         return f"ST_MakeEnvelope({w}, {s}, {e}, {n}, {srid})"
 
-    def _get_data_policy_licence(self, qdict):
+    def _bbox_to_geography(self, w, s, e, n):
+        """
+        Returns a tuple of (SQL, params) for the envelope as a geography. The envelope
+        is segmentized first so that its geodesic edges follow the parallels of the
+        requested box.
         """
-        Special treatment to map single value to list of values based on:
-        - input: non_commercial --> "(1)"
-        - input: open (i.e. including commercial) --> "(0,5)"
-        - input: open,non_commercial --> "(0,1,5)"
+        envelope = self._bbox_to_linestring('%s', '%s', '%s', '%s', srid=self.SRID)
+        return f"ST_Segmentize({envelope}, {self.ENVELOPE_SEGMENT_DEGREES})::geography", [w, s, e, n]
+
+    def _parse_bbox(self, bbox):
+        "Parses and validates a bbox string of: '<west>,<south>,<east>,<north>'."
+        try:
+            w, s, e, n = [float(_) for _ in bbox.split(',')]
+        except ValueError:
+            raise Exception(f'"bbox" must be provided as "<west>,<south>,<east>,<north>", not "{bbox}".')
+
+        if not all(-180 <= _ <= 180 for _ in (w, e)) or not all(-90 <= _ <= 90 for _ in (s, n)):
+            raise Exception(f'"bbox" values are out of range (longitude: -180 to 180, latitude: -90 to 90): "{bbox}".')
+
+        if s > n:
+            raise Exception(f'"bbox" south ({s}) must not be greater than north ({n}).')
+
+        return w, s, e, n
+
+    def _split_bbox(self, w, s, e, n):
+        """
+        Splits a bbox into boxes that can be planned as geography envelopes:
+          - a bbox crossing the antimeridian (w > e) is split at 180 degrees
+          - any box wider than 180 degrees is halved (geography polygons
+            must not span a hemisphere)
+        Returns an empty list if the bbox covers the whole globe.
+        """
+        if w > e:
+            boxes = [(w, s, 180.0, n), (-180.0, s, e, n)]
+        elif e - w >= 360 and s <= -90 and n >= 90:
+            return []
+        else:
+            boxes = [(w, s, e, n)]
+
+        split = []
+        for (bw, bs, be, bn) in boxes:
+            if be - bw > 180:
+                mid = (bw + be) / 2.
+                split.extend([(bw, bs, mid, bn), (mid, bs, be, bn)])
+            else:
+                split.append((bw, bs, be, bn))
+
+        return split
+
+    def _parse_polygon(self, wkt):
+        "Validates a WKT (MULTI)POLYGON so that it can be safely embedded in the SQL."
+        if not re.match(self.POLYGON_REGEX, wkt, re.IGNORECASE):
+            raise Exception(f'"polygon" must be a WKT POLYGON or MULTIPOLYGON in longitude/latitude, not "{wkt}".')
+
+        return wkt.strip()
+
+    def _parse_point_radius(self, point, radius):
+        "Parses and validates a point ('<lon>,<lat>') and radius (in kilometres)."
+        try:
+            lon, lat = [float(_) for _ in point.split(',')]
+            radius = float(radius)
+        except ValueError:
+            raise Exception(f'"point" must be provided as "<longitude>,<latitude>" and "radius" as '
+                            f'a number of kilometres, not "{point}" and "{radius}".')
+
+        if not -180 <= lon <= 180 or not -90 <= lat <= 90:
+            raise Exception(f'"point" values are out of range (longitude: -180 to 180, latitude: -90 to 90): "{point}".')
+
+        if radius <= 0:
+            raise Exception(f'"radius" must be greater than zero, not "{radius}".')
+
+        return lon, lat, radius
+
+    def _intersects_geography(self, geog, params):
+        """
+        Returns a tuple of (SQL, params) for the predicate for a geography shape.
+        The explicit "&&" is an index prefilter on the native (geography) column,
+        so the GiST index is used before the exact ST_Intersects check.
+        """
+        col = self.SPATIAL_COLUMN
+        return f"({col} && {geog} AND ST_Intersects({col}, {geog}))", params + params
+
+    def _get_bbox_condition(self, w, s, e, n):
+        "Returns a tuple of (SQL, params) for a bbox, or (None, []) for the whole globe."
+        boxes = self._split_bbox(w, s, e, n)
+
+        if not boxes:
+            return None, []
+
+        conditions = [self._intersects_geography(*self._bbox_to_geography(*box)) for box in boxes]
+        return self._combine_conditions(conditions)
+
+    def _combine_conditions(self, conditions):
+        "Combines a list of (SQL, params) conditions with OR."
+        params = [param for _, cond_params in conditions for param in cond_params]
+
+        if len(conditions) == 1:
+            return conditions[0][0], params
+
+        return '(' + ' OR '.join([cond for cond, _ in conditions]) + ')', params
+
+    def _parse_spatial(self, qdict):
+        """
+        Returns the spatial selection in the request as a tuple of: (kind, values),
+        or None if no spatial selection was made. Spatial selections can be one of:
+          - bbox=<west>,<south>,<east>,<north>
+          - polygon=<WKT POLYGON or MULTIPOLYGON>
+          - point=<lon>,<lat>&radius=<kilometres>
+        """
+        selections = [_ for _ in ('bbox', 'polygon', 'point') if qdict.get(_)]
+
+        if len(selections) > 1:
+            raise Exception(f'Only one spatial selection can be provided, not: {selections}.')
+
+        if 'radius' in qdict and 'point' not in selections:
+            raise Exception('"radius" can only be used with "point".')
+
+        if not selections:
+            return None
+
+        kind = selections[0]
+
+        if kind == 'bbox':
+            return kind, self._parse_bbox(qdict['bbox'])
+        elif kind == 'polygon':
+            return kind, self._parse_polygon(qdict['polygon'])
+
+        if 'radius' not in qdict:
+            raise Exception('"radius" (in kilometres) must be provided with "point".')
+
+        return kind, self._parse_point_radius(qdict['point'], qdict['radius'])
+
+    def _get_spatial_condition(self, spatial):
+        """
+        Returns a tuple of (SQL, params) for a spatial selection (as returned by
+        `_parse_spatial`), or (None, []) if it is None.
+
+        All shapes are compared against the native geography column (never
+        cast) so that the spatial index can be used.
+        """
+        if not spatial:
+            return None, []
+
+        kind, values = spatial
+
+        if kind == 'bbox':
+            return self._get_bbox_condition(*values)
+
+        elif kind == 'polygon':
+            conditions = [self._intersects_geography("ST_GeogFromText(%s)", [f'SRID={self.SRID};{values}'])]
+
+        else:
+            lon, lat, radius = values
+            point = f"ST_SetSRID(ST_MakePoint(%s, %s), {self.SRID})::geography"
+            # ST_DWithin includes its own index prefilter on geography
+            conditions = [(f"ST_DWithin({self.SPATIAL_COLUMN}, {point}, %s)", [lon, lat, radius * 1000.])]
+
+        return self._combine_conditions(conditions)
+
+    def _get_data_policy_licence(self, value):
+        """
+        Special treatment to map the list of intended uses to list of values based on:
+        - input: non_commercial --> [1]
+        - input: open (i.e. including commercial) --> [0, 5]
+        - input: open,non_commercial --> [0, 1, 5]
         """
-        value = self._get_as_list(qdict, "intended_use") 
         resp = set()
 
         if "open" in value:
@@ -92,28 +344,289 @@ class SQLManager(object):
         if "non_commercial" in value:
             resp.add("1")
 
-        return "(" + ",".join([i for i in sorted(resp)]) + ")"
+        return sorted([int(_) for _ in resp])
 
-    def _generate_queries(self, qdict):
+    def _get_stations(self, qdict):
+        """
+        Returns a sorted list of the station IDs requested in the "station" parameter.
+        Stations can be separated by commas or whitespace (e.g. one per line in a POST).
+        """
+        stations = set()
 
-        tmpl = self.tmpl
+        for item in qdict.getlist('station', []):
+            stations.update(item.replace(',', ' ').split())
 
-        d = {'SCHEMA': DATA_VERSIONS[self._data_version]}
-        d['domain'] = qdict['domain']
+        if len(stations) > self.MAX_STATIONS:
+            raise Exception(f'A maximum of {self.MAX_STATIONS} stations can be requested, '
+                            f'not {len(stations)}. Please modify your request.')
+
+        for station in stations:
+            if not re.match(self.STATION_REGEX, station):
+                raise Exception(f'Invalid value for "station": "{station}".')
+
+        return sorted(stations)
+
+    def needs_station_table(self, stations):
+        "Returns True if the stations must be loaded into the temporary station table."
+        return len(stations) > self.STATION_TABLE_THRESHOLD
+
+    def _get_station_condition(self, stations):
+        "Returns a tuple of (SQL, params) for the station condition."
+        if self.needs_station_table(stations):
+            return f"primary_station_id IN (SELECT primary_station_id FROM {self.STATION_TABLE})", []
+
+        return "primary_station_id = ANY(%s)", [stations]
 
+    def _get_keyset_condition(self, after):
+        """
+        Returns a tuple of (SQL, params) to select rows after the keyset `after`
+        of (date_time, observation_id). The extra "date_time >= ..." condition is
+        implied by the row comparison but lets the planner use the date_time index.
+        """
+        date_time, observation_id = after
+        return ("date_time >= %s AND (date_time, observation_id) > (%s, %s)",
+                [date_time, date_time, observation_id])
+
+    def _generate_queries(self, qdict, limit=None, keyset=False, after=None):
+        """
+        Returns a `Query` of: (sql, params, partition). The SQL contains "%s"
+        placeholders for all values in `params`. Only the partition name and the
+        shape of the predicates are written into the SQL itself, so requests of
+        the same shape produce identical SQL (and can share a prepared statement).
+
+        If `limit` is set, at most `limit` rows are returned.
+
+        If `keyset` is True, rows are ordered by (date_time, observation_id) and,
+        if `after` is set, only rows after that (date_time, observation_id) are
+        selected (for keyset pagination).
+        """
+        partition, where, params = self._generate_where(qdict)
+
+        if after:
+            keyset_condition, keyset_params = self._get_keyset_condition(after)
+            where += f" AND {keyset_condition}"
+            params.extend(keyset_params)
+
+        sql = self.tmpl.format(partition=partition, where=where)
+
+        if keyset:
+            sql += " ORDER BY date_time, observation_id"
+
+        if limit is not None:
+            sql += " LIMIT %s"
+            params.append(limit)
+
+        return Query(sql, params, partition)
+
+    def _generate_count_query(self, qdict):
+        """
+        Returns a `Query` that counts the rows selected in `qdict` per observed variable.
+        Only indexed columns are referenced, so the count can use an index-only scan.
+        """
+        partition, where, params = self._generate_where(qdict)
+
+        sql = self.count_tmpl.format(partition=partition, where=where)
+        return Query(sql, params, partition)
+
+    def _generate_count_estimate_queries(self, qdict):
+        """
+        Returns a list of (variable, `Query`) with one "EXPLAIN" query per variable
+        selected in `qdict`, from which the planner's row estimate can be read.
+        """
+        partition, where, params = self._generate_where(qdict)
+        sql = "EXPLAIN (FORMAT JSON) " + self.tmpl.format(partition=partition, where=where)
+
+        estimates = []
+        for variable in self._get_request(qdict).variables:
+            code = int(self._map_value('variable', variable, wfs_mappings['variable']['fields']))
+            estimates.append((variable, Query(sql, [[code]] + params[1:], partition)))
+
+        return estimates
+
+    def _generate_split_queries(self, qdict, split, limit=None):
+        """
+        Returns a list of independent `Query` objects that together select the same
+        rows as `_generate_queries(qdict)`, split by:
+          - "variable": one query per observed variable
+          - "month":    one query per month (not for "time" range selections)
+          - "auto":     by variable if more than one is selected, otherwise by month
+
+        A single query is returned if the selection cannot be split. If `limit` is
+        set, it applies to each query.
+        """
+        if split not in self.SPLIT_STRATEGIES:
+            raise Exception(f'Query split must be one of: {self.SPLIT_STRATEGIES}, not "{split}".')
+
+        request = self._get_request(qdict)
+        months = [] if request.time_range else request.months
+
+        if split == 'auto':
+            split = 'variable' if len(request.variables) > 1 else 'month'
+
+        values = request.variables if split == 'variable' else months
+
+        if len(values) < 2:
+            return [self._generate_queries(qdict, limit=limit)]
+
+        queries = []
+        for value in values:
+            sub_qdict = qdict.copy()
+            sub_qdict.setlist(split, [value])
+
+            # The request of each query only differs in the split parameter
+            field = 'variables' if split == 'variable' else 'months'
+            sub_request = request._replace(params=sub_qdict, **{field: [value]})
+            queries.append(SQLManager(self._data_version, selection=sub_request)._generate_queries(sub_qdict,
+                                                                                                  limit=limit))
+
+        return queries
+
+    def _generate_aggregate_query(self, qdict):
+        """
+        Returns a `Query` that aggregates observation values over the selection in
+        `qdict`, grouped by `group_by` (any of: station, day, month) and by variable.
+        The statistics are set with `statistics` (default: count, mean, min, max).
+
+        The `source_ids` and `country_ids` (from `observation_id`) columns list
+        the sources and nations in each group, for the data policy.
+        """
+        group_by = self._get_as_list(qdict, 'group_by', default=['station'])
+        statistics = self._get_as_list(qdict, 'statistics', default=self.DEFAULT_AGGREGATE_STATISTICS)
+
+        for name, values, allowed in (('group_by', group_by, self.AGGREGATE_GROUPS),
+                                      ('statistics', statistics, self.AGGREGATE_STATISTICS)):
+            for value in values:
+                if value not in allowed:
+                    raise Exception(f'Cannot find value "{value}" in list of valid options for '
+                                    f'parameter: "{name}" ({list(allowed)}).')
+
+        # Keep a fixed order of groups and statistics, so the SQL only depends on the options chosen
+        groups = [self.AGGREGATE_GROUPS[_] for _ in self.AGGREGATE_GROUPS if _ in group_by]
+        statistics = [_ for _ in self.AGGREGATE_STATISTICS if _ in statistics]
+
+        partition, where, params = self._generate_where(qdict)
+
+        sql = self.aggregate_tmpl.format(
+            groups=', '.join([f'{expr} AS {column}' for expr, column in groups]),
+            statistics=', '.join([f'{self.AGGREGATE_STATISTICS[_]} AS {_}' for _ in statistics]),
+            group_by=', '.join([column for _, column in groups]),
+            partition=partition, where=where)
+
+        return Query(sql, params, partition)
+
+    def _generate_tile_query(self, qdict, z, x, y):
+        """
+        Returns a `Query` for a Mapbox vector tile (at `z`/`x`/`y`) of the locations
+        of the observations selected in `qdict`. Each feature has the `count` of
+        observations and number of `stations` at that point. Below `TILE_CLUSTER_ZOOM`
+        points are clustered on a grid of `TILE_CLUSTER_GRID` tile units.
+        """
+        tile_bbox, envelope = _get_tile_bounds(z, x, y)
+        grid = self.TILE_CLUSTER_GRID if z < self.TILE_CLUSTER_ZOOM else 1
+
+        partition, where, params = self._generate_where(qdict)
+
+        # Index-driven prefilter to the tile (in lon/lat)
+        bbox_condition, bbox_params = self._get_bbox_condition(*tile_bbox)
+        if bbox_condition:
+            where += f" AND {bbox_condition}"
+            params.extend(bbox_params)
+
+        sql = self.tile_tmpl.format(partition=partition, where=where, SRID=self.SRID)
+        return Query(sql, list(envelope) + [grid] + params, partition)
+
+    def _format_table(self, tmpl, d):
+        "Returns the table name of `tmpl` for `d`, checking the domain and year it contains."
+        if d['domain'] not in self.DOMAINS:
+            raise Exception(f'"domain" must be one of: {self.DOMAINS}')
+
+        if not re.match(self.YEAR_REGEX, str(d['year'])):
+            raise Exception(f'Invalid value for "year": "{d["year"]}". Must be a 4-digit year.')
+
+        return tmpl.format(**d)
+
+    def _generate_inventory_query(self, qdict):
+        """
+        Returns a `Query` of the inventory rows (station, variable, month) matching
+        `qdict`, from the inventory tables of the partitions of each "year". The
+        "variable", "month", "station" and spatial selections are all optional.
+        """
+        d = {'SCHEMA': DATA_VERSIONS[self._data_version], 'domain': qdict['domain']}
         d['report_type'] = self._map_value('frequency', qdict['frequency'],
-                                wfs_mappings['frequency']['fields'])
+                                           wfs_mappings['frequency']['fields'])
+
+        where, params = "TRUE", []
+
+        variables = self._get_as_list(qdict, 'variable')
+        if variables:
+            observed_variables = self._map_value('variable', variables,
+                                                 wfs_mappings['variable']['fields'], as_array=True)
+            where += " AND observed_variable = ANY(%s)"
+            params.append([int(_) for _ in observed_variables])
+
+        spatial_condition, spatial_params = self._get_spatial_condition(self._parse_spatial(qdict))
+        if spatial_condition:
+            where += f" AND {spatial_condition}"
+            params.extend(spatial_params)
+
+        stations = self._get_stations(qdict)
+        if stations:
+            station_condition, station_params = self._get_station_condition(stations)
+            where += f" AND {station_condition}"
+            params.extend(station_params)
+
+        years = self._get_as_list(qdict, 'year')
+        if not years:
+            raise Exception('Input parameter "year" must be provided.')
+
+        months = [int(_) for _ in self._get_as_list(qdict, 'month')]
+
+        selects, all_params = [], []
+        for year in years:
+            d['year'] = year
+            inventory = self._format_table(self.inventory_tmpl, d)
+            year_where, year_params = where, list(params)
+
+            if months:
+                year_where += " AND month = ANY(%s)"
+                year_params.append([datetime.date(int(year), _, 1) for _ in months])
+
+            selects.append(self.inventory_select_tmpl.format(inventory=inventory, where=year_where))
+            all_params.extend(year_params)
 
-        if 'bbox' in qdict:
-            bbox = [float(_) for _ in qdict['bbox'].split(',')]
-            d['linestring'] = self._bbox_to_linestring(*bbox)
-            tmpl += "ST_Intersects({linestring}, location::geometry) AND "
+        sql = " UNION ALL ".join(selects) + " ORDER BY primary_station_id, observed_variable, month"
+        return Query(sql, all_params, self._format_table(self.inventory_tmpl, d))
 
-        d['observed_variable'] = self._map_value('variable', self._get_as_list(qdict, 'variable'),
+    def _generate_where(self, qdict):
+        """
+        Returns a tuple of: (partition, where, params) for the selection in `qdict`,
+        where `where` is the SQL condition (with "%s" placeholders for `params`).
+        The condition is built from the parsed request (see `_get_request`).
+        """
+        request = self._get_request(qdict)
+        tmpl = self.where_tmpl
+
+        d = {'SCHEMA': DATA_VERSIONS[self._data_version]}
+        d['domain'] = request.domain
+
+        d['report_type'] = self._map_value('frequency', request.frequency,
+                                wfs_mappings['frequency']['fields'])
+
+        observed_variables = self._map_value('variable', request.variables,
                                      wfs_mappings['variable']['fields'],
                                      as_array=True)
 
-        d['data_policy_licence'] = self._get_data_policy_licence(qdict) #['intended_use'])
+        params = [[int(_) for _ in observed_variables], self._get_data_policy_licence(request.intended_use)]
+
+        spatial_condition, spatial_params = self._get_spatial_condition(request.spatial)
+        if spatial_condition:
+            tmpl += f"{spatial_condition} AND "
+            params.extend(spatial_params)
+
+        if request.stations:
+            station_condition, station_params = self._get_station_condition(request.stations)
+            tmpl += f"{station_condition} AND "
+            params.extend(station_params)
 #        d['data_policy_licence'] = self._map_value('intended_use', self._get_as_list(qdict, 'intended_use'),
 #                                     {"open": "0", "non_commercial": "1"},
 #                                     as_array=True)
@@ -124,38 +637,34 @@ class SQLManager(object):
 #            d['quality_flag'] = '0'
 #            tmpl += "quality_flag = {quality_flag} AND "
 
-        d['quality_flag'] = self._map_value('data_quality', self._get_as_list(qdict, 'data_quality'),
+        d['quality_flag'] = self._map_value('data_quality', request.data_quality,
                                      {"passed": "0", "failed": "1"},
                                      as_array=True)
 
         # If the request includes the "time" parameter then ignore other temporal parameters
-        if qdict.get('time'):
-            time_condition = self._get_time_range_condition(qdict['time'])
+        if request.time_range:
+            time_condition, time_params = self._get_time_range_condition(*request.time_range)
             # "year" is needed in template to match the partition
-            d['year'] = qdict['time'][:4] 
+            d['year'] = f'{request.time_range[0].year:04d}'
 
         else:
-            year = d['year'] = self._get_as_list(qdict, 'year')[0]
-            months = self._get_as_list(qdict, 'month')
-
-            # Set defaults for days and hours
-            days = None
-            hours = None
+            year = d['year'] = request.years[0]
 
-            # Overwrite days and hours if relevant to the query
-            if qdict['frequency'] in ('daily', 'sub_daily'):
-                days = self._get_as_list(qdict, 'day')
+            # Days are only relevant to daily and sub-daily queries
+            days = request.days if request.frequency in ('daily', 'sub_daily') else None
 
-            if qdict['frequency'] == 'sub_daily':
-                hours = self._get_as_list(qdict, 'hour') or [f'{_:02d}' for _ in range(24)]
+            time_condition, time_params = self._get_time_condition([year], request.months, days,
+                                                                   frequency=request.frequency)
 
-            time_condition = self._get_time_condition([year], months, days, frequency=qdict['frequency'])
+        params.extend(time_params)
 
-        return (tmpl + time_condition).format(**d)
+        partition = self._format_table(self.partition_tmpl, d)
+        return partition, tmpl + time_condition, params
 
     def _get_time_condition(self, years, months, days=None, frequency=None):
         """
-        Generate and return a time condition SQL string. This matches at the level of:
+        Generate and return a tuple of (SQL, params) for the time condition.
+        This matches at the level of:
           - month: for monthly data
           - day:   for daily/sub-daily data
         """
@@ -170,13 +679,11 @@ class SQLManager(object):
 
         all_times = []
         
-        log.warning(f'Generating times from: {time_iterators}')
+        log.debug('Generating times from: %s', time_iterators)
         for x in itertools.product(*time_iterators):
             # Use try/except to ignore any invalid time combinations
             try:
-                #tm = datetime.datetime.strptime('-'.join(x))
-                #all_times.append(tm.strftime(dt_format))
-                all_times.append('-'.join(x))
+                all_times.append(datetime.date(*[int(_) for _ in x]))
             except Exception as err:
                 pass
 
@@ -184,18 +691,18 @@ class SQLManager(object):
         if not all_times:
             raise Exception('Could not generate any valid date/time values from the parameters provided.')
 
-        all_times_string = ', '.join(["'{}'".format(x) for x in all_times])
-
         if frequency == 'monthly':
-            time_condition = f"date_trunc('month', date_time) in ({all_times_string});"
+            # Months are truncated in UTC, whatever the time zone of the session
+            time_condition = "date_trunc('month', date_time AT TIME ZONE 'UTC')::date = ANY(%s)"
         else:
-            time_condition = f"date in ({all_times_string});"
+            time_condition = "date = ANY(%s)"
 
-        return time_condition
+        return time_condition, [all_times]
 
 
-    def _get_time_range_condition(self, time_range):
-        log.info(f'Parsing time range: "{time_range}"')
+    def _parse_time_range(self, time_range):
+        "Parses a time range of: '<start_time>/<end_time>' and returns a tuple of (start, end) in UTC."
+        log.debug('Parsing time range: "%s"', time_range)
 
         if '/' not in time_range:
              raise Exception(f'Time range must be provided as "<start_time>/<end_time>", not "{time_range}".')
@@ -207,11 +714,40 @@ class SQLManager(object):
         if start.year != end.year:
             raise Exception('Time range selections must be a maximum of 1 year. Please modify your request.')
 
+        if start > end:
+            raise Exception(f'The start of the time range must be before its end: "{time_range}".')
+
         #start_time, end_time = [_.astimezone(UTC) for _ in (start, end)] # <-- failed with pre-1800 python3.6
-        start_time, end_time = [f'{_}+00:00' for _ in (start, end)]
+        return tuple([_.replace(tzinfo=UTC) for _ in (start, end)])
 
-        time_condition = f"date_time BETWEEN '{start_time}'::timestamptz AND '{end_time}'::timestamptz;"
-        return time_condition
+    def _get_time_range_condition(self, start_time, end_time):
+        "Returns a tuple of (SQL, params) for the time condition of a (parsed) time range."
+        time_condition = "date_time BETWEEN %s AND %s"
+        return time_condition, [start_time, end_time]
 
-        
 
+# Half the width of the world in Web Mercator (EPSG:3857) metres
+WEB_MERCATOR_EXTENT = 20037508.342789244
+
+
+def _get_tile_bounds(z, x, y):
+    """
+    Returns a tuple of: ((w, s, e, n), (xmin, ymin, xmax, ymax)) for the tile
+    `z`/`x`/`y`: in longitude/latitude and in Web Mercator metres.
+    """
+    n_tiles = 2 ** z
+
+    if not 0 <= z <= 22 or not 0 <= x < n_tiles or not 0 <= y < n_tiles:
+        raise Exception(f'Invalid tile: {z}/{x}/{y}.')
+
+    def lon(i):
+        return i / n_tiles * 360. - 180.
+
+    def lat(j):
+        return math.degrees(math.atan(math.sinh(math.pi * (1 - 2. * j / n_tiles))))
+
+    size = 2 * WEB_MERCATOR_EXTENT / n_tiles
+    xmin = -WEB_MERCATOR_EXTENT + x * size
+    ymax = WEB_MERCATOR_EXTENT - y * size
+
+    return (lon(x), lat(y + 1), lon(x + 1), lat(y)), (xmin, ymax - size, xmin + size, ymax)
@@ -0,0 +1,76 @@
+"""
+streaming.py
+============
+
+Incremental serialisation of results for streaming responses.
+
+The results are written as CSV in chunks of rows and, if compressed, into a zip
+file that is written to an unseekable buffer, so the response can be sent as it
+is produced. `aiterate` runs each step of a (CPU-bound) generator in an executor,
+so that it can be used in an async streaming response.
+"""
+
+import asyncio
+import io
+import zipfile
+
+
+DEFAULT_CSV_CHUNK_ROWS = 100000
+
+
+class _Sink(io.RawIOBase):
+    "An unseekable buffer, drained as the zip file is written to it."
+
+    def __init__(self):
+        self._buffer = bytearray()
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._buffer.extend(data)
+        return len(data)
+
+    def drain(self):
+        data = bytes(self._buffer)
+        self._buffer.clear()
+        return data
+
+
+def iter_csv(df, chunk_rows=DEFAULT_CSV_CHUNK_ROWS):
+    "Yields `df` as CSV (bytes), `chunk_rows` rows at a time."
+    for start in range(0, max(len(df), 1), chunk_rows):
+        chunk = df.iloc[start:start + chunk_rows]
+        yield chunk.to_csv(index=False, header=(start == 0)).encode('utf-8')
+
+
+def iter_zip(files):
+    """
+    Yields the bytes of a (deflated) zip file containing `files`: a list of
+    (file name, iterable of bytes) pairs.
+    """
+    sink = _Sink()
+
+    with zipfile.ZipFile(sink, 'w', compression=zipfile.ZIP_DEFLATED) as zf:
+        for fname, chunks in files:
+            with zf.open(fname, 'w', force_zip64=True) as writer:
+                for chunk in chunks:
+                    writer.write(chunk)
+                    yield sink.drain()
+
+    yield sink.drain()
+
+
+async def aiterate(iterator, executor=None):
+    "Asynchronously yields the (non-empty) items of `iterator`, each produced in `executor`."
+    loop = asyncio.get_running_loop()
+    done = object()
+
+    while True:
+        item = await loop.run_in_executor(executor, next, iterator, done)
+
+        if item is done:
+            break
+
+        if item:
+            yield item
@@ -6,16 +6,67 @@ __copyright__ = "Copyright 2019 United Kingdom Research and Innovation"
 __license__ = "BSD - see LICENSE file in top-level directory"
 
 
+import functools
+import importlib
+
+from django.conf import settings
 from django.urls import path
 from django.shortcuts import redirect
+from django.views.decorators.csrf import csrf_exempt
+
+from cdm_interface import basic_views
+
+
+def _lazy_view(name, module='cdm_interface.views'):
+    """
+    Returns a view function for the class `name` in `module`, which is only
+    imported (with pandas, psycopg2 etc.) when the view is first called.
+    """
+    @functools.lru_cache(maxsize=None)
+    def get_view():
+        return getattr(importlib.import_module(module), name).as_view()
+
+    def view(request, *args, **kwargs):
+        return get_view()(request, *args, **kwargs)
+
+    return csrf_exempt(view)
+
+
+def _lazy_async_view(name, module='cdm_interface.async_views'):
+    "As `_lazy_view`, for an async view."
+    @functools.lru_cache(maxsize=None)
+    def get_view():
+        return getattr(importlib.import_module(module), name).as_view()
+
+    async def view(request, *args, **kwargs):
+        return await get_view()(request, *args, **kwargs)
+
+    return csrf_exempt(view)
+
 
-from cdm_interface import views as interface_views
+# In ASGI deployments, select and constraints requests are served by async views
+if getattr(settings, 'ASYNC_VIEWS', False):
+    select_view = _lazy_async_view('AsyncSelectView')
+    constraints_view = basic_views.AsyncConstraintsView.as_view()
+else:
+    select_view = _lazy_view('SelectView')
+    constraints_view = basic_views.ConstraintsView.as_view()
 
 
 urlpatterns = [
-    path('select/', interface_views.SelectView.as_view()),
-    path('<data_version>/select/', interface_views.SelectView.as_view()),
-    path('<data_version>/constraints/<domain>', interface_views.ConstraintsView.as_view()),
+    path('health/', basic_views.HealthView.as_view()),
+    path('ready/', basic_views.ReadyView.as_view()),
+    path('select/', select_view),
+    path('<data_version>/select/', select_view),
+    path('select/batch/', _lazy_view('BatchSelectView')),
+    path('<data_version>/select/batch/', _lazy_view('BatchSelectView')),
+    path('aggregate/', _lazy_view('AggregateView')),
+    path('<data_version>/aggregate/', _lazy_view('AggregateView')),
+    path('tiles/<int:z>/<int:x>/<int:y>', _lazy_view('TilesView')),
+    path('<data_version>/tiles/<int:z>/<int:x>/<int:y>', _lazy_view('TilesView')),
+    path('inventory/', _lazy_view('InventoryView')),
+    path('<data_version>/inventory/', _lazy_view('InventoryView')),
+    path('<data_version>/constraints/<domain>', constraints_view),
 #    path('wfs/', interface_views.RawWFSView.as_view()),
 #    path('records/',
 #        interface_views.LiteRecordView.as_view()),
@@ -7,23 +7,22 @@ __license__ = "BSD - see LICENSE file in top-level directory"
 
 
 import json
-import requests
 import io
 import csv
 import re
 import datetime
 
 from django.conf import settings
-from furl import furl
-from pandas import DataFrame
+from urllib.parse import urlencode
 
 import logging
-logging.basicConfig()
 log = logging.getLogger(__name__)
 
 
 
 def extract_csv_records(input_data, index_field=None, mappers=None):
+    # Imported here so that pandas is only loaded by the views that need it
+    from pandas import DataFrame
 
     # Convert the CSV file to a DataFrame
     if type(input_data) is str:
@@ -53,6 +52,34 @@ def extract_csv_records(input_data, index_field=None, mappers=None):
     return data
 
 
+# Parameters that hold lists of values (as "x=1,2" or "x=1&x=2"), so their order does not matter
+LIST_PARAMETERS = ('variable', 'intended_use', 'data_quality', 'year', 'month', 'day', 'hour', 'station',
+                   'group_by', 'statistics')
+
+
+def canonical_query(qdict, ignore=()):
+    """
+    Returns a canonical string for the parameters of a request: keys are sorted
+    and the values of list parameters are split, de-duplicated and sorted.
+    Requests that differ only in parameter order or list formatting give the
+    same string. Keys in `ignore` are left out.
+    """
+    items = []
+
+    for key in sorted(qdict.keys()):
+        if key in ignore:
+            continue
+
+        values = qdict.getlist(key)
+
+        if key in LIST_PARAMETERS:
+            values = sorted(set([_ for value in values for _ in re.split(r'[,\s]+', value) if _]))
+
+        items.append((key, ','.join(values)))
+
+    return urlencode(items)
+
+
 def decompose_datetime(dt, day_limit):
     match = re.match('^(\d{4})-(\d{2})-(\d{2})T?(\d{2})?:?(\d{2})?:?(\d{2})?$', dt)
     err_msg = f'Could not parse date/time from: "{dt}".'
@@ -8,42 +8,79 @@ __license__ = "BSD - see LICENSE file in top-level directory"
 
 import re
 import json
+import itertools
 import zipfile
 import os
 import io
 import random
 import time
 import uuid
+import hashlib
+import contextvars
+import threading
 from dateutil import parser
 
 import pandas as pd
 import psycopg2
 
 from io import BytesIO
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 from collections import namedtuple
 from django.views.generic import View
-from django.http import HttpResponse
+from django.http import HttpResponse, StreamingHttpResponse, FileResponse, QueryDict
 from django.conf import settings
+from django.core.cache import cache
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.decorators import method_decorator
+from django.views.decorators.csrf import csrf_exempt
 
 #from cdm_interface.utils import LayerQuery, WFSQuery, extract_json_records,
-from cdm_interface.utils import extract_csv_records
+from cdm_interface.utils import extract_csv_records, canonical_query
 from cdm_interface.sql_mngr import SQLManager
-from cdm_interface.data_policies import get_data_policies
+from cdm_interface.wfs_mappings import wfs_mappings
+from cdm_interface.db import pooled_connection, prepare
+from cdm_interface import query_log
+from cdm_interface import coalesce
+from cdm_interface.frames import read_frame, concat_frames, map_categories, get_memory_usage
+from cdm_interface import limits
+from cdm_interface import pagination
+from cdm_interface import serialise
+from cdm_interface.streaming import iter_csv, iter_zip
+from cdm_interface import request_logging
+from cdm_interface import extracts
+from cdm_interface import slice_cache
+from cdm_interface import warmup
+from cdm_interface.request_model import parse_request, parse_flag
+from cdm_interface.data_policies import get_data_policies, merge_data_policies
 from cdm_interface.file_namer import OutputFileNamer
 from cdm_interface.data_versions import validate_data_version
 
 import logging
-logging.basicConfig()
 log = logging.getLogger(__name__)
 
 
+# Results with fewer rows are serialised in the request's own thread
+DEFAULT_SERIALISE_PARALLEL_MIN_ROWS = 500000
+
+# Select responses (for a data version) do not change, so caches can keep them for a year
+DEFAULT_RESPONSE_CACHE_MAX_AGE = 365 * 24 * 3600
+
+# Responses without a data version in the URL change when the default version does
+DEFAULT_UNVERSIONED_RESPONSE_CACHE_MAX_AGE = 600
+
+
 def log_time(msg):
     now = time.time()
-    log.warn(f'[TIMER] | {msg} | {now:.3f}')
+    log.info('[TIMER] | %s | %.3f', msg, now, extra={'timer': msg, 'timestamp': round(now, 3)})
 
 
+@method_decorator(csrf_exempt, name='dispatch')
 class SelectView(View):
 
+    # Used in the output file names (and to separate coalesced requests)
+    output_content = 'obs'
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         #self._output_format = None
@@ -51,46 +88,195 @@ class SelectView(View):
 
     def _set_reqid(self):
         self._reqid = uuid.uuid4() 
+        request_logging.set_request_id(self._reqid)
 
 #    @property
 #    def output_format(self):
 #        return "csv"
 
-    def get(self, request, data_version):
+    def get(self, request, data_version=None):
 
-     
-        log.warn(f'QUERY STRING: {request.GET}')
-        log.warn(f'Query string: {self.request.GET.urlencode()}')
+        log.info('Query string: %s', request.GET.urlencode())
+
+        return self._select(request, request.GET, data_version)
+
+    def head(self, request, data_version=None):
+        "Returns only the row counts of the selection, in the response headers."
+        return self._count(request.GET, data_version, head=True)
+
+    def post(self, request, data_version=None):
+        """
+        Accepts the same parameters as GET, but as a form POST, so that large
+        parameters (such as a list of thousands of "station" IDs) can be sent.
+        Parameters in the query string are merged with the POSTed parameters.
+        """
+        params = request.GET.copy()
 
+        for key in request.POST:
+            params.setlist(key, request.POST.getlist(key))
+
+        log.info('Posted query: %s', params.urlencode()[:1000])
+        return self._select(request, params, data_version)
+
+    def _select(self, request, params, data_version):
+        versioned = data_version is not None
         data_version = validate_data_version(data_version)
 
+        # Reject malformed requests before any other work
+        try:
+            selection = parse_request(params, data_version)
+        except Exception as exc:
+            log.warning(f'[ERROR] Invalid request: {exc}')
+            return HttpResponse(f'Exception raised when running query: {str(exc)}', status=400)
+
+        if selection.count_only:
+            return self._count(selection.params, data_version, selection=selection)
+
+        params = selection.params
+
+        etag = self._get_etag(params, data_version)
+        if request.method == 'GET':
+            not_modified = get_conditional_response(request, etag=etag)
+            if not_modified:
+                return not_modified
+
+        response = self._get_extract_response(params, data_version)
+        if response:
+            return self._set_cache_headers(response, etag, versioned)
+
         log_time(f'{self._reqid}::RECEIVED_QUERY')
         try:
-            qm = QueryManager(data_version, self._reqid)
-            data, data_policy_text = qm.run_query(request.GET)
+            qm = QueryManager(data_version, self._reqid, selection=selection)
+
+            def run_query():
+                return self._run_query(qm, params) + (qm.next_page_token,)
+
+            # Identical concurrent requests share a single run of the query
+            coalesce_key = f'{data_version}/{self.output_content}?' + canonical_query(params, ignore=('compress',))
+            data, data_policy_text, next_page_token = coalesce.run_once(coalesce_key, run_query)
         except Exception as exc:
 
-            log.warn(f'[ERROR] Failed with exception: {exc}')
+            log.warning(f'[ERROR] Failed with exception: {exc}')
 
 #            with open('/tmp/failures.txt', 'a') as writer:
 #                writer.write(str(request.GET) + '\n' + str(exc) + '\n\n')
 
-            return HttpResponse(f'Exception raised when running query: {str(exc)}', status=400)
+            status = 413 if isinstance(exc, limits.RequestTooLarge) else 400
+            return HttpResponse(f'Exception raised when running query: {str(exc)}', status=status)
 
-        log.warn(f'LENGTH: {len(data)}')
-        compress = json.loads(request.GET.get("compress", "true"))
-        return self._build_response(request, data, data_version, data_policy_text, compress=compress)
+        log.info('Result length: %d', len(data), extra={'rows': len(data)})
+        response = self._build_response(params, data, data_version, data_policy_text, compress=selection.compress)
 
-    def _build_response(self, request, data, data_version, data_policy_text='', compress=True):
-        log_time(f'{self._reqid}::START_BUILD_RESPONSE')
+        if next_page_token:
+            response['X-Next-Page-Token'] = next_page_token
 
-        data = data.to_csv(index=False)
+        return self._set_cache_headers(response, etag, versioned)
+
+    def _get_etag(self, params, data_version):
+        """
+        Returns the ETag of the response to a request: a hash of its canonical query. It is
+        weak, as the zip files of identical results can differ (e.g. in their timestamps).
+        """
+        selection = f'{data_version}/{self.output_content}?' + canonical_query(params)
+        return 'W/"' + hashlib.sha1(selection.encode('utf-8')).hexdigest() + '"'
+
+    def _set_cache_headers(self, response, etag, versioned):
+        """
+        Sets the `etag` of a successful response and marks it as public, for caches in front
+        of the service. Responses to URLs with a data version are immutable, for
+        RESPONSE_CACHE_MAX_AGE seconds; others (of the default version, which can change) are
+        kept for UNVERSIONED_RESPONSE_CACHE_MAX_AGE seconds. None: not cached.
+        """
+        if versioned:
+            max_age = getattr(settings, 'RESPONSE_CACHE_MAX_AGE', DEFAULT_RESPONSE_CACHE_MAX_AGE)
+        else:
+            max_age = getattr(settings, 'UNVERSIONED_RESPONSE_CACHE_MAX_AGE',
+                              DEFAULT_UNVERSIONED_RESPONSE_CACHE_MAX_AGE)
+
+        if max_age is not None and response.status_code == 200:
+            response['ETag'] = etag
+
+            if versioned:
+                patch_cache_control(response, public=True, max_age=max_age, immutable=True)
+            else:
+                patch_cache_control(response, public=True, max_age=max_age)
+
+        return response
+
+    def _get_extract_response(self, params, data_version):
+        """
+        Returns a response serving the pre-built extract (see `extracts.py`) that matches
+        the request, or None if there is none (and the query must be run).
+        """
+        if self.output_content != 'obs' or not parse_flag(params, 'compress'):
+            return None
+
+        path = extracts.lookup(data_version, params)
+
+        if not path:
+            return None
+
+        log.info('Serving pre-built extract: %s', path)
+        file_namer = OutputFileNamer(data_version, params, content=self.output_content)
+
+        return FileResponse(open(path, 'rb'), as_attachment=True, filename=file_namer.get_zip_name(),
+                            content_type="application/x-zip-compressed")
+
+    def _count(self, params, data_version, head=False, selection=None):
+        """
+        Returns the number of rows the selection would return, per variable, without
+        extracting them: as JSON, or only in the "X-Row-Count" headers for a HEAD request.
+        Counts are cached (for COUNT_CACHE_TIMEOUT seconds) per canonical query.
+        `selection` is the `SelectRequest` of `params`, if already parsed.
+        """
+        data_version = validate_data_version(data_version)
+
+        count_query = f'{data_version}/count?' + canonical_query(
+            params, ignore=('compress', 'count_only', 'column_selection') + pagination.PAGE_PARAMETERS)
+        cache_key = 'cdm_count:' + hashlib.sha1(count_query.encode('utf-8')).hexdigest()
+
+        result = cache.get(cache_key)
+
+        if result is None:
+            try:
+                counts, estimated = QueryManager(data_version, self._reqid, selection=selection).run_count(params)
+            except Exception as exc:
+                log.warning(f'[ERROR] Failed with exception: {exc}')
+                return HttpResponse(f'Exception raised when running query: {str(exc)}', status=400)
+
+            result = {'total': sum(counts.values()), 'counts': counts, 'estimated': estimated}
+            cache.set(cache_key, result, getattr(settings, 'COUNT_CACHE_TIMEOUT', 600))
+
+        if head:
+            response = HttpResponse(content_type='application/json')
+        else:
+            response = HttpResponse(json.dumps(result), content_type='application/json')
+
+        response['X-Row-Count'] = result['total']
+        response['X-Row-Count-Estimated'] = str(result['estimated']).lower()
+        return response
+
+    def _run_query(self, qm, params):
+        "Returns tuple of: (results_data_frame, data_policy_text)"
+        return qm.run_query(params)
+
+    def _build_response(self, params, data, data_version, data_policy_text='', compress=True):
+        log_time(f'{self._reqid}::START_BUILD_RESPONSE')
 
         # Check valid combination of arguments
         if data_policy_text and not compress:
-            return HttpResponse('Cannot return a data policy info to uncompressed response.')
+            return HttpResponse('Cannot return a data policy info to uncompressed response.', status=400)
+
+        processes = getattr(settings, 'SERIALISE_PROCESSES', 1)
+        min_rows = getattr(settings, 'SERIALISE_PARALLEL_MIN_ROWS', DEFAULT_SERIALISE_PARALLEL_MIN_ROWS)
+
+        if processes > 1 and len(data) >= min_rows:
+            return self._build_parallel_response(params, data, data_version, data_policy_text,
+                                                 compress, processes)
 
-        file_namer = OutputFileNamer(data_version, request.GET)
+        data = data.to_csv(index=False)
+
+        file_namer = OutputFileNamer(data_version, params, content=self.output_content)
         zip_name = file_namer.get_zip_name()
 
         if compress: 
@@ -103,6 +289,7 @@ class SelectView(View):
         else:
             content_type = "text/csv"
             response_file_name = file_namer.get_csv_name()
+            zipped_bytes = data
 
         response = HttpResponse(zipped_bytes, content_type=content_type)
         content_disposition = f'attachment; filename="{zip_name}"'
@@ -112,6 +299,37 @@ class SelectView(View):
 
         return response
 
+    def _build_parallel_response(self, params, data, data_version, data_policy_text, compress, processes):
+        """
+        As `_build_response`, for large results: the CSV is formatted (and compressed) in
+        chunks of SERIALISE_CHUNK_ROWS rows by `processes` worker processes, and streamed.
+        """
+        file_namer = OutputFileNamer(data_version, params, content=self.output_content)
+        chunk_rows = getattr(settings, 'SERIALISE_CHUNK_ROWS', serialise.DEFAULT_CHUNK_ROWS)
+
+        log.warning(f'Serialising {len(data)} rows with {processes} processes.')
+
+        if compress:
+            content_type = "application/x-zip-compressed"
+            response_file_name = file_namer.get_zip_name()
+
+            policy_file = (file_namer.get_policy_name(), data_policy_text.encode('utf-8'))
+
+            # Always with zip64 records, as the size of the CSV is not known in advance
+            chunks = serialise.iter_zip_parallel(file_namer.get_csv_name(), data, [policy_file], processes,
+                                                 chunk_rows=chunk_rows)
+        else:
+            content_type = "text/csv"
+            response_file_name = file_namer.get_csv_name()
+            chunks = serialise.iter_csv_parallel(data, processes, chunk_rows=chunk_rows)
+
+        response = StreamingHttpResponse(chunks, content_type=content_type)
+        response["Content-Disposition"] = f'attachment; filename="{response_file_name}"'
+
+        log_time(f'{self._reqid}::END_BUILD_RESPONSE')
+
+        return response
+
     def _get_zipped_response(self, file_pairs):
 
         file_like_object = BytesIO()
@@ -128,13 +346,153 @@ class SelectView(View):
 
 
 
+class AggregateView(SelectView):
+    """
+    Takes the same parameters as SelectView, plus:
+      - group_by:   any of: station, day, month (default: station)
+      - statistics: any of: count, mean, min, max, sum, stddev (default: count, mean, min, max)
+    Returns summary statistics of the observation values per group and variable,
+    computed in the database, packaged in the same way as a select.
+    """
+
+    output_content = 'agg'
+
+    def _run_query(self, qm, params):
+        return qm.run_aggregate(params)
+
+
+def get_tile_params(qdict):
+    """
+    Returns a copy of the parameters of a tile request with the defaults set: all
+    intended uses and, without a "time" selection, all months of the year, all days
+    (for daily and sub-daily data) and all hours (for sub-daily data).
+    """
+    params = qdict.copy()
+    if not params.get('intended_use'):
+        params['intended_use'] = 'open,non_commercial'
+
+    if not params.get('time'):
+        defaults = [('month', 1, 12)]
+
+        if params.get('frequency') in ('daily', 'sub_daily'):
+            defaults.append(('day', 1, 31))
+
+        if params.get('frequency') == 'sub_daily':
+            defaults.append(('hour', 0, 23))
+
+        for name, first, last in defaults:
+            if not params.get(name):
+                params[name] = ','.join([f'{_:02d}' for _ in range(first, last + 1)])
+
+    return params
+
+
+class TilesView(View):
+    """
+    Returns a Mapbox vector tile (at `z`/`x`/`y`) of the locations of the observations
+    matching the selection parameters, for map previews. Each feature has the `count`
+    of observations and number of `stations` at that point. Points are clustered at
+    low zoom levels. "intended_use" defaults to all data policies and, if only "year"
+    is given, the time selection defaults to the whole year (see `get_tile_params`).
+
+    Tiles are cached (for TILE_CACHE_TIMEOUT seconds) by data version, selection and tile.
+    """
+
+    content_type = 'application/vnd.mapbox-vector-tile'
+
+    def get(self, request, z, x, y, data_version=None):
+        reqid = uuid.uuid4()
+        data_version = validate_data_version(data_version)
+
+        params = get_tile_params(request.GET)
+
+        timeout = getattr(settings, 'TILE_CACHE_TIMEOUT', 3600)
+        selection = f'{data_version}/tiles/{z}/{x}/{y}?' + canonical_query(params)
+        cache_key = 'cdm_tile:' + hashlib.sha1(selection.encode('utf-8')).hexdigest()
+
+        tile = cache.get(cache_key)
+
+        if tile is None:
+            try:
+                tile = QueryManager(data_version, reqid).run_tile(params, z, x, y)
+            except Exception as exc:
+                log.warning(f'[ERROR] Failed with exception: {exc}')
+                return HttpResponse(f'Exception raised when running query: {str(exc)}', status=400)
+
+            cache.set(cache_key, tile, timeout)
+
+        response = HttpResponse(tile, content_type=self.content_type)
+        response['Cache-Control'] = f'public, max-age={timeout}'
+        return response
+
+
+class InventoryView(View):
+    """
+    Returns (as JSON) the inventory of which stations report which variables in which
+    months, with the number of observations, first/last times and station locations.
+    Served from the inventory tables (see the "build_inventory" management command).
+
+    Takes: domain, frequency, year (required) and, optionally: variable, month,
+    station and a spatial selection (bbox, polygon or point/radius).
+    """
+
+    def get(self, request, data_version=None):
+        reqid = uuid.uuid4()
+        data_version = validate_data_version(data_version)
+
+        try:
+            records = QueryManager(data_version, reqid).run_inventory(request.GET)
+        except Exception as exc:
+            log.warning(f'[ERROR] Failed with exception: {exc}')
+            return HttpResponse(f'Exception raised when running query: {str(exc)}', status=400)
+
+        return HttpResponse(json.dumps(records), content_type='application/json')
+
+
 # noinspection SqlDialectInspection
 class QueryManager(object):
 
-    def __init__(self, data_version, reqid, conn_str=settings.LOCAL_CONN_STR):
+    BASIC_METADATA_COLUMNS = ['observation_id', 'date_time', 'observation_duration', 'longitude',
+                              'latitude', 'height_above_surface', 'observed_variable', 'units',
+                              'observation_value', 'value_significance', 'primary_station_id',
+                              'station_name', 'quality_flag', 'source_id']
+
+    def __init__(self, data_version, reqid, selection=None):
         self._data_version = data_version
         self._reqid = reqid
-        self._conn = psycopg2.connect(conn_str)
+        self._conn = None
+        self.next_page_token = None
+
+        # The parsed request (a `SelectRequest`), if the view has parsed it already
+        self._selection = selection
+
+        # Connections that queries are running on, so they can be cancelled
+        self._running = {}
+        self._running_lock = threading.Lock()
+        self._cancelled = False
+
+    def cancel(self):
+        "Cancels the queries of the request that are running, and any that would start later."
+        with self._running_lock:
+            self._cancelled = True
+
+            for conn in self._running.values():
+                conn.cancel()
+
+    @contextmanager
+    def _track(self, conn):
+        "Registers `conn` as running a query of the request, so `cancel` can stop it."
+        with self._running_lock:
+            if self._cancelled:
+                raise Exception('The request was cancelled.')
+
+            self._running[id(conn)] = conn
+
+        try:
+            yield conn
+        finally:
+            with self._running_lock:
+                del self._running[id(conn)]
 
     def _get_data_policy_text(self, results):
         """
@@ -151,44 +509,231 @@ class QueryManager(object):
         return get_data_policies(results, rendered=True)
 
     def run_query(self, kwargs):
-        "Returns tuple of: (results_data_frame, data_policy_text)"
-        log.warn(f'kwargs: {kwargs}')
-        self._validate_request(kwargs)        
+        """
+        Returns tuple of: (results_data_frame, data_policy_text)
+        For paginated requests, `self.next_page_token` is set if there is another page.
+        Other requests use the slice cache, if it is enabled (see `slice_cache.py`).
+        """
+        log.debug('kwargs: %s', kwargs)
+        cache = slice_cache.get_cache()
 
-        dfs = []
+        if cache and not any([_ in kwargs for _ in pagination.PAGE_PARAMETERS]):
+            return self._run_cached_query(cache, kwargs)
 
-        sql_manager = SQLManager(self._data_version)
+        dfs, page_size = self._extract_frames(kwargs)
+        return self._finish_query(kwargs, dfs, page_size)
 
-        log_time(f'{self._reqid}::START_SQL')
- 
-        for sql_query in [sql_manager._generate_queries(kwargs)]:
-            log.warn(f'RUNNING SQL: {sql_query}')
+    def _run_cached_query(self, cache, kwargs):
+        """
+        As `run_query`, with the slice of the request read from (or extracted, for all
+        intended uses, and written to) `cache`. The licence filter is then applied.
+        """
+        selection = self._validate_request(kwargs)
+
+        key = slice_cache.get_key(self._data_version, kwargs)
+        columns = None
+
+        if kwargs.get('column_selection', None) == 'basic_metadata':
+            columns = self.BASIC_METADATA_COLUMNS + ['data_policy_licence']
+
+        df = cache.get(key, columns=columns)
+
+        if df is None:
+            slice_kwargs = kwargs.copy()
+            slice_kwargs.setlist('intended_use', list(slice_cache.ALL_INTENDED_USES))
+
+            # Only the (valid) intended use differs, so the request is not parsed again
+            self._selection = selection._replace(intended_use=list(slice_cache.ALL_INTENDED_USES),
+                                                 params=slice_kwargs)
 
             try:
-                df = pd.read_sql(sql_query, self._conn)
-                log.warn(f'SUCCESS: Extracted a DataFrame of length: {len(df)}')
-            except Exception:
-                log.warn(f'FAILED: Error when extracting data! - query: {sql_query}')
-                continue
+                dfs, _ = self._extract_frames(slice_kwargs)
+            except limits.RequestTooLarge:
+                dfs = None
+            finally:
+                self._selection = selection
+
+            if dfs is None:
+                log.info('Slice is too large for the budget, extracting the request only.')
+                dfs, page_size = self._extract_frames(kwargs)
+                return self._finish_query(kwargs, dfs, page_size)
+
+            # Empty results, or results with missing partitions, are not cached
+            if not dfs or any([_ is None for _ in dfs]):
+                return self._finish_query(kwargs, [self._filter_licences(kwargs, _) for _ in dfs if _ is not None])
+
+            df = concat_frames(dfs)
+
+            try:
+                cache.put(key, df)
+            except Exception as exc:
+                log.warning(f'Failed to write slice to cache: {key}: {exc}')
+        else:
+            log.info('Using cached slice: %s', key)
+
+        return self._finish_query(kwargs, [self._filter_licences(kwargs, df)])
+
+    def _filter_licences(self, kwargs, df):
+        "Returns the rows of a slice `df` that are licensed for the intended use of the request."
+        intended_use = self._validate_request(kwargs).intended_use
+        licences = SQLManager(self._data_version)._get_data_policy_licence(intended_use)
+        return df[df['data_policy_licence'].isin(licences)].reset_index(drop=True)
+
+    def _extract_frames(self, kwargs):
+        """
+        Runs the queries of the request and returns a tuple of: (dfs, page_size), where
+        `dfs` is the list of DataFrames extracted by each query (None if its partition
+        does not exist). Raises an Exception if any query fails.
+        """
+        sql_manager, budget, page_size, queries = self._plan_query(kwargs)
+
+        if not queries:
+            return [], page_size
+
+        stations = sql_manager._get_request(kwargs).stations
+        uses_station_table = sql_manager.needs_station_table(stations)
+        parallelism = min(len(queries), getattr(settings, 'QUERY_PARALLELISM', 4))
 
-            dfs.append(df)
+        # Rows/bytes extracted by each query so far, so the budget applies to the whole request
+        progress = {}
+        progress_lock = threading.Lock()
+
+        def get_check(index):
+            def check(n_rows, n_bytes):
+                with progress_lock:
+                    progress[index] = (n_rows, n_bytes)
+                    total_rows = sum([_[0] for _ in progress.values()])
+                    total_bytes = sum([_[1] for _ in progress.values()])
+
+                self._check_budget(budget, kwargs, total_rows, total_bytes)
+            return check
+
+        def extract(index, query):
+            # Each parallel query runs on its own connection
+            with pooled_connection() as conn, self._track(conn):
+                self._prepare_connection(conn, stations, uses_station_table, sql_manager.STATION_TABLE)
+                return self._extract(conn, kwargs, query, get_check(index), uses_station_table)
+
+        log_time(f'{self._reqid}::START_SQL')
+
+        if parallelism > 1:
+            log.warning(f'Running {len(queries)} split queries, {parallelism} at a time.')
+
+            with ThreadPoolExecutor(max_workers=parallelism) as executor:
+                # Each query runs in a copy of the context, so its log records keep the request ID
+                futures = [executor.submit(contextvars.copy_context().run, extract, index, query)
+                           for index, query in enumerate(queries)]
+
+                try:
+                    # Results are kept in the order of the queries
+                    dfs = [_.result() for _ in futures]
+                except Exception:
+                    for future in futures:
+                        future.cancel()
+
+                    # Stop the queries that have started, rather than wait for them to finish
+                    self.cancel()
+                    raise
+        else:
+            with pooled_connection() as conn, self._track(conn):
+                self._conn = conn
+                self._prepare_connection(conn, stations, uses_station_table, sql_manager.STATION_TABLE)
+
+                dfs = [self._extract(conn, kwargs, query, get_check(index), uses_station_table)
+                       for index, query in enumerate(queries)]
 
         log_time(f'{self._reqid}::END_SQL')
 
+        return dfs, page_size
+
+    def _prepare_connection(self, conn, stations, uses_station_table, station_table):
+        if query_log.is_enabled():
+            query_log.configure_auto_explain(conn)
+
+        if uses_station_table:
+            self._load_station_table(stations, station_table, conn=conn)
+
+    def _extract(self, conn, kwargs, query, check, uses_station_table):
+        """
+        Returns a DataFrame of the results of `query` on `conn`, or None if its partition
+        does not exist. Raises `RequestTooLarge` if `check` finds the budget is exceeded,
+        or an Exception if the query fails (so that no partial results are returned).
+        """
+        log.debug('Running SQL: %s | params: %s', query.sql, query.params)
+
+        try:
+            start = time.time()
+            chunksize = getattr(settings, 'QUERY_CHUNK_SIZE', 50000)
+            df = read_frame(conn, query.sql, params=query.params, chunksize=chunksize, check=check)
+            log.info('Extracted a DataFrame of length: %d', len(df), extra={'rows': len(df)})
+        except limits.RequestTooLarge as exc:
+            log.warning(f'ABORTED: Request too large - {exc}')
+            raise
+        except psycopg2.errors.UndefinedTable:
+            log.warning(f'No partition found for query: {query.sql}')
+            conn.rollback()
+            return None
+        except Exception as exc:
+            log.warning(f'FAILED: Error when extracting data! - query: {query.sql} - {exc}')
+            raise Exception('Error when extracting data from the database.') from exc
+
+        query_log.record_query(self._reqid, canonical_query(kwargs), query, time.time() - start,
+                               rows=len(df), replayable=not uses_station_table)
+        return df
+
+    def _plan_query(self, kwargs):
+        """
+        Validates the request and returns a tuple of: (sql_manager, budget, page_size, queries)
+        where `queries` is the list of `Query` objects to extract the results.
+        """
+        selection = self._validate_request(kwargs)
+
+        sql_manager = SQLManager(self._data_version, selection=selection)
+
+        budget = limits.get_limits(kwargs['domain'], kwargs['frequency'])
+
+        # Keyset pagination: fetch one extra row to find out if there is another page
+        page_size = pagination.get_page_size(kwargs, budget.max_rows)
+        page_after = pagination.decode_token(kwargs)
+
+        if page_size:
+            limit = page_size + 1
+        else:
+            # Probe with LIMIT max_rows + 1, so the database stops as soon as the budget is exceeded
+            limit = budget.max_rows + 1 if budget.max_rows is not None else None
+
+        split = getattr(settings, 'QUERY_SPLIT', None)
 
+        # Paginated requests need a single ordered query
+        if split and not page_size:
+            queries = sql_manager._generate_split_queries(kwargs, split, limit=limit)
+        else:
+            queries = [sql_manager._generate_queries(kwargs, limit=limit, keyset=bool(page_size), after=page_after)]
+
+        # Partitions that do not exist have no results (e.g. a year before any sub-daily data)
+        missing = set([_.partition for _ in queries if not warmup.has_partition(self._data_version, _.partition)])
+        if missing:
+            log.info(f'Skipping queries on missing partitions: {sorted(missing)}')
+            queries = [_ for _ in queries if _.partition not in missing]
+
+        return sql_manager, budget, page_size, queries
+
+    def _finish_query(self, kwargs, dfs, page_size=None):
+        """
+        Returns tuple of: (results_data_frame, data_policy_text) from the list of
+        DataFrames extracted, `dfs`: concatenated, paged, with the requested columns
+        and with values mapped.
+        """
         all_columns = ['observation_id', 'data_policy_licence', 'date_time', 'date_time_meaning', 
                        'observation_duration', 'longitude', 'latitude', 'report_type', 
                        'height_above_surface', 'observed_variable', 'units', 'observation_value', 
                        'value_significance', 'platform_type', 'station_type', 'primary_station_id', 
                        'station_name', 'quality_flag', 'source_id', 'location']
 
-        basic_metadata_columns = ['observation_id', 'date_time', 'observation_duration', 'longitude',
-                                  'latitude', 'height_above_surface', 'observed_variable', 'units',
-                                  'observation_value', 'value_significance', 'primary_station_id',
-                                  'station_name', 'quality_flag', 'source_id']
-
         log_time(f'{self._reqid}::START_MODIFY_DATAFRAMES')
 
+        dfs = [_ for _ in dfs if _ is not None]
+
         if not dfs:
             # If no data has been found (or no valid tables for date range)
             # Create empty DataFrame with required headers
@@ -198,17 +743,22 @@ class QueryManager(object):
         if len(dfs) == 1:
             df = dfs[0]
         else:
-            df = pd.concat(dfs)
+            df = concat_frames(dfs)
+
+        if page_size and len(df) > page_size:
+            df = df.iloc[:page_size]
+            last = df.iloc[-1]
+            self.next_page_token = pagination.encode_token(kwargs, last['date_time'], last['observation_id'])
 
         log_time(f'Columns in dataframe: {df.columns}')
         # Filter the columns if only basic metadata requested
         if kwargs.get('column_selection', None) == 'basic_metadata':
-            df = df[basic_metadata_columns]
+            df = df[self.BASIC_METADATA_COLUMNS]
 
         else:
             # Only drop "location" and "date" columns when extended metadata required
             # These are only used internally
-            df = df.drop(columns=['location', 'date'])
+            df = df.drop(columns=['location', 'date'], errors='ignore')
 
         log_time(f'{self._reqid}::END_MODIFY_DATAFRAMES')
 
@@ -227,15 +777,206 @@ class QueryManager(object):
         self._map_values(df)
         log_time(f'{self._reqid}::END_MAP_VALUES')
 
+        self._log_memory_usage(df)
+
         # df.to_csv('out.csv', sep=',', index=False, float_format='%.3f',
         #           date_format='%Y-%m-%d %H:%M:%S%z')
         return df, data_policy_text
 
+    def _log_memory_usage(self, df):
+        "Logs the size of the results and the (current and peak) RSS of the worker."
+        rss, peak_rss = get_memory_usage()
+        frame_size = df.memory_usage(deep=True).sum() / 1024. ** 2
+        rss = f'{rss:.1f}' if rss is not None else '-'
+
+        log.warning(f'[MEMORY] {self._reqid} | rows: {len(df)} | frame: {frame_size:.1f} MB | '
+                 f'rss: {rss} MB | peak rss: {peak_rss:.1f} MB')
+
+    def run_aggregate(self, kwargs):
+        "Returns tuple of: (aggregated_data_frame, data_policy_text)"
+        log.debug('kwargs: %s', kwargs)
+        selection = self._validate_request(kwargs)
+
+        sql_manager = SQLManager(self._data_version, selection=selection)
+        query = sql_manager._generate_aggregate_query(kwargs)
+        stations = selection.stations
+        uses_station_table = sql_manager.needs_station_table(stations)
+
+        log_time(f'{self._reqid}::START_SQL')
+
+        with pooled_connection() as conn:
+            self._conn = conn
+
+            if uses_station_table:
+                self._load_station_table(stations, sql_manager.STATION_TABLE)
+
+            log.debug('Running SQL: %s | params: %s', query.sql, query.params)
+            start = time.time()
+            df = read_frame(self._conn, query.sql, params=query.params)
+
+            query_log.record_query(self._reqid, canonical_query(kwargs), query, time.time() - start,
+                                   rows=len(df), replayable=not uses_station_table)
+
+        log_time(f'{self._reqid}::END_SQL')
+
+        # Build a (small) frame of the sources and nations found, to get the data policy
+        sources = set([_ for ids in df['source_ids'] for _ in ids])
+        countries = set([_ for ids in df['country_ids'] for _ in ids])
+        policy_df = pd.DataFrame(list(itertools.product(sources, countries)),
+                                 columns=['source_id', 'observation_id'])
+
+        data_policy_text = self._get_data_policy_text(policy_df)
+
+        df = df.drop(columns=['source_ids', 'country_ids'])
+
+        for statistic in sql_manager.AGGREGATE_STATISTICS:
+            if statistic in df:
+                df[statistic] = pd.to_numeric(df[statistic])
+
+        self._map_values(df)
+        return df, data_policy_text
+
+    def run_count(self, kwargs):
+        """
+        Returns a tuple of: (dictionary of row counts per variable, estimated).
+        The counts are exact unless counting takes longer than COUNT_TIMEOUT seconds,
+        in which case the query planner's estimates are returned.
+        """
+        selection = self._validate_request(kwargs)
+
+        sql_manager = SQLManager(self._data_version, selection=selection)
+        query = sql_manager._generate_count_query(kwargs)
+        stations = selection.stations
+        variables = wfs_mappings['variable']['fields']
+        names = dict([(int(code), name) for name, code in variables.items()])
+
+        with pooled_connection() as conn:
+            self._conn = conn
+
+            if sql_manager.needs_station_table(stations):
+                self._load_station_table(stations, sql_manager.STATION_TABLE)
+
+            counts = dict([(_, 0) for _ in selection.variables])
+            timeout = getattr(settings, 'COUNT_TIMEOUT', 5)
+
+            with self._conn.cursor() as cursor:
+                cursor.execute("SAVEPOINT count_rows;")
+                cursor.execute("SET LOCAL statement_timeout = %s;", [int(timeout * 1000)])
+
+                try:
+                    log.debug('Running SQL: %s | params: %s', query.sql, query.params)
+                    cursor.execute(prepare(self._conn, query.sql, query.params), query.params)
+
+                    for code, count in cursor.fetchall():
+                        counts[names.get(code, str(code))] = count
+
+                    return counts, False
+                except psycopg2.extensions.QueryCanceledError:
+                    log.warning(f'Count took longer than {timeout}s, using estimates.')
+                    cursor.execute("ROLLBACK TO SAVEPOINT count_rows;")
+
+                for variable, estimate_query in sql_manager._generate_count_estimate_queries(kwargs):
+                    cursor.execute(estimate_query.sql, estimate_query.params)
+                    counts[variable] = cursor.fetchone()[0][0]['Plan']['Plan Rows']
+
+            return counts, True
+
+    def run_inventory(self, kwargs):
+        "Returns a list of inventory records (dictionaries) for the selection in `kwargs`."
+        for param in ('domain', 'frequency'):
+            if param not in kwargs:
+                raise KeyError(f'Input parameter "{param}" must be provided.')
+
+        sql_manager = SQLManager(self._data_version)
+        query = sql_manager._generate_inventory_query(kwargs)
+        stations = sql_manager._get_stations(kwargs)
+        names = dict([(int(code), name) for name, code in wfs_mappings['variable']['fields'].items()])
+
+        with pooled_connection() as conn:
+            self._conn = conn
+
+            if sql_manager.needs_station_table(stations):
+                self._load_station_table(stations, sql_manager.STATION_TABLE)
+
+            log.debug('Running SQL: %s | params: %s', query.sql, query.params)
+
+            with self._conn.cursor() as cursor:
+                try:
+                    cursor.execute(prepare(self._conn, query.sql, query.params), query.params)
+                except psycopg2.errors.UndefinedTable:
+                    raise Exception('No inventory is available for the requested domain, frequency and year.')
+
+                columns = [_.name for _ in cursor.description]
+                rows = cursor.fetchall()
+
+        records = []
+        for row in rows:
+            record = dict(zip(columns, row))
+            record['observed_variable'] = names.get(record['observed_variable'], record['observed_variable'])
+
+            for key in ('month', 'first_date_time', 'last_date_time'):
+                if record[key] is not None:
+                    record[key] = record[key].isoformat()
+
+            records.append(record)
+
+        return records
+
+    def run_tile(self, kwargs, z, x, y):
+        "Returns the bytes of the vector tile at `z`/`x`/`y` for the selection in `kwargs`."
+        selection = self._validate_request(kwargs)
+
+        sql_manager = SQLManager(self._data_version, selection=selection)
+        query = sql_manager._generate_tile_query(kwargs, z, x, y)
+        stations = selection.stations
+        uses_station_table = sql_manager.needs_station_table(stations)
+
+        with pooled_connection() as conn:
+            self._conn = conn
+
+            if uses_station_table:
+                self._load_station_table(stations, sql_manager.STATION_TABLE)
+
+            log.debug('Running SQL: %s | params: %s', query.sql, query.params)
+            start = time.time()
+
+            with self._conn.cursor() as cursor:
+                cursor.execute(prepare(self._conn, query.sql, query.params), query.params)
+                tile = bytes(cursor.fetchone()[0] or b'')
+
+            query_log.record_query(self._reqid, canonical_query(kwargs), query, time.time() - start,
+                                   replayable=not uses_station_table)
+
+        return tile
+
+    def _check_budget(self, budget, kwargs, n_rows, n_bytes):
+        "Raises `RequestTooLarge` if `n_rows` or `n_bytes` exceed the `budget`."
+        if budget.max_rows is not None and n_rows > budget.max_rows:
+            raise limits.rows_exceeded(budget.max_rows, kwargs['domain'], kwargs['frequency'])
+
+        if budget.max_bytes is not None and n_bytes > budget.max_bytes:
+            raise limits.bytes_exceeded(budget.max_bytes, kwargs['domain'], kwargs['frequency'])
+
+    def _load_station_table(self, stations, table, conn=None):
+        """
+        Loads a (large) list of stations into a temporary table so that the
+        select can join on it, instead of using a huge IN (...) literal.
+        The table is dropped at the end of the transaction.
+        """
+        log.warning(f'Loading {len(stations)} stations into temporary table: {table}')
+
+        with (conn or self._conn).cursor() as cursor:
+            cursor.execute(f"CREATE TEMPORARY TABLE IF NOT EXISTS {table} "
+                           "(primary_station_id text PRIMARY KEY) ON COMMIT DROP;")
+            cursor.execute(f"TRUNCATE {table};")
+            cursor.copy_from(io.StringIO('\n'.join(stations)), table, columns=('primary_station_id',))
+            cursor.execute(f"ANALYZE {table};")
+
     def _map_values(self, df):
 
 #        df_test = df.copy(deep=True)
         mappers = _get_mappers()
-        df.replace(dict(mappers), inplace=True)
+        map_categories(df, mappers)
 
 #        found_cols = [_ for _ in df.columns]
 #        df_test.replace(dict(mappers), inplace=True)
@@ -249,25 +990,147 @@ class QueryManager(object):
 
 
     def _validate_request(self, kwargs):
-        required = ['domain', 'frequency', 'variable']
+        """
+        Returns the `SelectRequest` parsed from `kwargs`, raising an Exception if it is invalid.
+        Requests are only parsed once: `kwargs` is usually the params of a parsed request.
+        """
+        if self._selection is None or self._selection.params is not kwargs:
+            self._selection = parse_request(kwargs, self._data_version)
 
-        for param in required:
-            if param not in kwargs:
-                msg = f'Input parameter "{param}" must be provided.'
-                log.warn(msg)
-                raise KeyError(msg)
+        return self._selection
+
+
+class BatchQueryManager(QueryManager):
+    "As `QueryManager`, returning the data policies unrendered, to be merged across a batch."
 
-        # Check either 'time' or 'year' provided
-        if 'time' not in kwargs and ('year' not in kwargs or 'month' not in kwargs):
-            raise Exception('Either "time" or time compoonents must be provided.')
+    def _get_data_policy_text(self, results):
+        return get_data_policies(results, rendered=False)
+
+
+@method_decorator(csrf_exempt, name='dispatch')
+class BatchSelectView(View):
+    """
+    Runs many selections in one request. POST a JSON object of:
+      {"selections": [{"domain": "land", "frequency": "monthly", "variable": ["..."], ...}, ...]}
+    where each selection takes the same parameters as SelectView (values as strings or lists).
+
+    All selections are validated before any is run, then run on the pooled connections,
+    up to BATCH_PARALLELISM at a time. Returns a single streamed zip file with one CSV
+    file per selection (numbered in order) and a merged data policy file. Selections
+    that fail (including any over the row budget) are listed in "errors.txt" in the zip
+    file. Selections cannot be paged.
+    """
+
+    def post(self, request, data_version=None):
+        reqid = uuid.uuid4()
+        request_logging.set_request_id(reqid)
+        data_version = validate_data_version(data_version)
 
-        allowed_domains = ('marine', 'land')
-        if kwargs['domain'] not in allowed_domains:
-            raise Exception(f'"domain" must be one of: {allowed_domains}')
+        try:
+            selections = self._parse_selections(request.body)
+
+            # Validate (and plan) all selections up front
+            for index, params in enumerate(selections):
+                try:
+                    # All rows of a selection are returned: a page would be silently truncated
+                    if any([_ in params for _ in pagination.PAGE_PARAMETERS]):
+                        raise Exception('Page parameters ("page_size", "page_token") are not '
+                                        'supported in batch selections.')
+
+                    selections[index] = selection = parse_request(params, data_version)
+                    QueryManager(data_version, reqid, selection=selection)._plan_query(selection.params)
+                except Exception as exc:
+                    raise Exception(f'Selection {index + 1}: {exc}')
+        except Exception as exc:
+            log.warning(f'[ERROR] Failed with exception: {exc}')
+            return HttpResponse(f'Exception raised when running query: {str(exc)}', status=400)
+
+        log.info('Running batch of %d selections.', len(selections), extra={'selections': len(selections)})
+
+        files = self._iter_files(selections, data_version, reqid)
+        response = StreamingHttpResponse(iter_zip(files), content_type="application/x-zip-compressed")
+        response["Content-Disposition"] = f'attachment; filename="batch_{reqid.hex[:8]}_{data_version}.zip"'
+
+        return response
+
+    def _parse_selections(self, body):
+        "Returns the list of selections in the JSON `body`, as QueryDicts."
+        try:
+            selections = json.loads(body)['selections']
+        except Exception:
+            raise Exception('Request body must be a JSON object with a "selections" list.')
 
-        allowed_frequencies = ('monthly', 'daily', 'sub_daily')
-        if kwargs['frequency'] not in allowed_frequencies:
-            raise Exception(f'Incorrect value for "frequency". Must be one of: {allowed_frequencies}.')
+        max_selections = getattr(settings, 'BATCH_MAX_SELECTIONS', 500)
+
+        if not isinstance(selections, list) or not selections:
+            raise Exception('"selections" must be a non-empty list.')
+
+        if len(selections) > max_selections:
+            raise Exception(f'Too many selections: {len(selections)} (the maximum is {max_selections}).')
+
+        resp = []
+
+        for selection in selections:
+            params = QueryDict(mutable=True)
+
+            for key, value in selection.items():
+                values = value if isinstance(value, list) else [value]
+                params.setlist(key, [str(_) for _ in values])
+
+            resp.append(params)
+
+        return resp
+
+    def _iter_files(self, selections, data_version, reqid):
+        """
+        Yields (file name, iterable of bytes) pairs for the zip file, running up to
+        BATCH_PARALLELISM `selections` (parsed `SelectRequest`s) ahead of the one being written.
+        """
+        parallelism = getattr(settings, 'BATCH_PARALLELISM', 4)
+        executor = ThreadPoolExecutor(max_workers=parallelism, thread_name_prefix='cdm-lens-batch')
+
+        # Query managers of the selections submitted, so their queries can be cancelled
+        managers = {}
+
+        def submit(index):
+            selection = selections[index]
+            qm = managers[index] = BatchQueryManager(data_version, f'{reqid}-{index + 1}', selection=selection)
+            return executor.submit(contextvars.copy_context().run, qm.run_query, selection.params)
+
+        pending = [submit(index) for index in range(min(parallelism, len(selections)))]
+        policies = []
+        errors = []
+
+        try:
+            for index, selection in enumerate(selections):
+                future = pending.pop(0)
+
+                if index + len(pending) + 1 < len(selections):
+                    pending.append(submit(index + len(pending) + 1))
+
+                try:
+                    df, data_policies = future.result()
+                except Exception as exc:
+                    log.warning(f'[ERROR] Selection {index + 1} failed with exception: {exc}')
+                    errors.append(f'Selection {index + 1}: {exc}')
+                    continue
+                finally:
+                    del managers[index]
+
+                policies.append(data_policies)
+                csv_name = OutputFileNamer(data_version, selection.params).get_csv_name()
+                yield f'{index + 1:03d}_{csv_name}', iter_csv(df)
+        finally:
+            # If the client disconnected, stop the selections that are still running
+            executor.shutdown(wait=False, cancel_futures=True)
+
+            for qm in managers.values():
+                qm.cancel()
+
+        yield f'data-policy_{data_version}.txt', [merge_data_policies(policies).encode('utf-8')]
+
+        if errors:
+            yield 'errors.txt', ['\n'.join(errors).encode('utf-8') + b'\n']
 
 
 class QueryView(View):
@@ -397,19 +1260,34 @@ def _insert_underscores(s):
     return s.replace(' ', '_')
 
 
-def _get_mappers():
-    mappers = []
+_mappers = None
+_mappers_lock = threading.Lock()
 
-    for column, (code_table, index_field, desc_field) in mapper_data.items(): 
 
-        processor = None
-        if column == 'observed_variable':
-            processor = _insert_underscores  
+def _get_mappers():
+    """
+    Returns a list of (column, mapper) for all code tables. The code tables are
+    read once per process (on a single pooled connection) and then cached.
+    """
+    global _mappers
+
+    with _mappers_lock:
+        if _mappers is None:
+            mappers = []
+
+            with pooled_connection() as conn:
+                for column, (code_table, index_field, desc_field) in mapper_data.items(): 
+
+                    processor = None
+                    if column == 'observed_variable':
+                        processor = _insert_underscores  
  
-        mapper = _get_mapper(code_table, index_field, desc_field, processor=processor)
-        mappers.append((column, mapper))
+                    mapper = _get_mapper(code_table, index_field, desc_field, processor=processor, conn=conn)
+                    mappers.append((column, mapper))
+
+            _mappers = mappers
 
-    return mappers
+    return _mappers
  
 
 def _get_mapper(code_table, index_field, desc_field, processor=None, conn=None):
@@ -545,32 +1423,6 @@ def _get_mapper(code_table, index_field, desc_field, processor=None, conn=None):
 #         return cql.strip()
 
 
-class ConstraintsView(View):
-
-    def get(self, request, data_version, domain):
-
-        log.warn(f'Requested constraints for: {domain}')
-        domain = domain.lower()
-
-        data_version = validate_data_version(data_version) 
-
-        if domain not in ('land', 'marine'):
-            return HttpResponse('Domain must be one of: "land", "marine".', status=400)
-
-        content_type = "application/json"
-        response_file_path = self._get_constraints_path(domain, data_version)
-        response_file_name = os.path.basename(response_file_path)
-
-        response = HttpResponse(open(response_file_path).read(), content_type=content_type)
-        content_disposition = f"attachment; filename=\"{response_file_name}\""
-        response["Content-Disposition"] = content_disposition
-
-        return response
-
-    def _get_constraints_path(self, domain, data_version):
-        return f'{settings.STATIC_ROOT}/constraints/constraints-{domain}-{data_version}.json'
-
-
 # class LayerView(QueryView):
 
 #     DEFAULT_OUTPUT_FORMAT = "csv"
@@ -0,0 +1,180 @@
+"""
+warmup.py
+=========
+
+Warm-up of a worker process at startup, so that the first requests after a
+deploy do not pay for loading tables and opening connections.
+
+The warm-up runs in a background thread (started from `AppConfig.ready`) and:
+
+  - imports the data views (with pandas and psycopg2)
+  - opens the pooled database connections
+  - reads and caches the code tables used to map values
+  - loads the data policy tables
+  - reads the constraints files
+  - loads the list of observations partitions of each data version, so that queries
+    on partitions that do not exist are skipped (see `has_partition`); the list is
+    reloaded when a partition is not in it and it is older than
+    `PARTITIONS_REFRESH_SECONDS`, so that partitions added later are queried
+
+The `/ready` endpoint reports 503 until the warm-up has succeeded (a failed
+warm-up is retried when `/ready` is polled), and `/health` reports that the
+process is alive.
+"""
+
+import threading
+import time
+
+from django.conf import settings
+
+import logging
+log = logging.getLogger(__name__)
+
+
+_lock = threading.Lock()
+_thread = None
+
+_state = {
+    'ready': False,
+    'duration': None,
+    'steps': {},
+    'errors': {},
+}
+
+# Observations partitions, per data version (loaded at warm-up), and when they were loaded
+partitions = {}
+_partitions_loaded = {}
+_partitions_lock = threading.Lock()
+
+
+def _import_modules():
+    # The data views (and pandas, psycopg2) are imported lazily by the URLs
+    import cdm_interface.views
+
+
+def _open_connections():
+    from cdm_interface.db import get_pool, pooled_connection
+
+    get_pool()
+    with pooled_connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT 1")
+
+
+def _load_code_tables():
+    from cdm_interface.views import _get_mappers
+    _get_mappers()
+
+
+def _load_policy_tables():
+    from cdm_interface.data_policies import registry
+    registry.load()
+
+
+def _load_constraints():
+    from cdm_interface import constraints
+    from cdm_interface.data_versions import DATA_VERSIONS
+
+    for data_version in DATA_VERSIONS:
+        for domain in constraints.DOMAINS:
+            constraints.read_constraints(domain, data_version)
+
+
+def _load_partitions(data_versions=None):
+    from cdm_interface.db import pooled_connection
+    from cdm_interface.data_versions import DATA_VERSIONS
+    from cdm_interface.inventory import list_partitions
+
+    with pooled_connection() as conn:
+        for data_version in data_versions or DATA_VERSIONS:
+            partitions[data_version] = frozenset(list_partitions(conn, data_version))
+            _partitions_loaded[data_version] = time.monotonic()
+
+
+def _get_refresh_seconds():
+    return getattr(settings, 'PARTITIONS_REFRESH_SECONDS', 60)
+
+
+def has_partition(data_version, partition):
+    """
+    Returns False if `partition` (of `data_version`) is known not to exist, or True if
+    it exists or the partitions have not been loaded (yet).
+
+    A partition that is not in a list older than `PARTITIONS_REFRESH_SECONDS` is looked
+    up again (if that fails, it is assumed to exist and is queried).
+    """
+    known = partitions.get(data_version)
+    if known is None or partition in known:
+        return True
+
+    with _partitions_lock:
+        age = time.monotonic() - _partitions_loaded.get(data_version, 0)
+
+        if age > _get_refresh_seconds():
+            try:
+                _load_partitions([data_version])
+            except Exception as exc:
+                log.warning(f'[WARMUP] Failed to reload the partitions of {data_version}: {exc}')
+                return True
+
+    return partition in partitions[data_version]
+
+
+STEPS = [
+    ('imports', _import_modules),
+    ('connections', _open_connections),
+    ('code_tables', _load_code_tables),
+    ('policy_tables', _load_policy_tables),
+    ('constraints', _load_constraints),
+    ('partitions', _load_partitions),
+]
+
+
+def warm_up():
+    "Runs all warm-up steps, recording the duration and any error of each."
+    start = time.time()
+    errors = {}
+
+    for name, func in STEPS:
+        step_start = time.time()
+
+        try:
+            func()
+        except Exception as exc:
+            log.warning(f'[WARMUP] Step "{name}" failed: {exc}')
+            errors[name] = str(exc)
+
+        _state['steps'][name] = round(time.time() - step_start, 3)
+
+    _state['errors'] = errors
+    _state['duration'] = round(time.time() - start, 3)
+    _state['ready'] = not errors
+
+    log.warning(f'[WARMUP] Finished in {_state["duration"]:.3f}s | ready: {_state["ready"]} | '
+                f'steps: {_state["steps"]}')
+
+
+def start():
+    "Starts the warm-up in a background thread, unless it is running or has succeeded."
+    global _thread
+
+    with _lock:
+        if _state['ready'] or (_thread is not None and _thread.is_alive()):
+            return
+
+        _thread = threading.Thread(target=warm_up, name='cdm-lens-warmup', daemon=True)
+        _thread.start()
+
+
+def is_enabled():
+    return getattr(settings, 'WARMUP_ON_START', True)
+
+
+def get_state():
+    "Returns a dictionary of the readiness of this process and details of the warm-up."
+    if not is_enabled():
+        return {'ready': True, 'warmup': 'disabled'}
+
+    state = dict(_state)
+    state['running'] = _thread is not None and _thread.is_alive()
+    return state
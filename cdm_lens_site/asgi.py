@@ -0,0 +1,20 @@
+"""
+ASGI config for cdm_lens_site project.
+
+It exposes the ASGI callable as a module-level variable named ``application``.
+Set ``ASYNC_VIEWS = True`` in the settings so that select and constraints requests
+are served by the async views, e.g. with:
+
+    uvicorn cdm_lens_site.asgi:application --workers 2
+
+For more information on this file, see
+https://docs.djangoproject.com/en/stable/howto/deployment/asgi/
+"""
+
+import os
+
+from django.core.asgi import get_asgi_application
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'cdm_lens_site.settings')
+
+application = get_asgi_application()
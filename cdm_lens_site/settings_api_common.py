@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+
+""" Lean common settings for running the site as a read-only data API.
+
+Use instead of `settings_common` (i.e. `from .settings_api_common import *` in
+`settings.py`) to drop the admin, auth, sessions and messages apps and their
+middleware, which the API does not use.
+"""
+
+__author__ = "William Tucker"
+__date__ = "2019-10-03"
+__copyright__ = "Copyright 2019 United Kingdom Research and Innovation"
+__license__ = "BSD - see LICENSE file in top-level package directory"
+
+
+from .settings_common import * #@UnusedWildImport
+
+
+INSTALLED_APPS = [
+    'django.contrib.staticfiles',
+    'cdm_interface',
+]
+
+# The API has no forms, sessions or logins, so no CSRF, session, auth or message middleware
+MIDDLEWARE = [
+    'django.middleware.security.SecurityMiddleware',
+    'django.middleware.common.CommonMiddleware',
+]
+
+ROOT_URLCONF = 'cdm_lens_site.urls_api'
+
+TEMPLATES = []
@@ -54,3 +54,30 @@ TEMPLATES = [
 ]
 
 WSGI_APPLICATION = 'cdm_lens_site.wsgi.application'
+
+# Structured (JSON) logging of the app, written by a background thread (see
+# cdm_interface/request_logging.py). Set the level per module in "loggers"; DEBUG
+# records are only kept for a sample (LOG_DEBUG_SAMPLE_RATE) of the requests.
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'formatters': {
+        'json': {'()': 'cdm_interface.request_logging.JSONFormatter'},
+    },
+    'filters': {
+        'request_id': {'()': 'cdm_interface.request_logging.RequestIdFilter'},
+        'sampling': {'()': 'cdm_interface.request_logging.SamplingFilter'},
+    },
+    'handlers': {
+        'queue': {
+            'class': 'cdm_interface.request_logging.QueueingHandler',
+            'formatter': 'json',
+            'filters': ['request_id', 'sampling'],
+        },
+    },
+    'loggers': {
+        'cdm_interface': {'handlers': ['queue'], 'level': 'INFO', 'propagate': False},
+        'cdm_interface.views': {'level': 'DEBUG'},
+        'cdm_interface.async_views': {'level': 'DEBUG'},
+    },
+}
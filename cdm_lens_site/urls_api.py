@@ -0,0 +1,14 @@
+""" URL Configuration for the site, as a data API only (without the admin). """
+
+__author__ = "William Tucker"
+__date__ = "2019-10-03"
+__copyright__ = "Copyright 2019 United Kingdom Research and Innovation"
+__license__ = "BSD - see LICENSE file in top-level directory"
+
+
+from django.urls import path, include
+
+
+urlpatterns = [
+    path('', include('cdm_interface.urls')),
+]
@@ -26,10 +26,12 @@ setup(
     packages = find_packages(),
     install_requires = [
         'django',
-        'requests',
-        'furl',
         'pandas',
     ],
+    extras_require = {
+        # For the async views, served by ASGI (see ASYNC_VIEWS)
+        'async': ['asgiref', 'psycopg>=3.1'],
+    },
     classifiers = [
         'Development Status :: 1 - Planning',
         'Intended Audience :: Science/Research',
@@ -0,0 +1,123 @@
+import io
+import json
+import threading
+import time
+import zipfile
+
+from django.conf import settings
+
+if not settings.configured:
+    settings.configure(SECRET_KEY='test-secret-key')
+
+import django
+django.setup()
+
+import pandas as pd
+from django.test import RequestFactory
+
+from cdm_interface import views
+
+
+SELECTIONS = [
+    {'domain': 'land', 'frequency': 'monthly', 'variable': ['air_temperature'], 'year': 2000, 'month': 1},
+    {'domain': 'land', 'frequency': 'monthly', 'variable': 'air_pressure', 'year': 2001, 'month': 1},
+    {'domain': 'marine', 'frequency': 'daily', 'variable': ['air_temperature'], 'year': 2002, 'month': 1},
+]
+
+
+def _post(selections):
+    request = RequestFactory().post('/select/batch/', json.dumps({'selections': selections}),
+                                    content_type='application/json')
+    return views.BatchSelectView.as_view()(request)
+
+
+def _run_query(self, params):
+    if params['year'] == '2001':
+        raise Exception('no data')
+
+    policies = {'by_source': pd.DataFrame({'source_id': [251], 'product_name': ['A']}),
+                'by_nation': pd.DataFrame(columns=['country', 'country_id'])}
+    return pd.DataFrame({'year': [params['year']]}), policies
+
+
+def test_batch_select(monkeypatch):
+    monkeypatch.setattr(views.QueryManager, '_plan_query', lambda self, params: None)
+    monkeypatch.setattr(views.BatchQueryManager, 'run_query', _run_query)
+
+    response = _post(SELECTIONS)
+    assert response.status_code == 200
+
+    zf = zipfile.ZipFile(io.BytesIO(b''.join(response.streaming_content)))
+    names = zf.namelist()
+
+    assert names[0].startswith('001_surface-land_monthly')
+    assert names[1].startswith('003_surface-marine_daily')
+    assert zf.read(names[0]) == b'year\n2000\n'
+    assert zf.read(names[1]) == b'year\n2002\n'
+
+    # Data policies are merged without duplicates
+    assert zf.read(names[2]).decode('utf-8').count('Source ID: 251') == 1
+    assert zf.read('errors.txt') == b'Selection 2: no data\n'
+
+
+def test_batch_validated_up_front(monkeypatch):
+    def plan_query(self, params):
+        if params['domain'] == 'marine':
+            raise Exception('Bad domain')
+
+    monkeypatch.setattr(views.QueryManager, '_plan_query', plan_query)
+
+    response = _post(SELECTIONS)
+    assert response.status_code == 400
+    assert b'Selection 3: Bad domain' in response.content
+
+    assert _post([]).status_code == 400
+
+
+def test_batch_rejects_page_parameters(monkeypatch):
+    monkeypatch.setattr(views.QueryManager, '_plan_query', lambda self, params: None)
+
+    response = _post(SELECTIONS[:1] + [dict(SELECTIONS[1], page_size=10)])
+    assert response.status_code == 400
+    assert b'Selection 2: Page parameters' in response.content
+
+
+class _Connection(object):
+
+    def __init__(self):
+        self.cancelled = threading.Event()
+
+    def cancel(self):
+        self.cancelled.set()
+
+
+def test_disconnect_cancels_running_selections(monkeypatch):
+    connections = []
+
+    def run_query(self, params):
+        if params['year'] == '2000':
+            return _run_query(self, params)
+
+        # Runs until cancelled
+        conn = _Connection()
+        connections.append(conn)
+
+        with self._track(conn):
+            assert conn.cancelled.wait(10)
+
+        raise Exception('canceling statement due to user request')
+
+    monkeypatch.setattr(views.QueryManager, '_plan_query', lambda self, params: None)
+    monkeypatch.setattr(views.BatchQueryManager, 'run_query', run_query)
+
+    response = _post(SELECTIONS)
+    content = iter(response.streaming_content)
+    next(content)
+
+    # The client disconnects after the first file
+    while len(connections) < 2:
+        time.sleep(0.01)
+
+    response.close()
+
+    assert all([_.cancelled.wait(5) for _ in connections])
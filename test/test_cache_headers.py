@@ -0,0 +1,74 @@
+from django.conf import settings
+
+if not settings.configured:
+    settings.configure(SECRET_KEY='test-secret-key')
+
+import django
+django.setup()
+
+import pandas as pd
+from django.http import QueryDict
+from django.test import RequestFactory
+
+from cdm_interface import views
+from cdm_interface.file_namer import OutputFileNamer
+
+
+QUERY = 'domain=land&frequency=monthly&year=2000&month=01&variable=air_temperature'
+
+
+def test_file_names_are_deterministic():
+    data_version = views.validate_data_version(None)
+    name = OutputFileNamer(data_version, QueryDict(QUERY)).get_zip_name()
+
+    reordered = QueryDict('variable=air_temperature&month=01&year=2000&frequency=monthly&domain=land&compress=true')
+    assert OutputFileNamer(data_version, reordered).get_zip_name() == name
+
+    assert OutputFileNamer(data_version, QueryDict(QUERY + '&month=02')).get_zip_name() != name
+    assert OutputFileNamer(data_version, QueryDict(QUERY), content='agg').get_zip_name() != name
+
+
+def test_etag_and_not_modified(monkeypatch):
+    runs = []
+
+    def run_query(self, params):
+        runs.append(params)
+        return pd.DataFrame({'a': [1, 2]}), 'policy'
+
+    monkeypatch.setattr(views.QueryManager, 'run_query', run_query)
+    view = views.SelectView.as_view()
+
+    response = view(RequestFactory().get('/v2/select/?' + QUERY), data_version='v2')
+    assert response.status_code == 200
+    assert 'immutable' in response['Cache-Control'] and 'public' in response['Cache-Control']
+
+    # Responses of the default version change with it, so they are not immutable
+    response = view(RequestFactory().get('/select/?' + QUERY))
+    assert response.status_code == 200
+    assert 'immutable' not in response['Cache-Control']
+    assert f'max-age={views.DEFAULT_UNVERSIONED_RESPONSE_CACHE_MAX_AGE}' in response['Cache-Control']
+
+    etag = response['ETag']
+    assert view(RequestFactory().get('/select/?' + QUERY + '&month=02'))['ETag'] != etag
+
+    response = view(RequestFactory().get('/select/?' + QUERY, HTTP_IF_NONE_MATCH=etag))
+    assert response.status_code == 304
+    assert len(runs) == 3
+
+
+def test_invalid_flag_is_rejected():
+    view = views.SelectView.as_view()
+
+    for flag in ('count_only=yes', 'compress=maybe'):
+        response = view(RequestFactory().get('/select/?' + QUERY + '&' + flag))
+        assert response.status_code == 400
+
+
+def test_uncompressed_data_policy_is_rejected(monkeypatch):
+    monkeypatch.setattr(views.QueryManager, 'run_query',
+                        lambda self, params: (pd.DataFrame({'a': [1, 2]}), 'policy'))
+
+    response = views.SelectView.as_view()(RequestFactory().get('/v2/select/?' + QUERY + '&compress=false'),
+                                          data_version='v2')
+    assert response.status_code == 400
+    assert 'Cache-Control' not in response
@@ -0,0 +1,91 @@
+import fcntl
+import hashlib
+import os
+import threading
+import time
+
+from django.conf import settings
+
+if not settings.configured:
+    settings.configure(SECRET_KEY='test-secret-key')
+
+from cdm_interface import coalesce
+
+
+KEY = 'domain=land&frequency=monthly&year=2000'
+
+
+def _base(tmp_path):
+    return os.path.join(tmp_path, hashlib.sha256(KEY.encode('utf-8')).hexdigest())
+
+
+def _setup(monkeypatch, tmp_path):
+    monkeypatch.setattr(settings, 'COALESCE_DIR', str(tmp_path), raising=False)
+    monkeypatch.setattr(settings, 'COALESCE_REQUESTS', True, raising=False)
+
+
+def _run_followers(count, func):
+    results = [None] * count
+
+    def follow(i):
+        results[i] = coalesce.run_once(KEY, func)
+
+    threads = [threading.Thread(target=follow, args=(_,)) for _ in range(count)]
+    for thread in threads:
+        thread.start()
+
+    return threads, results
+
+
+def _join(threads):
+    for thread in threads:
+        thread.join(10)
+        assert not thread.is_alive()
+
+
+def test_followers_read_result_concurrently(monkeypatch, tmp_path):
+    _setup(monkeypatch, tmp_path)
+
+    # All followers must be reading the result at the same time to pass the barrier
+    barrier = threading.Barrier(3, timeout=5)
+    load = coalesce.pickle.load
+
+    def pickle_load(reader):
+        barrier.wait()
+        return load(reader)
+
+    monkeypatch.setattr(coalesce.pickle, 'load', pickle_load)
+    base = _base(tmp_path)
+
+    with open(f'{base}.lock', 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        threads, results = _run_followers(3, lambda: 0)
+
+        time.sleep(0.2)
+        assert coalesce._lead(str(tmp_path), f'{base}.waiting', f'{base}.result', lambda: 42,
+                              always_publish=True) == 42
+        fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    _join(threads)
+    assert results == [42, 42, 42]
+
+
+def test_follower_leads_when_nothing_published(monkeypatch, tmp_path):
+    _setup(monkeypatch, tmp_path)
+    calls = []
+
+    def func():
+        calls.append(1)
+        return 'ran'
+
+    with open(f'{_base(tmp_path)}.lock', 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        threads, results = _run_followers(3, func)
+
+        # The leader dies without publishing anything
+        time.sleep(0.2)
+        fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    _join(threads)
+    assert results == ['ran', 'ran', 'ran']
+    assert len(calls) == 1
@@ -0,0 +1,81 @@
+import asyncio
+import json
+
+from contextlib import contextmanager
+
+from django.conf import settings
+
+if not settings.configured:
+    settings.configure(SECRET_KEY='test-secret-key')
+
+import django
+django.setup()
+
+import pytest
+from django.core.cache import cache
+from django.test import RequestFactory
+
+from cdm_interface import views
+from cdm_interface.wfs_mappings import wfs_mappings
+
+
+QUERY = 'domain=land&frequency=monthly&year=2000&month=01&variable=air_temperature'
+
+
+class _Cursor(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def execute(self, sql, params=None):
+        pass
+
+    def fetchall(self):
+        return [(int(wfs_mappings['variable']['fields']['air_temperature']), 42)]
+
+
+class _Connection(object):
+
+    def cursor(self):
+        return _Cursor()
+
+
+@pytest.fixture
+def database(monkeypatch):
+    @contextmanager
+    def pooled_connection():
+        yield _Connection()
+
+    monkeypatch.setattr(views, 'pooled_connection', pooled_connection)
+    monkeypatch.setattr(views, 'prepare', lambda conn, sql, params: sql)
+    cache.clear()
+
+
+def _check(response):
+    assert response.status_code == 200, response.content
+    assert response['X-Row-Count'] == '42'
+    assert response['X-Row-Count-Estimated'] == 'false'
+
+
+def test_count_only(database):
+    response = views.SelectView.as_view()(RequestFactory().get('/select/?' + QUERY + '&count_only=true'))
+    _check(response)
+    assert json.loads(response.content)['counts'] == {'air_temperature': 42}
+
+
+def test_head(database):
+    response = views.SelectView.as_view()(RequestFactory().head('/select/?' + QUERY))
+    _check(response)
+    assert response.content == b''
+
+
+def test_async_count_only_and_head(database):
+    from cdm_interface import async_views
+
+    view = async_views.AsyncSelectView.as_view()
+
+    _check(asyncio.run(view(RequestFactory().get('/select/?' + QUERY + '&count_only=true'))))
+    _check(asyncio.run(view(RequestFactory().head('/select/?' + QUERY))))
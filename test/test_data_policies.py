@@ -0,0 +1,78 @@
+import os
+
+from django.conf import settings
+
+if not settings.configured:
+    settings.configure(SECRET_KEY='test-secret-key')
+
+import pandas as pd
+
+from cdm_interface.data_policies import PolicyRegistry
+from cdm_interface import data_policies
+
+
+SOURCES = '''source_id|product_name|product_references|product_citation
+251|Product A|Ref A|Cite A
+225|Product B|Ref B|Cite B
+291|Product C||Cite C
+'''
+
+NATIONS = '''country_id|country|institute|data_policy_link|data_policy
+NL|Netherlands|KNMI|https://knmi.nl|0
+NO|Norway|MET Norway|https://met.no|5
+'''
+
+
+def _write(path, content, mtime=None):
+    with open(path, 'w') as writer:
+        writer.write(content)
+
+    if mtime:
+        os.utime(path, (mtime, mtime))
+
+
+def _registry(tmpdir, monkeypatch):
+    source_path, nation_path = [os.path.join(tmpdir, _) for _ in ('sources.psv', 'nations.psv')]
+    _write(source_path, SOURCES, mtime=1000)
+    _write(nation_path, NATIONS, mtime=1000)
+
+    # Restored after each test, so the paths do not leak into other tests
+    monkeypatch.setattr(settings, 'SOURCE_CONFIG_FILE', source_path, raising=False)
+    monkeypatch.setattr(settings, 'NATIONAL_POLICIES_FILE', nation_path, raising=False)
+
+    return PolicyRegistry(), source_path
+
+
+def test_lookup_keeps_file_order(tmpdir, monkeypatch):
+    registry, _ = _registry(str(tmpdir), monkeypatch)
+
+    df = registry.get('source').lookup(pd.Series([291, 251, 251, 999]).unique(), ['source_id', 'product_name'])
+    assert list(df['product_name']) == ['Product A', 'Product C']
+
+    df = registry.get('nation').lookup({'NO', 'XX'}, ['country_id', 'country'])
+    assert list(df['country']) == ['Norway']
+
+
+def test_reload_on_mtime_change(tmpdir, monkeypatch):
+    registry, source_path = _registry(str(tmpdir), monkeypatch)
+
+    first = registry.get('source')
+    assert registry.get('source') is first
+
+    _write(source_path, SOURCES.replace('Product A', 'Product Z'), mtime=2000)
+
+    reloaded = registry.get('source')
+    assert reloaded is not first
+    assert list(reloaded.lookup([251], ['product_name'])['product_name']) == ['Product Z']
+
+
+def test_get_data_policies(tmpdir, monkeypatch):
+    registry, _ = _registry(str(tmpdir), monkeypatch)
+    monkeypatch.setattr(data_policies, 'registry', registry)
+
+    df = pd.DataFrame({'observation_id': ['NLM00006253-1', 'EIM00006253-1'],
+                       'source_id': pd.Categorical([225, 225])})
+    pols = data_policies.get_data_policies(df, rendered=False)
+
+    assert list(pols['by_source']['source_id']) == [225]
+    assert list(pols['by_nation']['country_id']) == ['NL']
@@ -0,0 +1,56 @@
+import tempfile
+
+from django.conf import settings
+
+if not settings.configured:
+    settings.configure(SECRET_KEY='test-secret-key')
+
+import django
+django.setup()
+
+from django.http import QueryDict
+from django.test import RequestFactory, override_settings
+
+from cdm_interface import extracts
+from cdm_interface import views
+
+
+QUERY = 'domain=land&frequency=monthly&year=2000&month=01&variable=air_temperature,accumulated_precipitation'
+
+
+def test_store_lookup():
+    store = extracts.ExtractStore(tempfile.mkdtemp())
+    store.add('v1', QueryDict(QUERY), lambda writer: writer.write(b'zip'), rows=1)
+
+    # Matches regardless of parameter order and list formatting (and "compress")
+    reordered = QueryDict('variable=accumulated_precipitation&variable=air_temperature&month=01&year=2000'
+                          '&frequency=monthly&domain=land&compress=true')
+    path = store.lookup('v1', reordered)
+
+    assert open(path, 'rb').read() == b'zip'
+    assert store.get_entry('v1', reordered)['rows'] == 1
+
+    assert store.lookup('v0', reordered) is None
+    assert store.lookup('v1', QueryDict(QUERY + '&bbox=0,0,10,10')) is None
+
+
+def test_select_serves_extract(monkeypatch):
+    directory = tempfile.mkdtemp()
+    data_version = views.validate_data_version(None)
+
+    with override_settings(EXTRACT_STORE_DIR=directory):
+        extracts.get_store().add(data_version, QueryDict(QUERY), lambda writer: writer.write(b'pre-built'))
+
+        def run_query(self, params):
+            raise Exception('Live query run')
+
+        monkeypatch.setattr(views.QueryManager, 'run_query', run_query)
+
+        response = views.SelectView.as_view()(RequestFactory().get('/select/?' + QUERY))
+        assert response.status_code == 200
+        assert b''.join(response.streaming_content) == b'pre-built'
+        assert response['Content-Disposition'].startswith('attachment; filename="surface-land_monthly')
+
+        # No matching extract: the query is run
+        response = views.SelectView.as_view()(RequestFactory().get('/select/?' + QUERY + '&month=02'))
+        assert response.status_code == 400
@@ -0,0 +1,113 @@
+import datetime
+
+import pandas as pd
+import pytest
+
+from collections import namedtuple
+
+from cdm_interface.frames import _apply_dtypes, concat_frames, map_categories, read_frame
+
+
+UTC = datetime.timezone.utc
+
+
+def _chunk(rows):
+    columns = ['observation_id', 'date_time', 'observed_variable', 'primary_station_id', 'observation_value']
+    return _apply_dtypes(pd.DataFrame.from_records(rows, columns=columns))
+
+
+def test_chunks_keep_categoricals():
+    c1 = _chunk([('a-1', datetime.datetime(1999, 1, 1, tzinfo=UTC), 85, 'STN1', 1.5)])
+    c2 = _chunk([('a-2', datetime.datetime(1999, 1, 2, tzinfo=UTC), 44, 'STN2', 2.5),
+                 ('a-3', datetime.datetime(1999, 1, 2, tzinfo=UTC), 85, 'STN1', None)])
+
+    df = concat_frames([c1, c2])
+
+    assert len(df) == 3
+    assert isinstance(df['observed_variable'].dtype, pd.CategoricalDtype)
+    assert list(df['primary_station_id']) == ['STN1', 'STN2', 'STN1']
+    assert str(df['date_time'].dt.tz) == 'UTC'
+    assert df['observation_value'].dtype == 'float64'
+
+
+def test_map_categories():
+    df = _chunk([('a-1', datetime.datetime(1999, 1, 1, tzinfo=UTC), 85, 'STN1', 1.5),
+                 ('a-2', datetime.datetime(1999, 1, 1, tzinfo=UTC), 44, 'STN1', 1.5),
+                 ('a-3', datetime.datetime(1999, 1, 1, tzinfo=UTC), 99, 'STN1', 1.5)])
+
+    map_categories(df, [('observed_variable', {85: 'air_temperature', 44: 'accumulated_precipitation'})])
+    assert list(df['observed_variable']) == ['air_temperature', 'accumulated_precipitation', 99]
+
+
+Column = namedtuple('Column', ['name'])
+
+
+class _ServerSideCursor(object):
+    "Produces rows only as they are fetched, like a psycopg2 named cursor."
+
+    def __init__(self, conn, name):
+        self.conn = conn
+        self.name = name
+        self.description = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.conn.closed_cursors.append(self.name)
+
+    def execute(self, sql, params=None):
+        self.conn.executed.append(sql)
+
+    def fetchmany(self, size):
+        self.description = [Column('observation_id'), Column('observation_value'), Column('location')]
+        start = self.conn.fetched
+        self.conn.fetched = min(start + size, self.conn.n_rows)
+        return [(f'a-{_}', float(_), 'POINT') for _ in range(start, self.conn.fetched)]
+
+
+class _Connection(object):
+
+    def __init__(self, n_rows):
+        self.n_rows = n_rows
+        self.fetched = 0
+        self.executed = []
+        self.closed_cursors = []
+
+    def cursor(self, name=None):
+        assert name, 'Results must be read with a server-side cursor'
+        return _ServerSideCursor(self, name)
+
+
+def test_read_frame_in_chunks():
+    conn = _Connection(25)
+    df = read_frame(conn, 'SELECT 1', chunksize=10)
+
+    assert list(df.columns) == ['observation_id', 'observation_value']
+    assert len(df) == 25
+    assert conn.fetched == 25
+
+
+class TooLarge(Exception):
+    pass
+
+
+def test_budget_aborts_before_whole_result_is_fetched():
+    conn = _Connection(1000)
+
+    def check(n_rows, n_bytes):
+        if n_rows > 15:
+            raise TooLarge()
+
+    with pytest.raises(TooLarge):
+        read_frame(conn, 'SELECT 1', chunksize=10, check=check)
+
+    # Only the chunks up to the budget were fetched, and the cursor was closed
+    assert conn.fetched == 20
+    assert len(conn.closed_cursors) == 1
+
+
+if __name__ == '__main__':
+
+    test_chunks_keep_categoricals()
+    test_map_categories()
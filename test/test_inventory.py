@@ -0,0 +1,62 @@
+from django.conf import settings
+
+if not settings.configured:
+    settings.configure(SECRET_KEY='test-secret-key')
+
+from cdm_interface import inventory
+
+
+PARTITION = 'lite_2_0.observations_2000_land_2'
+
+
+class _Cursor(object):
+
+    def __init__(self, executed):
+        self.executed = executed
+        self.rowcount = 10
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def execute(self, sql, params=None):
+        self.executed.append(sql)
+
+    def fetchone(self):
+        return None
+
+
+class _Connection(object):
+
+    def __init__(self):
+        self.executed = []
+        self.committed = False
+
+    def cursor(self):
+        return _Cursor(self.executed)
+
+    def commit(self):
+        self.committed = True
+
+
+def test_full_refresh_does_not_truncate():
+    conn = _Connection()
+    assert inventory.refresh_partition(conn, PARTITION) == 10
+    assert conn.committed
+
+    statements = [_.split()[0] for _ in conn.executed]
+    assert 'TRUNCATE' not in statements
+
+    delete = conn.executed.index('DELETE FROM lite_2_0.inventory_2000_land_2')
+    assert conn.executed[delete + 1].startswith('INSERT INTO lite_2_0.inventory_2000_land_2 SELECT')
+    assert conn.executed[delete + 1].endswith('WHERE TRUE GROUP BY 1, 2, 3')
+
+
+def test_monthly_refresh():
+    conn = _Connection()
+    inventory.refresh_partition(conn, PARTITION, months=[1, 2])
+
+    assert 'DELETE FROM lite_2_0.inventory_2000_land_2 WHERE month = ANY(%s)' in conn.executed
+    assert not any([_.startswith('INSERT INTO lite_2_0.inventory_state') for _ in conn.executed])
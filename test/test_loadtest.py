@@ -0,0 +1,134 @@
+import http.server
+import json
+import threading
+import urllib.parse
+
+import pytest
+
+from django.conf import settings
+
+if not settings.configured:
+    settings.configure(SECRET_KEY='test-secret-key')
+
+from django.http import QueryDict
+
+from cdm_interface import loadtest
+from cdm_interface.request_model import parse_request
+
+
+def test_synthetic_mix_is_valid_and_repeatable():
+    mix = loadtest.synthetic_mix(300, seed=1)
+
+    assert mix == loadtest.synthetic_mix(300, seed=1)
+    assert mix != loadtest.synthetic_mix(300, seed=2)
+
+    kinds = [_[0] for _ in mix]
+    assert 0 < kinds.count('constraints') < kinds.count('select')
+
+    # Every selection passes validation, with a spread of domains, frequencies and spatial selections
+    requests = [parse_request(QueryDict(urllib.parse.urlsplit(path).query))
+                for kind, path in mix if kind == 'select']
+
+    assert set([_.domain for _ in requests]) == {'land', 'marine'}
+    assert set([_.frequency for _ in requests]) == {'monthly', 'daily', 'sub_daily'}
+    assert set([_.spatial[0] if _.spatial else None for _ in requests]) == {None, 'bbox', 'point'}
+    assert any(_.time_range for _ in requests) and any(_.years for _ in requests)
+
+
+def test_recorded_mix(tmpdir):
+    path = str(tmpdir.join('requests.txt'))
+
+    with open(path, 'w') as writer:
+        writer.write('# Recorded requests\n')
+        writer.write(json.dumps({'canonical_query': 'domain=land&frequency=daily'}) + '\n')
+        writer.write('v2/constraints/marine\n\n')
+
+    assert loadtest.recorded_mix(path) == [('select', '/v2/select/?domain=land&frequency=daily'),
+                                           ('constraints', '/v2/constraints/marine')]
+
+
+def _result(kind='select', status=200, latency=1., error=None):
+    return {'kind': kind, 'path': '/', 'status': status, 'bytes': 100, 'latency': latency, 'error': error}
+
+
+def test_summarise():
+    results = [_result(latency=float(_)) for _ in range(1, 101)]
+    results += [_result(status=500), _result(status=None, error='URLError: refused'), _result(status=413)]
+    results += [_result(kind='constraints', latency=0.1)]
+
+    report = loadtest.summarise(results, elapsed=10.)
+
+    assert report['requests'] == 104
+    assert report['throughput'] == 10.4
+    assert report['error_rate'] == round(2 / 104, 4)
+    assert report['client_error_rate'] == round(1 / 104, 4)
+    assert report['statuses'] == {'200': 101, '500': 1, 'failed': 1, '413': 1}
+
+    assert report['kinds']['select']['requests'] == 103
+    assert report['kinds']['constraints']['latency']['p99'] == 0.1
+    assert 45 < report['latency']['p50'] < 55
+    assert report['latency']['p50'] < report['latency']['p95'] < report['latency']['p99']
+
+    # The report is written as JSON
+    json.dumps(report)
+
+
+def test_compare():
+    baseline = loadtest.summarise([_result(latency=1.) for _ in range(10)], elapsed=10.,
+                                  rss={'workers': 2, 'peak_worker_mb': 100., 'peak_total_mb': 200.,
+                                       'mean_total_mb': 150.})
+
+    assert loadtest.compare(baseline, baseline) == []
+
+    slower = loadtest.summarise([_result(latency=1.2) for _ in range(9)] + [_result(status=500)], elapsed=10.,
+                                rss={'workers': 2, 'peak_worker_mb': 105., 'peak_total_mb': 300.,
+                                     'mean_total_mb': 150.})
+
+    regressions = dict([(_[0], _[1:]) for _ in loadtest.compare(baseline, slower)])
+
+    assert regressions['latency.p50'] == (1., 1.2)
+    assert regressions['select.latency.p99'] == (1., 1.2)
+    assert regressions['rss.peak_total_mb'] == (200., 300.)
+    assert regressions['error_rate'] == (0., 0.1)
+
+    # Within the threshold
+    assert 'rss.peak_worker_mb' not in regressions
+    assert 'throughput' not in regressions
+    assert 'rss.peak_worker_mb' in dict([(_[0], _) for _ in loadtest.compare(baseline, slower, threshold=0.01)])
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        status = 500 if 'fail' in self.path else 200
+        self.send_response(status)
+        self.send_header('Content-Length', '5')
+        self.end_headers()
+        self.wfile.write(b'hello')
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), _Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    yield f'http://127.0.0.1:{server.server_address[1]}'
+
+    server.shutdown()
+    server.server_close()
+
+
+def test_run(server):
+    mix = [('select', '/v2/select/?a=1')] * 8 + [('select', '/fail'), ('constraints', '/v2/constraints/land')]
+    report = loadtest.run(server, mix, concurrency=4)
+
+    assert report['requests'] == 10
+    assert report['statuses'] == {'200': 9, '500': 1}
+    assert report['error_rate'] == 0.1
+    assert report['bytes_per_second'] > 0
+    assert report['concurrency'] == 4
+    assert report['rss'] is None
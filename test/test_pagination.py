@@ -0,0 +1,55 @@
+import datetime
+
+from django.conf import settings
+
+if not settings.configured:
+    settings.configure(SECRET_KEY='test-secret-key')
+
+from django.http import QueryDict
+from cdm_interface.sql_mngr import SQLManager
+from cdm_interface import pagination
+
+
+UTC = datetime.timezone.utc
+BASE = 'domain=land&frequency=sub_daily&variable=air_temperature&intended_use=open&year=1999&month=03&day=01'
+
+
+def test_token_round_trip():
+    qdict = QueryDict(f'{BASE}&page_size=1000')
+    dt = datetime.datetime(1999, 3, 1, 6, tzinfo=UTC)
+
+    token = pagination.encode_token(qdict, dt, 'UKM00003772-1-1999-03-01-06:00-85-12')
+    # Parameter order and formatting do not matter
+    next_qdict = QueryDict(f'variable=air_temperature&{BASE}&page_size=1000&page_token={token}')
+
+    assert pagination.decode_token(next_qdict) == (dt, 'UKM00003772-1-1999-03-01-06:00-85-12')
+
+
+def test_token_is_bound_to_selection():
+    token = pagination.encode_token(QueryDict(BASE), datetime.datetime(1999, 3, 1, tzinfo=UTC), 'x')
+
+    for qs in (f'{BASE}&bbox=0,0,10,10&page_size=10&page_token={token}', f'{BASE}&page_size=10&page_token=x{token}'):
+        try:
+            pagination.decode_token(QueryDict(qs))
+        except Exception:
+            continue
+
+        raise AssertionError(f'Expected failure for: {qs}')
+
+
+def test_keyset_query():
+    s = SQLManager('v2')
+    dt = datetime.datetime(1999, 3, 1, 6, tzinfo=UTC)
+    query = s._generate_queries(QueryDict(BASE), limit=101, keyset=True, after=(dt, 'x'))
+
+    assert query.sql.endswith('AND date_time >= %s AND (date_time, observation_id) > (%s, %s) '
+                              'ORDER BY date_time, observation_id LIMIT %s')
+    assert query.params[-4:] == [dt, dt, 'x', 101]
+    assert 'OFFSET' not in query.sql
+
+
+if __name__ == '__main__':
+
+    test_token_round_trip()
+    test_token_is_bound_to_selection()
+    test_keyset_query()
@@ -0,0 +1,86 @@
+import threading
+
+from django.conf import settings
+
+if not settings.configured:
+    settings.configure(SECRET_KEY='test-secret-key')
+
+from cdm_interface import query_log
+
+
+class _Connection(object):
+
+    def __init__(self):
+        self.executed = []
+
+    def cursor(self):
+        conn = self
+
+        class _Cursor(object):
+            def __enter__(self):
+                return self
+
+            def __exit__(self, *args):
+                pass
+
+            def execute(self, sql):
+                conn.executed.append(sql)
+
+        return _Cursor()
+
+    def commit(self):
+        pass
+
+
+def test_auto_explain_needs_threshold(monkeypatch):
+    monkeypatch.setattr(settings, 'SLOW_QUERY_EXPLAIN', 'auto_explain', raising=False)
+    monkeypatch.setattr(settings, 'SLOW_QUERY_SAMPLE_RATE', 0.5, raising=False)
+    monkeypatch.setattr(settings, 'SLOW_QUERY_THRESHOLD', None, raising=False)
+
+    conn = _Connection()
+    query_log.configure_auto_explain(conn)
+    assert conn.executed == []
+
+    monkeypatch.setattr(settings, 'SLOW_QUERY_THRESHOLD', 2.5, raising=False)
+    query_log.configure_auto_explain(conn)
+    assert 'SET auto_explain.log_min_duration = 2500' in conn.executed
+
+
+class _Query(object):
+    partition = 'lite_2_0.observations_2000_land_2'
+    sql = f'SELECT * FROM {partition}'
+    params = []
+
+
+def test_replays_are_queued(monkeypatch, tmpdir):
+    log_path = str(tmpdir.join('slow.jsonl'))
+    monkeypatch.setattr(settings, 'SLOW_QUERY_LOG_PATH', log_path, raising=False)
+    monkeypatch.setattr(settings, 'SLOW_QUERY_THRESHOLD', 0, raising=False)
+    monkeypatch.setattr(settings, 'SLOW_QUERY_EXPLAIN', 'replay', raising=False)
+    monkeypatch.setattr(query_log, 'REPLAY_QUEUE_SIZE', 2)
+
+    # Replays block until released, so the queue fills up
+    release = threading.Event()
+    replayed = []
+
+    def _replay(entry, query):
+        release.wait()
+        replayed.append(entry['reqid'])
+
+    monkeypatch.setattr(query_log, '_replay_and_write', _replay)
+    monkeypatch.setattr(query_log, '_replay_pid', None)
+
+    threads = threading.active_count()
+
+    for reqid in range(6):
+        query_log.record_query(reqid, 'domain=land', _Query(), duration=1.)
+
+    # A single worker thread; entries that do not fit in the queue are written without a plan
+    assert threading.active_count() == threads + 1
+    entries = list(query_log.read_entries(log_path))
+    assert len(entries) >= 3
+    assert all([_['plan'] is None and _['plan_error'] == 'Replay queue full' for _ in entries])
+
+    release.set()
+    query_log._replay_queue.join()
+    assert len(replayed) + len(entries) == 6
@@ -0,0 +1,204 @@
+import datetime
+
+import pytest
+
+from django.conf import settings
+
+if not settings.configured:
+    settings.configure(SECRET_KEY='test-secret-key')
+
+from django.http import QueryDict
+from cdm_interface.sql_mngr import SQLManager
+from cdm_interface.db import _to_positional, _statement_name
+
+UTC = datetime.timezone.utc
+
+
+def test_values_are_bound_as_params():
+    s = SQLManager('v2')
+    query = s._generate_queries(QueryDict('domain=land&frequency=sub_daily&variable=air_temperature,'
+                                          'accumulated_precipitation&intended_use=open&data_quality=passed'
+                                          '&year=1999&month=02&day=28,29,30'))
+
+    assert query.partition == 'lite_2_0.observations_1999_land_0'
+    assert query.sql == 'SELECT * FROM lite_2_0.observations_1999_land_0 WHERE observed_variable = ANY(%s) ' \
+                        'AND data_policy_licence = ANY(%s) AND date = ANY(%s)'
+    # Invalid dates (1999-02-29/30) are ignored
+    assert query.params == [[44, 85], [0, 5], [datetime.date(1999, 2, 28)]]
+
+
+def test_time_range_params():
+    s = SQLManager('v2')
+    query = s._generate_queries(QueryDict('domain=marine&frequency=monthly&variable=air_temperature'
+                                          '&intended_use=non_commercial&time=1800-01-01/1800-03-01'))
+
+    assert query.sql.endswith('date_time BETWEEN %s AND %s')
+    assert query.params[-2:] == [datetime.datetime(1800, 1, 1, tzinfo=UTC),
+                                 datetime.datetime(1800, 3, 1, 23, 59, 59, tzinfo=UTC)]
+
+
+def test_same_shape_gives_same_statement():
+    s = SQLManager('v2')
+    q1 = s._generate_queries(QueryDict('domain=land&frequency=monthly&variable=air_temperature'
+                                       '&intended_use=open&year=2000&month=01&bbox=0,0,10,10'))
+    q2 = s._generate_queries(QueryDict('domain=land&frequency=monthly&variable=air_temperature,wind_speed'
+                                       '&intended_use=open&year=2000&month=05,06&bbox=-5,-5,5,5'))
+
+    assert q1.sql == q2.sql
+    assert _statement_name(q1.sql) == _statement_name(q2.sql)
+    assert q1.params != q2.params
+
+
+def test_limit_is_a_param():
+    s = SQLManager('v2')
+    query = s._generate_queries(QueryDict('domain=land&frequency=monthly&variable=air_temperature'
+                                          '&intended_use=open&year=2000&month=01'), limit=1001)
+
+    assert query.sql.endswith(' LIMIT %s')
+    assert query.params[-1] == 1001
+
+
+def test_aggregate_query():
+    s = SQLManager('v2')
+    query = s._generate_aggregate_query(QueryDict('domain=land&frequency=sub_daily&variable=air_temperature'
+                                                  '&intended_use=open&year=2000&month=01&day=01'
+                                                  '&group_by=month,station&statistics=max,count'))
+
+    assert query.sql.startswith("SELECT primary_station_id AS primary_station_id, date_trunc('month', "
+                                "date_time AT TIME ZONE 'UTC')::date AS month, observed_variable, units, "
+                                "count(observation_value) AS count, max(observation_value) AS max, ")
+    assert 'GROUP BY primary_station_id, month, observed_variable, units' in query.sql
+
+    try:
+        s._generate_aggregate_query(QueryDict('domain=land&frequency=monthly&variable=air_temperature'
+                                              '&year=2000&month=01&group_by=hour'))
+    except Exception:
+        return
+
+    raise AssertionError('Expected failure for invalid group_by.')
+
+
+def test_count_queries():
+    s = SQLManager('v2')
+    qdict = QueryDict('domain=land&frequency=monthly&variable=air_temperature,wind_speed'
+                      '&intended_use=open&year=2000&month=01')
+
+    query = s._generate_count_query(qdict)
+    assert query.sql.startswith('SELECT observed_variable, count(*) AS count FROM ')
+    assert query.sql.endswith(' GROUP BY observed_variable')
+    assert query.params[0] == [85, 107]
+
+    estimates = s._generate_count_estimate_queries(qdict)
+    assert [(variable, q.params[0]) for variable, q in estimates] == [('air_temperature', [85]), ('wind_speed', [107])]
+    assert estimates[0][1].sql.startswith('EXPLAIN (FORMAT JSON) SELECT * FROM ')
+
+
+def test_inventory_query():
+    s = SQLManager('v2')
+    query = s._generate_inventory_query(QueryDict('domain=land&frequency=monthly&variable=air_temperature'
+                                                  '&year=1999,2000&month=02&station=A,B'))
+
+    assert query.sql.count(' UNION ALL ') == 1
+    assert 'FROM lite_2_0.inventory_1999_land_' in query.sql
+    assert query.sql.endswith(' ORDER BY primary_station_id, observed_variable, month')
+    assert query.sql.count('%s') == len(query.params)
+    assert query.params[:3] == [[85], ['A', 'B'], [datetime.date(1999, 2, 1)]]
+
+    query = s._generate_inventory_query(QueryDict('domain=marine&frequency=daily&year=1999'))
+    assert 'WHERE TRUE ORDER BY' in query.sql
+    assert query.params == []
+
+
+def test_table_names_reject_injection():
+    s = SQLManager('v2')
+
+    for query in ('domain=x;drop&frequency=monthly&year=1999',
+                  'domain=land&frequency=monthly&year=1999_x;drop',
+                  'domain=land&frequency=monthly&year=1999,2000;drop'):
+        with pytest.raises(Exception, match='"domain"|"year"'):
+            s._generate_inventory_query(QueryDict(query))
+
+    # Partition names of selections are checked in the same way
+    with pytest.raises(Exception, match='"domain"'):
+        s._format_table(s.partition_tmpl, {'SCHEMA': 'lite_2_0', 'domain': 'x;drop', 'year': '1999',
+                                           'report_type': '2'})
+
+
+def test_split_queries():
+    s = SQLManager('v2')
+    qdict = QueryDict('domain=land&frequency=sub_daily&variable=air_temperature,wind_speed'
+                      '&intended_use=open&year=2000&month=01,02,03&day=01')
+
+    by_variable = s._generate_split_queries(qdict, 'variable', limit=10)
+    assert [_.params[0] for _ in by_variable] == [[85], [107]]
+    assert by_variable[0].sql == by_variable[1].sql
+    assert by_variable[0].params[-1] == 10
+
+    by_month = s._generate_split_queries(qdict, 'month')
+    assert len(by_month) == 3
+    assert by_month[1].params[-1] == [datetime.date(2000, 2, 1)]
+
+    assert len(s._generate_split_queries(qdict, 'auto')) == 2
+
+    single = QueryDict('domain=land&frequency=monthly&variable=air_temperature&intended_use=open'
+                       '&time=2000-01-01T00:00:00/2000-06-30T23:59:59')
+    assert len(s._generate_split_queries(single, 'auto')) == 1
+
+
+def test_monthly_condition_is_in_utc():
+    s = SQLManager('v2')
+    query = s._generate_queries(QueryDict('domain=land&frequency=monthly&variable=air_temperature'
+                                          '&intended_use=open&year=2000&month=01,12'))
+
+    # Truncated in UTC and compared with dates, so the session time zone makes no difference
+    assert query.sql.endswith("date_trunc('month', date_time AT TIME ZONE 'UTC')::date = ANY(%s)")
+    assert query.params[-1] == [datetime.date(2000, 1, 1), datetime.date(2000, 12, 1)]
+
+
+def test_monthly_condition_in_non_utc_session():
+    "Runs the monthly condition on a local database (LOCAL_CONN_STR), with a non-UTC session time zone."
+    psycopg2 = pytest.importorskip('psycopg2')
+    conn_str = getattr(settings, 'LOCAL_CONN_STR', None)
+
+    if not conn_str:
+        pytest.skip('LOCAL_CONN_STR is not set')
+
+    try:
+        conn = psycopg2.connect(conn_str)
+    except psycopg2.OperationalError as exc:
+        pytest.skip(f'Cannot connect to the local database: {exc}')
+
+    condition, params = SQLManager('v2')._get_time_condition(['2000'], ['01'], frequency='monthly')
+
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute("SET TimeZone = 'America/New_York'")
+            cursor.execute("CREATE TEMPORARY TABLE observations (date_time timestamptz)")
+            cursor.execute("INSERT INTO observations VALUES ('1999-12-31T23:30:00Z'), ('2000-01-01T00:00:00Z'), "
+                           "('2000-01-31T23:30:00Z'), ('2000-02-01T00:00:00Z')")
+
+            cursor.execute(f"SELECT date_time FROM observations WHERE {condition} ORDER BY date_time", params)
+            selected = [_[0].astimezone(UTC) for _ in cursor.fetchall()]
+    finally:
+        conn.rollback()
+        conn.close()
+
+    assert selected == [datetime.datetime(2000, 1, 1, tzinfo=UTC), datetime.datetime(2000, 1, 31, 23, 30, tzinfo=UTC)]
+
+
+def test_to_positional():
+    assert _to_positional("a = ANY(%s) AND b LIKE 'x%%' AND c = %s") == "a = ANY($1) AND b LIKE 'x%' AND c = $2"
+
+
+if __name__ == '__main__':
+
+    test_values_are_bound_as_params()
+    test_time_range_params()
+    test_same_shape_gives_same_statement()
+    test_limit_is_a_param()
+    test_aggregate_query()
+    test_count_queries()
+    test_inventory_query()
+    test_split_queries()
+    test_monthly_condition_is_in_utc()
+    test_to_positional()
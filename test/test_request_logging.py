@@ -0,0 +1,41 @@
+import json
+import logging
+
+from django.conf import settings
+
+if not settings.configured:
+    settings.configure(SECRET_KEY='test-secret-key')
+
+from cdm_interface import request_logging
+
+
+def _record(level, msg, **extra):
+    record = logging.LogRecord('cdm_interface.views', level, __file__, 1, msg, (), None)
+    record.__dict__.update(extra)
+    return record
+
+
+def test_json_format_with_request_id():
+    request_logging.set_request_id('req-1')
+
+    record = _record(logging.INFO, 'Extracted rows', rows=10)
+    assert request_logging.RequestIdFilter().filter(record)
+
+    entry = json.loads(request_logging.JSONFormatter().format(record))
+    assert entry['request_id'] == 'req-1'
+    assert entry['message'] == 'Extracted rows'
+    assert entry['level'] == 'INFO'
+    assert entry['rows'] == 10
+
+
+def test_debug_sampled_per_request(monkeypatch):
+    sampling = request_logging.SamplingFilter()
+
+    monkeypatch.setattr(settings, 'LOG_DEBUG_SAMPLE_RATE', 0, raising=False)
+    request_logging.set_request_id('req-2')
+    assert not sampling.filter(_record(logging.DEBUG, 'SQL'))
+    assert sampling.filter(_record(logging.INFO, 'Query string'))
+
+    monkeypatch.setattr(settings, 'LOG_DEBUG_SAMPLE_RATE', 1, raising=False)
+    request_logging.set_request_id('req-3')
+    assert sampling.filter(_record(logging.DEBUG, 'SQL'))
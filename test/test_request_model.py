@@ -0,0 +1,115 @@
+import pytest
+
+from django.conf import settings
+
+if not settings.configured:
+    settings.configure(SECRET_KEY='test-secret-key')
+
+from django.http import QueryDict
+
+from cdm_interface.request_model import parse_request
+from cdm_interface.utils import canonical_query
+
+
+QUERY = 'domain=land&frequency=sub_daily&variable=air_temperature&intended_use=open&data_quality=passed'
+
+
+def test_parse_and_normalise():
+    request = parse_request(QueryDict(QUERY + '&variable=air_pressure,air_temperature&year=2000'
+                                      '&month=3,1&day=7&hour=0&bbox=-10,40,10,60&compress=false'))
+
+    assert request.variables == ['air_pressure', 'air_temperature']
+    assert request.months == ['01', '03']
+    assert request.days == ['07'] and request.hours == ['00']
+    assert request.spatial == ('bbox', (-10., 40., 10., 60.))
+
+    # Normalised parameters (other parameters are kept)
+    assert request.params.getlist('month') == ['01', '03']
+    assert request.params['compress'] == 'false'
+
+
+def test_time_range():
+    request = parse_request(QueryDict(QUERY + '&time=2000-01-01/2000-02-01T12:00'))
+    assert request.time_range[1].day == 1 and request.time_range[1].hour == 12
+
+    with pytest.raises(Exception, match='maximum of 1 year'):
+        parse_request(QueryDict(QUERY + '&time=2000-01-01/2001-01-01'))
+
+
+@pytest.mark.parametrize('extra, message', [
+    ('&year=2000&month=13', 'Invalid value for "month"'),
+    ('&year=20x0&month=1', 'Invalid value for "year"'),
+    ('&year=2000&month=1&variable=unknown', 'Cannot find value "unknown"'),
+    ('&year=2000&month=1&intended_use=private', 'Cannot find value "private"'),
+    ('&year=2000&month=1&bbox=0,0,200,10', 'out of range'),
+    ('&year=2000&month=1&radius=10', '"radius" can only be used'),
+    ('&year=2000&month=1&column_selection=all', 'column_selection'),
+    ('&year=2000', 'time compoonents'),
+])
+def test_invalid_requests(extra, message):
+    with pytest.raises(Exception, match=message):
+        parse_request(QueryDict(QUERY + extra))
+
+
+def test_missing_parameter():
+    with pytest.raises(KeyError):
+        parse_request(QueryDict('domain=land&frequency=monthly&year=2000&month=01'))
+
+
+def test_aggregate_options_are_normalised():
+    request = parse_request(QueryDict(QUERY + '&year=2000&month=1&group_by=month,station&statistics=max'
+                                      '&statistics=count'))
+
+    assert request.params.getlist('group_by') == ['month', 'station']
+    assert request.params.getlist('statistics') == ['count', 'max']
+
+    same = parse_request(QueryDict(QUERY + '&year=2000&month=1&group_by=station&group_by=month'
+                                   '&statistics=count,max'))
+    assert canonical_query(request.params) == canonical_query(same.params)
+
+
+def test_flags():
+    request = parse_request(QueryDict(QUERY + '&year=2000&month=1'))
+    assert request.compress is True and request.count_only is False
+
+    request = parse_request(QueryDict(QUERY + '&year=2000&month=1&compress=false&count_only=True'))
+    assert request.compress is False and request.count_only is True
+
+    with pytest.raises(Exception, match='"count_only"'):
+        parse_request(QueryDict(QUERY + '&year=2000&month=1&count_only=yes'))
+
+
+def test_queries_generated_from_parsed_request(monkeypatch):
+    from cdm_interface import request_model
+    from cdm_interface.sql_mngr import SQLManager
+
+    request = parse_request(QueryDict(QUERY + '&variable=air_pressure&year=2000&month=1,2&station=A1,B2'
+                                      '&point=10,50&radius=5'), 'v2')
+
+    # The SQL is generated from the fields of the parsed request, without parsing it again
+    def fail(*args):
+        raise AssertionError('Request parsed again')
+
+    monkeypatch.setattr(request_model, 'parse_request', fail)
+    s = SQLManager('v2', selection=request)
+
+    query = s._generate_queries(request.params)
+    assert query.partition == 'lite_2_0.observations_2000_land_0'
+    assert query.params[:6] == [[57, 85], [0, 5], 10., 50., 5000., ['A1', 'B2']]
+
+    queries = s._generate_split_queries(request.params, 'variable')
+    assert [_.params[0] for _ in queries] == [[57], [85]]
+
+    estimates = s._generate_count_estimate_queries(request.params)
+    assert [_[0] for _ in estimates] == ['air_pressure', 'air_temperature']
+
+
+def test_time_range_parsed_once():
+    from cdm_interface.sql_mngr import SQLManager
+
+    # The request model and SQL generation share one parser, so they agree
+    with pytest.raises(Exception, match='must be before its end'):
+        parse_request(QueryDict(QUERY + '&time=2000-02-01/2000-01-01'))
+
+    with pytest.raises(Exception, match='must be before its end'):
+        SQLManager('v2')._generate_queries(QueryDict(QUERY + '&time=2000-02-01/2000-01-01'))
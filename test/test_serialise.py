@@ -0,0 +1,110 @@
+import io
+import zlib
+import zipfile
+
+from multiprocessing import shared_memory
+
+import pandas as pd
+import pytest
+
+from django.conf import settings
+
+if not settings.configured:
+    settings.configure(SECRET_KEY='test-secret-key')
+
+from django.http import QueryDict
+
+from cdm_interface import serialise
+
+
+def test_crc32_combine():
+    first, second = b'observations', b'-table data' * 100
+    combined = serialise.crc32_combine(zlib.crc32(first), zlib.crc32(second), len(second))
+
+    assert combined == zlib.crc32(first + second)
+
+
+def test_parallel_csv_matches_to_csv():
+    df = pd.DataFrame({'a': range(2500), 'b': pd.Categorical(['x', 'y'] * 1250)})
+
+    assert b''.join(serialise.iter_csv_parallel(df, 2, chunk_rows=1000)) == df.to_csv(index=False).encode('utf-8')
+
+
+def test_parallel_zip():
+    df = pd.DataFrame({'a': range(2500), 'b': ['x'] * 2500})
+    expected = df.to_csv(index=False).encode('utf-8')
+
+    for zip64 in (False, True):
+        data = b''.join(serialise.iter_zip_parallel('data.csv', df, [('policy.txt', b'policy')], 3,
+                                                    chunk_rows=700, zip64=zip64))
+
+        zf = zipfile.ZipFile(io.BytesIO(data))
+        assert zf.testzip() is None
+        assert zf.namelist() == ['data.csv', 'policy.txt']
+        assert zf.read('data.csv') == expected
+        assert zf.read('policy.txt') == b'policy'
+
+
+def test_streamed_zip_always_zip64(monkeypatch):
+    from cdm_interface import views
+
+    # The size of the CSV is only known once streamed, so even a CSV estimated (far)
+    # below 4 GB is zipped with zip64 records
+    monkeypatch.setattr(settings, 'SERIALISE_PROCESSES', 2, raising=False)
+    monkeypatch.setattr(settings, 'SERIALISE_PARALLEL_MIN_ROWS', 1, raising=False)
+
+    df = pd.DataFrame({'a': range(2500), 'b': ['x'] * 2500})
+    view = views.SelectView()
+    view._reqid = 'req'
+
+    response = view._build_response(QueryDict('domain=land&frequency=monthly&variable=air_temperature'),
+                                    df, 'v2', 'policy', compress=True)
+    data = b''.join(response.streaming_content)
+
+    # With a zip64 end of central directory record
+    assert b'PK\x06\x06' in data[-200:]
+
+    zf = zipfile.ZipFile(io.BytesIO(data))
+    assert zf.testzip() is None
+    assert zf.read(zf.namelist()[0]) == df.to_csv(index=False).encode('utf-8')
+
+
+def test_pool_is_reused():
+    df = pd.DataFrame({'a': range(100), 'b': [1.5] * 100})
+    expected = df.to_csv(index=False).encode('utf-8')
+
+    assert b''.join(serialise.iter_csv_parallel(df, 2, chunk_rows=10)) == expected
+    pids = sorted([_.pid for _ in serialise._pool._pool])
+
+    assert b''.join(serialise.iter_csv_parallel(df, 2, chunk_rows=30)) == expected
+    assert sorted([_.pid for _ in serialise._pool._pool]) == pids
+
+
+def test_abandoned_response_releases_shared_memory(monkeypatch):
+    blocks = []
+    submit = serialise._submit
+
+    def _submit(*args):
+        block, result = submit(*args)
+        blocks.append(block.name)
+        return block, result
+
+    monkeypatch.setattr(serialise, '_submit', _submit)
+    df = pd.DataFrame({'a': range(1000)})
+
+    pieces = serialise.iter_csv_parallel(df, 2, chunk_rows=10)
+    next(pieces)
+    pieces.close()
+
+    assert len(blocks) > 1
+    for name in blocks:
+        with pytest.raises(FileNotFoundError):
+            shared_memory.SharedMemory(name=name)
+
+
+if __name__ == '__main__':
+
+    test_crc32_combine()
+    test_parallel_csv_matches_to_csv()
+    test_parallel_zip()
+    test_pool_is_reused()
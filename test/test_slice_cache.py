@@ -0,0 +1,181 @@
+import os
+import tempfile
+
+from django.conf import settings
+
+if not settings.configured:
+    settings.configure(SECRET_KEY='test-secret-key')
+
+import django
+django.setup()
+
+import pandas as pd
+from django.http import QueryDict
+from django.test import override_settings
+
+from cdm_interface import slice_cache
+from cdm_interface import views
+from cdm_interface.slice_cache import SliceCache
+
+
+def _get_frame():
+    return pd.DataFrame({
+        'observation_id': ['a-1', 'a-2', 'b-1'],
+        'data_policy_licence': pd.Categorical([0, 1, 1]),
+        'date_time': pd.to_datetime(['2000-01-01 00:00', None, '2000-01-03 12:00'], utc=True),
+        'observation_value': [1.5, float('nan'), 3.25],
+        'primary_station_id': pd.Categorical(['A', 'A', None]),
+    })
+
+
+def test_round_trip_and_projection():
+    cache = SliceCache(tempfile.mkdtemp())
+    df = _get_frame()
+    cache.put('key', df)
+
+    pd.testing.assert_frame_equal(cache.get('key'), df, check_categorical=False)
+
+    projected = cache.get('key', columns=['observation_value', 'observation_id'])
+    assert list(projected.columns) == ['observation_id', 'observation_value']
+
+    assert cache.get('missing') is None
+
+
+def test_key_ignores_output_options():
+    key = slice_cache.get_key('v1', QueryDict('domain=land&variable=a,b&intended_use=open'))
+
+    assert key == slice_cache.get_key('v1', QueryDict('variable=b&variable=a&domain=land&compress=false'
+                                                      '&column_selection=basic_metadata'))
+    assert key != slice_cache.get_key('v1', QueryDict('domain=land&variable=a'))
+
+
+def test_least_recently_used_evicted():
+    directory = tempfile.mkdtemp()
+    cache = SliceCache(directory, max_bytes=1)
+
+    cache.put('first', _get_frame())
+    assert os.listdir(directory) == []
+
+    cache.max_bytes = 10 ** 6
+    cache.put('first', _get_frame())
+    cache.put('second', _get_frame())
+
+    # "second" was used least recently
+    os.utime(os.path.join(directory, 'second', slice_cache.META_FILE), (0, 0))
+    assert cache.get('first') is not None
+
+    # Room for two slices (which differ by a few bytes in their metadata)
+    cache.max_bytes = 2 * slice_cache._get_size(os.path.join(directory, 'first')) + 100
+    cache.put('third', _get_frame())
+
+    assert sorted(os.listdir(directory)) == ['first', 'third']
+
+
+def test_slices_being_written_not_evicted():
+    directory = tempfile.mkdtemp()
+    cache = SliceCache(directory, max_bytes=1)
+
+    # A slice written by another process, before it is renamed into place
+    tmp_path = tempfile.mkdtemp(dir=directory, prefix='.tmp-')
+    with open(os.path.join(tmp_path, slice_cache.META_FILE), 'w') as writer:
+        writer.write('{}')
+
+    cache.put('first', _get_frame())
+    assert os.listdir(directory) == [os.path.basename(tmp_path)]
+
+
+def test_cached_slice_reused_across_intended_use(monkeypatch):
+    extracted = []
+
+    def extract_frames(self, kwargs):
+        extracted.append(kwargs.getlist('intended_use'))
+        return [_get_frame()], None
+
+    monkeypatch.setattr(views.QueryManager, '_extract_frames', extract_frames)
+    monkeypatch.setattr(views.QueryManager, '_finish_query', lambda self, kwargs, dfs, page_size=None: (dfs[0], ''))
+
+    query = 'domain=land&frequency=monthly&year=2000&month=01&variable=air_temperature'
+
+    with override_settings(SLICE_CACHE_DIR=tempfile.mkdtemp()):
+        qm = views.QueryManager('v1', 'req')
+        df, _ = qm.run_query(QueryDict(query + '&intended_use=open'))
+        assert list(df['observation_id']) == ['a-1']
+
+        df, _ = qm.run_query(QueryDict(query + '&intended_use=non_commercial&compress=false'))
+        assert list(df['observation_id']) == ['a-2', 'b-1']
+
+    # The slice was only extracted once, for all intended uses
+    assert extracted == [list(slice_cache.ALL_INTENDED_USES)]
+
+
+def test_concurrent_writers():
+    directory = tempfile.mkdtemp()
+    cache = SliceCache(directory)
+    cache.put('key', _get_frame())
+
+    # Another process wrote the same slice first: its copy is kept
+    cache.put('key', _get_frame().iloc[:1])
+
+    assert len(cache.get('key')) == 3
+    assert os.listdir(directory) == ['key']
+
+    # An expired slice is replaced
+    cache.timeout = -1
+    cache.put('key', _get_frame().iloc[:1])
+
+    cache.timeout = 10
+    assert len(cache.get('key')) == 1
+    assert os.listdir(directory) == ['key']
+
+
+def test_partial_slice_filtered_and_cache_errors_ignored(monkeypatch):
+    def extract_frames(self, kwargs):
+        return [_get_frame(), None], None
+
+    def put(self, key, df):
+        raise OSError('Disk full')
+
+    monkeypatch.setattr(views.QueryManager, '_extract_frames', extract_frames)
+    monkeypatch.setattr(views.QueryManager, '_finish_query', lambda self, kwargs, dfs, page_size=None: (dfs, ''))
+    monkeypatch.setattr(SliceCache, 'put', put)
+
+    query = 'domain=land&frequency=monthly&year=2000&month=01&variable=air_temperature&intended_use=open'
+
+    with override_settings(SLICE_CACHE_DIR=tempfile.mkdtemp()):
+        # Slices with missing partitions are not cached, but the licence filter still applies
+        dfs, _ = views.QueryManager('v1', 'req').run_query(QueryDict(query))
+        assert [list(_['observation_id']) for _ in dfs] == [['a-1']]
+
+        # A failed cache write does not fail the request
+        monkeypatch.setattr(views.QueryManager, '_extract_frames', lambda self, kwargs: ([_get_frame()], None))
+        dfs, _ = views.QueryManager('v1', 'req').run_query(QueryDict(query))
+        assert [list(_['observation_id']) for _ in dfs] == [['a-1']]
+
+
+def test_request_parsed_once(monkeypatch):
+    parsed = []
+    parse_request = views.parse_request
+
+    def counting_parse_request(*args):
+        parsed.append(args[0])
+        return parse_request(*args)
+
+    def extract_frames(self, kwargs):
+        # As in `_plan_query`
+        selection = self._validate_request(kwargs)
+        assert selection.params is kwargs
+        assert sorted(selection.intended_use) == sorted(kwargs.getlist('intended_use'))
+        return [_get_frame()], None
+
+    monkeypatch.setattr(views, 'parse_request', counting_parse_request)
+    monkeypatch.setattr(views.QueryManager, '_extract_frames', extract_frames)
+    monkeypatch.setattr(views.QueryManager, '_finish_query', lambda self, kwargs, dfs, page_size=None: (dfs[0], ''))
+
+    query = 'domain=land&frequency=monthly&year=2000&month=01&variable=air_temperature&intended_use=open'
+    selection = parse_request(QueryDict(query), 'v1')
+
+    with override_settings(SLICE_CACHE_DIR=tempfile.mkdtemp()):
+        df, _ = views.QueryManager('v1', 'req', selection=selection).run_query(selection.params)
+        assert list(df['observation_id']) == ['a-1']
+
+    assert parsed == []
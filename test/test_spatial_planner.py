@@ -0,0 +1,123 @@
+from django.conf import settings
+
+if not settings.configured:
+    settings.configure(SECRET_KEY='test-secret-key')
+
+from django.http import QueryDict
+from cdm_interface.sql_mngr import SQLManager, _get_tile_bounds
+
+
+BASE = 'domain=land&frequency=monthly&variable=air_temperature&intended_use=open&data_quality=passed' \
+       '&year=1999&month=03'
+
+
+def _spatial(extra):
+    s = SQLManager('v2')
+    return s._get_spatial_condition(s._parse_spatial(QueryDict(f'{BASE}&{extra}')))
+
+
+def test_bbox_uses_index_prefilter_on_native_column():
+    cond, params = _spatial('bbox=-1,50,10,59')
+
+    assert cond.startswith('(location && ST_Segmentize(ST_MakeEnvelope(%s, %s, %s, %s, 4326), 1)::geography')
+    assert 'ST_Intersects(location, ' in cond
+    assert 'location::geometry' not in cond
+    assert params == [-1., 50., 10., 59.] * 2
+
+
+def test_bbox_crossing_antimeridian_is_split():
+    cond, params = _spatial('bbox=170,-10,-170,10')
+
+    assert cond.count('ST_MakeEnvelope(%s, %s, %s, %s, 4326)') == 4
+    assert ' OR ' in cond
+    assert params == [170., -10., 180., 10.] * 2 + [-180., -10., -170., 10.] * 2
+
+
+def test_bbox_whole_globe_has_no_condition():
+    assert _spatial('bbox=-180,-90,180,90') == (None, [])
+
+
+def test_wide_bbox_is_halved():
+    s = SQLManager('v2')
+    assert s._split_bbox(-180, -50, 180, 50) == [(-180, -50, 0., 50), (0., -50, 180, 50)]
+
+
+def test_polygon_and_radius():
+    cond, params = _spatial('polygon=POLYGON((0 0, 0 10, 10 10, 10 0, 0 0))')
+    assert cond == '(location && ST_GeogFromText(%s) AND ST_Intersects(location, ST_GeogFromText(%s)))'
+    assert params == ['SRID=4326;POLYGON((0 0, 0 10, 10 10, 10 0, 0 0))'] * 2
+
+    cond, params = _spatial('point=-1.5,51.5&radius=25')
+    assert cond == 'ST_DWithin(location, ST_SetSRID(ST_MakePoint(%s, %s), 4326)::geography, %s)'
+    assert params == [-1.5, 51.5, 25000.]
+
+
+def test_invalid_spatial_selections():
+    for extra in ("polygon=POLYGON((0 0, 1 1));DROP TABLE x", 'bbox=1,2,3', 'bbox=0,10,10,0',
+                  'bbox=0,0,1,1&point=0,0&radius=1', 'point=0,0', 'radius=10'):
+        try:
+            _spatial(extra)
+        except Exception:
+            continue
+
+        raise AssertionError(f'Expected failure for: {extra}')
+
+
+def test_tile_bounds():
+    (w, s, e, n), (xmin, ymin, xmax, ymax) = _get_tile_bounds(1, 1, 0)
+
+    assert (w, s, e) == (0., 0., 180.)
+    assert round(n, 4) == 85.0511
+    assert (xmin, ymin) == (0., 0.)
+    assert round(xmax) == round(ymax) == 20037508
+
+    for z, x, y in ((1, 2, 0), (0, 0, -1), (23, 0, 0)):
+        try:
+            _get_tile_bounds(z, x, y)
+        except Exception:
+            continue
+
+        raise AssertionError(f'Expected failure for tile: {z}/{x}/{y}')
+
+
+def test_tile_query():
+    s = SQLManager('v2')
+    query = s._generate_tile_query(QueryDict(BASE), 2, 2, 1)
+
+    assert query.sql.startswith("SELECT ST_AsMVT(tile.*, 'observations')")
+    assert query.sql.count('%s') == len(query.params)
+    assert query.params[4] == s.TILE_CLUSTER_GRID
+    assert query.params[-8:] == [0., 0., 90., 66.51326044311186] * 2
+
+    assert s._generate_tile_query(QueryDict(BASE), 10, 0, 0).params[4] == 1
+
+
+def test_tile_defaults_cover_whole_year():
+    from cdm_interface.views import get_tile_params
+
+    s = SQLManager('v2')
+
+    for frequency in ('daily', 'sub_daily'):
+        params = get_tile_params(QueryDict(f'domain=land&frequency={frequency}&variable=air_temperature&year=1999'))
+        query = s._generate_tile_query(params, 2, 2, 1)
+
+        # All days of the year are selected, not only the first of each month
+        dates = [_ for _ in query.params if isinstance(_, list) and len(_) > 300][0]
+        assert len(dates) == 365
+
+    params = get_tile_params(QueryDict('domain=land&frequency=daily&variable=air_temperature&year=1999&month=02'))
+    assert params['intended_use'] == 'open,non_commercial'
+    assert params.getlist('month') == ['02'] and len(params['day'].split(',')) == 31
+    assert 'hour' not in params
+
+
+if __name__ == '__main__':
+
+    test_bbox_uses_index_prefilter_on_native_column()
+    test_bbox_crossing_antimeridian_is_split()
+    test_bbox_whole_globe_has_no_condition()
+    test_wide_bbox_is_halved()
+    test_polygon_and_radius()
+    test_invalid_spatial_selections()
+    test_tile_bounds()
+    test_tile_query()
@@ -0,0 +1,102 @@
+import threading
+import time
+
+from contextlib import contextmanager
+
+import pandas as pd
+import psycopg2
+import pytest
+
+from django.conf import settings
+
+if not settings.configured:
+    settings.configure(SECRET_KEY='test-secret-key')
+
+from django.http import QueryDict
+
+from cdm_interface import views
+from cdm_interface import limits
+from cdm_interface.sql_mngr import SQLManager, Query
+
+
+QUERY = 'domain=land&frequency=monthly&variable=air_temperature&intended_use=open&year=2000&month=01,02,03'
+
+
+class _Connection(object):
+
+    def __init__(self):
+        self.cancelled = threading.Event()
+
+    def cancel(self):
+        self.cancelled.set()
+
+    def rollback(self):
+        pass
+
+
+def _setup(monkeypatch, read_frame, parallelism=3):
+    queries = [Query(f'SELECT {_}', [], f'lite_2_0.observations_2000_land_{_}') for _ in range(3)]
+    monkeypatch.setattr(views.QueryManager, '_plan_query', lambda self, kwargs: (
+        SQLManager('v2'), limits.Limits(None, None), None, queries))
+    monkeypatch.setattr(views.QueryManager, '_prepare_connection', lambda self, *args: None)
+    monkeypatch.setattr(views, 'read_frame', read_frame)
+    monkeypatch.setattr(settings, 'QUERY_PARALLELISM', parallelism, raising=False)
+
+    connections = []
+
+    @contextmanager
+    def pooled_connection():
+        conn = _Connection()
+        connections.append(conn)
+        yield conn
+
+    monkeypatch.setattr(views, 'pooled_connection', pooled_connection)
+    return connections
+
+
+def test_failed_sub_query_fails_request(monkeypatch):
+    def read_frame(conn, sql, **kwargs):
+        if sql == 'SELECT 1':
+            raise psycopg2.OperationalError('server closed the connection')
+
+        return pd.DataFrame({'observation_id': [sql]})
+
+    for parallelism in (1, 3):
+        _setup(monkeypatch, read_frame, parallelism=parallelism)
+
+        with pytest.raises(Exception, match='Error when extracting data'):
+            views.QueryManager('v2', 'req')._extract_frames(QueryDict(QUERY))
+
+
+def test_missing_partition_is_empty(monkeypatch):
+    def read_frame(conn, sql, **kwargs):
+        if sql == 'SELECT 1':
+            raise psycopg2.errors.UndefinedTable('relation does not exist')
+
+        return pd.DataFrame({'observation_id': [sql]})
+
+    _setup(monkeypatch, read_frame)
+    dfs, _ = views.QueryManager('v2', 'req')._extract_frames(QueryDict(QUERY))
+
+    assert dfs[1] is None
+    assert [len(_) for _ in (dfs[0], dfs[2])] == [1, 1]
+
+
+def test_abort_cancels_running_sub_queries(monkeypatch):
+    def read_frame(conn, sql, **kwargs):
+        if sql == 'SELECT 0':
+            time.sleep(0.1)
+            raise limits.RequestTooLarge('Too many rows')
+
+        # Runs until cancelled
+        assert conn.cancelled.wait(10)
+        raise psycopg2.extensions.QueryCanceledError('canceling statement due to user request')
+
+    connections = _setup(monkeypatch, read_frame)
+    start = time.time()
+
+    with pytest.raises(limits.RequestTooLarge):
+        views.QueryManager('v2', 'req')._extract_frames(QueryDict(QUERY))
+
+    assert time.time() - start < 5
+    assert sum([_.cancelled.is_set() for _ in connections]) == 2
@@ -0,0 +1,49 @@
+from django.conf import settings
+
+if not settings.configured:
+    settings.configure(SECRET_KEY='test-secret-key')
+
+from django.http import QueryDict
+from cdm_interface.sql_mngr import SQLManager
+
+
+BASE = 'domain=land&frequency=monthly&variable=air_temperature&intended_use=open&data_quality=passed' \
+       '&year=1999&month=03'
+
+
+def test_small_station_list_is_inlined():
+    s = SQLManager('v2')
+    query = s._generate_queries(QueryDict(f'{BASE}&station=UKM00003772,USW00094728&station=UKM00003772'))
+
+    assert "primary_station_id = ANY(%s) AND " in query.sql
+    assert ['UKM00003772', 'USW00094728'] in query.params
+
+
+def test_large_station_list_uses_temporary_table():
+    s = SQLManager('v2')
+    stations = '\n'.join([f'STN{i:05d}' for i in range(s.STATION_TABLE_THRESHOLD + 1)])
+
+    qdict = QueryDict(BASE, mutable=True)
+    qdict['station'] = stations
+
+    assert s.needs_station_table(s._get_stations(qdict))
+    assert f'primary_station_id IN (SELECT primary_station_id FROM {s.STATION_TABLE}) AND ' \
+        in s._generate_queries(qdict).sql
+
+
+def test_invalid_station_is_rejected():
+    s = SQLManager('v2')
+
+    try:
+        s._get_stations(QueryDict("station=UKM00003772,x');DROP"))
+    except Exception:
+        return
+
+    raise AssertionError('Expected failure for invalid station.')
+
+
+if __name__ == '__main__':
+
+    test_small_station_list_is_inlined()
+    test_large_station_list_uses_temporary_table()
+    test_invalid_station_is_rejected()
@@ -0,0 +1,33 @@
+import io
+import zipfile
+
+import pandas as pd
+
+from cdm_interface.streaming import iter_csv, iter_zip
+
+
+def test_csv_chunks_match_to_csv():
+    df = pd.DataFrame({'a': range(250), 'b': ['x'] * 250})
+    chunks = list(iter_csv(df, chunk_rows=100))
+
+    assert len(chunks) == 3
+    assert b''.join(chunks) == df.to_csv(index=False).encode('utf-8')
+
+    empty = pd.DataFrame(columns=['a', 'b'])
+    assert list(iter_csv(empty)) == [b'a,b\n']
+
+
+def test_streamed_zip():
+    df = pd.DataFrame({'a': range(250)})
+    data = b''.join(iter_zip([('data.csv', iter_csv(df, chunk_rows=100)), ('policy.txt', [b'policy'])]))
+
+    zf = zipfile.ZipFile(io.BytesIO(data))
+    assert zf.namelist() == ['data.csv', 'policy.txt']
+    assert zf.read('data.csv') == df.to_csv(index=False).encode('utf-8')
+    assert zf.read('policy.txt') == b'policy'
+
+
+if __name__ == '__main__':
+
+    test_csv_chunks_match_to_csv()
+    test_streamed_zip()
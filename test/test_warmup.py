@@ -0,0 +1,83 @@
+import time
+
+from contextlib import contextmanager
+
+from django.conf import settings
+
+if not settings.configured:
+    settings.configure(SECRET_KEY='test-secret-key')
+
+from django.http import QueryDict
+
+from cdm_interface import views
+from cdm_interface import warmup
+
+
+QUERY = 'domain=land&frequency=monthly&variable=air_temperature&intended_use=open&month=01'
+
+
+def test_queries_on_missing_partitions_are_skipped(monkeypatch):
+    qm = views.QueryManager('v2', 'req')
+
+    # Before the partitions are loaded, all queries are run
+    monkeypatch.setattr(warmup, 'partitions', {})
+    assert len(qm._plan_query(QueryDict(QUERY + '&year=2000'))[3]) == 1
+
+    monkeypatch.setattr(warmup, 'partitions', {'v2': frozenset(['lite_2_0.observations_2000_land_2'])})
+    monkeypatch.setattr(warmup, '_partitions_loaded', {'v2': time.monotonic()})
+    assert warmup.has_partition('v2', 'lite_2_0.observations_2000_land_2')
+    assert not warmup.has_partition('v2', 'lite_2_0.observations_1999_land_2')
+
+    assert len(qm._plan_query(QueryDict(QUERY + '&year=2000'))[3]) == 1
+    assert qm._plan_query(QueryDict(QUERY + '&year=1999'))[3] == []
+
+    # No query (or connection) is needed for an empty result
+    assert qm._extract_frames(QueryDict(QUERY + '&year=1999')) == ([], None)
+
+
+def test_partitions_reloaded_on_miss(monkeypatch):
+    from cdm_interface import db, inventory
+
+    tables = ['lite_2_0.observations_2000_land_2']
+    loads = []
+
+    @contextmanager
+    def pooled_connection():
+        yield None
+
+    def list_partitions(conn, data_version):
+        loads.append(data_version)
+        return list(tables)
+
+    monkeypatch.setattr(db, 'pooled_connection', pooled_connection)
+    monkeypatch.setattr(inventory, 'list_partitions', list_partitions)
+    monkeypatch.setattr(warmup, 'partitions', {'v2': frozenset(tables)})
+    monkeypatch.setattr(warmup, '_partitions_loaded', {'v2': time.monotonic()})
+
+    # A partition added after the (recent) load is skipped until the list is stale
+    tables.append('lite_2_0.observations_2001_land_2')
+    assert not warmup.has_partition('v2', 'lite_2_0.observations_2001_land_2')
+    assert loads == []
+
+    monkeypatch.setattr(warmup, '_partitions_loaded', {'v2': time.monotonic() - 3600})
+    assert warmup.has_partition('v2', 'lite_2_0.observations_2001_land_2')
+    assert loads == ['v2']
+
+    # The reloaded list is used for later misses
+    assert not warmup.has_partition('v2', 'lite_2_0.observations_1999_land_2')
+    assert loads == ['v2']
+
+
+def test_partitions_queried_when_reload_fails(monkeypatch):
+    from cdm_interface import db
+
+    @contextmanager
+    def pooled_connection():
+        raise Exception('could not connect to server')
+        yield
+
+    monkeypatch.setattr(db, 'pooled_connection', pooled_connection)
+    monkeypatch.setattr(warmup, 'partitions', {'v2': frozenset()})
+    monkeypatch.setattr(warmup, '_partitions_loaded', {})
+
+    assert warmup.has_partition('v2', 'lite_2_0.observations_2001_land_2')